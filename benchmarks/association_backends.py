@@ -0,0 +1,43 @@
+"""
+Benchmarks the backends used to mine frequent itemsets (see csc_lib.association_rules.MINING_BACKENDS)
+on synthetic corpora of several sizes and for several values of min_docs.
+
+Usage (from the root of the repository):
+    python -m benchmarks.association_backends
+"""
+
+import time
+import argparse
+from csc_lib.annotation_processor import flatten_annotations_dict
+from csc_lib.association_rules import MINING_BACKENDS
+from benchmarks.synthetic_corpus import generate_annotations_dict
+
+
+def main(corpus_sizes, min_docs_values):
+
+    print(f"{'# docs':>8} {'min_docs':>9} {'# itemsets':>11} " + ' '.join(f'{backend:>10}' for backend in MINING_BACKENDS) + '  same itemsets')
+    for nb_docs in corpus_sizes:
+        anns_dict = generate_annotations_dict(nb_docs, vocabulary_size=nb_docs)
+        all_anns = flatten_annotations_dict(anns_dict)
+
+        for min_docs in min_docs_values:
+            durations, results = {}, {}
+            for backend, get_frequent_itemsets in MINING_BACKENDS.items():
+                start = time.perf_counter()
+                frequent_itemsets = get_frequent_itemsets(all_anns, anns_dict, min_docs / nb_docs)
+                durations[backend] = time.perf_counter() - start
+                results[backend] = dict(zip(frequent_itemsets['itemsets'], frequent_itemsets['support']))
+
+            # Association rules are derived from the frequent itemsets and their support only
+            same_itemsets = all(itemsets == results['fpgrowth'] for itemsets in results.values())
+            print(f"{nb_docs:>8} {min_docs:>9} {len(results['fpgrowth']):>11} " + ' '.join(f'{durations[backend]:>9.2f}s' for backend in MINING_BACKENDS) + f'  {same_itemsets}')
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmark the backends used to mine frequent itemsets')
+    parser.add_argument('--corpus_sizes', type=int, nargs='+', default=[2000, 10000, 50000], help='Number of synthetic documents')
+    parser.add_argument('--min_docs', type=int, nargs='+', default=[50, 200], help='Minimum number of docs')
+    args = parser.parse_args()
+
+    main(args.corpus_sizes, args.min_docs)
@@ -0,0 +1,67 @@
+"""
+Benchmarks the sampling of the tries of measure_chances_generating_target (see csc_lib.evaluation):
+one try at a time (Generator.complete_prompt, as before batching) and all the tries of one or several prompts at once (Generator.complete_prompts).
+
+By default, a small random BLOOM model is built (see benchmarks.small_models), so that the benchmark runs offline on CPU.
+
+Usage (from the root of the repository):
+    python -m benchmarks.consequents_generation
+"""
+
+import time
+import torch
+import argparse
+import tempfile
+from transformers import AutoTokenizer, AutoModelForCausalLM
+from csc_lib.config import GEN_ARGS
+from csc_lib.generation import Generator
+from benchmarks.synthetic_corpus import generate_annotations_dict
+from benchmarks.small_models import build_small_causal_lm
+
+
+def main(model_path, nb_prompts, nb_tries, max_new_tokens, prompts_per_call_values):
+
+    if model_path is None:
+        model_path = build_small_causal_lm(tempfile.mkdtemp(prefix='csc_model_'))
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    model = AutoModelForCausalLM.from_pretrained(model_path)
+    generator = Generator(tokenizer, model, device='cpu')
+
+    # Prompts made of 2 synthetic antecedents, as in consequents_generation.py
+    prompt_template = "<|startoftext|> lexique: {antecedents},"
+    prompts = [prompt_template.format(antecedents=', '.join(anns[:2])) for anns in generate_annotations_dict(nb_prompts, vocabulary_size=5000, seed=2).values()]
+
+    # Sequences must not stop early, so that every configuration generates the same number of tokens
+    gen_args = dict(GEN_ARGS, min_new_tokens=max_new_tokens)
+    torch.manual_seed(0)
+
+    start = time.perf_counter()
+    for prompt in prompts:
+        for _ in range(nb_tries):
+            generator.complete_prompt(prompt, dict(gen_args), max_new_tokens)
+    durations = {'one try at a time': time.perf_counter() - start}
+
+    for prompts_per_call in prompts_per_call_values:
+        start = time.perf_counter()
+        for i in range(0, len(prompts), prompts_per_call):
+            generator.complete_prompts(prompts[i:i + prompts_per_call], gen_args, max_new_tokens, num_return_sequences=nb_tries)
+        durations[f'{prompts_per_call} prompt(s) x {nb_tries} tries per call'] = time.perf_counter() - start
+
+    nb_sequences = nb_prompts * nb_tries
+    print(f"\n{nb_prompts} prompts x {nb_tries} tries, {max_new_tokens} new tokens each, on {model.device} ({sum(p.numel() for p in model.parameters()) / 1e6:.1f}M parameters)")
+    print(f"{'':>32} {'tries/s':>9} {'tokens/s':>9}")
+    for name, duration in durations.items():
+        print(f"{name:>32} {nb_sequences / duration:>9.2f} {nb_sequences * max_new_tokens / duration:>9.1f}")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmark the sampling of the tries of each prompt')
+    parser.add_argument('-m', '--model', type=str, default=None, help='Model path (a small random model is built by default)')
+    parser.add_argument('-p', '--nb_prompts', type=int, default=4, help='Number of prompts')
+    parser.add_argument('-n', '--number_tries', type=int, default=30, help='Number of generations for each prompt')
+    parser.add_argument('-t', '--max_tokens', type=int, default=64, help='Number of new tokens')
+    parser.add_argument('--prompts_per_call', type=int, nargs='+', default=[1, 2, 4], help='Numbers of prompts sampled with each call to generate')
+    args = parser.parse_args()
+
+    main(args.model, args.nb_prompts, args.number_tries, args.max_tokens, args.prompts_per_call)
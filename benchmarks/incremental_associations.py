@@ -0,0 +1,92 @@
+"""
+Checks the incremental maintenance of frequent itemsets (see csc_lib.incremental_associations) against mining the whole corpus,
+on a synthetic corpus updated several times (files added, modified and removed), and reports their speed
+(frequent itemsets only, and along with the association rules derived from them, the same in both cases).
+After each update, the frequent itemsets and the negative border must be the same as those mined from all the files,
+with the same counts. Exits with an AssertionError otherwise.
+
+Usage (from the root of the repository):
+    python -m benchmarks.incremental_associations
+"""
+
+import os
+import time
+import pickle
+import argparse
+import tempfile
+import numpy as np
+from mlxtend.frequent_patterns import association_rules
+from csc_lib.corpus_index import CorpusIndex
+from csc_lib.association_rules import get_min_counts
+from csc_lib.incremental_associations import ItemsetBorder, get_associations_incremental
+from benchmarks.synthetic_corpus import generate_annotations_dict
+
+
+def main(nb_docs, nb_updates, files_per_update, min_docs, min_confidence, seed):
+
+    rng = np.random.default_rng(seed)
+    # Documents used for the initial corpus, then for the added and modified files
+    pool = list(generate_annotations_dict(nb_docs + 2 * nb_updates * files_per_update, vocabulary_size=nb_docs // 4, seed=seed).values())
+    dico_anns = {f'doc_{i:06d}.ann': pool.pop() for i in range(nb_docs)}
+    files_stats = {filename: [0, len(anns)] for filename, anns in dico_anns.items()}
+    next_doc = nb_docs
+
+    state_path = os.path.join(tempfile.mkdtemp(prefix='csc_incremental_'), f'frequent_itemsets_{min_docs}_docs.pkl')
+    durations = {'incremental': [0, 0], 'all files': [0, 0]}
+    for update in range(nb_updates + 1):
+        if update > 0:
+            # Remove, modify and add files_per_update files each
+            filenames = list(dico_anns)
+            removed, modified = np.split(rng.choice(len(filenames), size=2 * files_per_update, replace=False), 2)
+            for i in removed:
+                del dico_anns[filenames[i]], files_stats[filenames[i]]
+            for filename in [filenames[i] for i in modified]:
+                dico_anns[filename] = pool.pop()
+                files_stats[filename] = [update, len(dico_anns[filename])]
+            for _ in range(files_per_update):
+                filename = f'doc_{next_doc:06d}.ann'
+                dico_anns[filename], files_stats[filename] = pool.pop(), [update, 0]
+                next_doc += 1
+        corpus_index = CorpusIndex.from_annotations_dict(dico_anns, files_stats, filter_hash='benchmark')
+
+        start = time.perf_counter()
+        get_associations_incremental(corpus_index, state_path, min_docs, min_confidence)
+        incremental_duration = time.perf_counter() - start
+        with open(state_path, 'rb') as f:
+            border = pickle.load(f)['border']
+
+        # Same steps as a run without --incremental mining with Eclat
+        start = time.perf_counter()
+        reference = ItemsetBorder.mine([frozenset(anns) for anns in dico_anns.values()], get_min_counts(min_docs / len(dico_anns), len(dico_anns)))
+        mining_duration = time.perf_counter() - start
+        association_rules(reference.frequent_itemsets(), min_threshold=min_confidence)
+        rules_duration = time.perf_counter() - start - mining_duration
+        if update > 0:
+            durations['incremental'][0] += incremental_duration - rules_duration
+            durations['incremental'][1] += incremental_duration
+            durations['all files'][0] += mining_duration
+            durations['all files'][1] += mining_duration + rules_duration
+
+        assert border.frequent == reference.frequent, f"Frequent itemsets differ from those of all the files after update {update}"
+        assert border.negative_border == reference.negative_border, f"Negative border differs from the one of all the files after update {update}"
+        assert border.nb_files == reference.nb_files
+
+    print(f"{nb_docs} files, {nb_updates} updates of {files_per_update} added, modified and removed files each, min_docs={min_docs}: "
+          f"same frequent itemsets ({len(reference.frequent)}) and negative border ({len(reference.negative_border)}) as all the files")
+    print(f"{'':>12} {'frequent itemsets (s)':>22} {'with association rules (s)':>27}")
+    for name, (itemsets_duration, total_duration) in durations.items():
+        print(f"{name:>12} {itemsets_duration:>22.2f} {total_duration:>27.2f}")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Check the incremental maintenance of frequent itemsets against mining all the files, and benchmark it')
+    parser.add_argument('--nb_docs', type=int, default=20000, help='Number of synthetic documents')
+    parser.add_argument('--nb_updates', type=int, default=10, help='Number of updates of the corpus')
+    parser.add_argument('--files_per_update', type=int, default=20, help='Number of files added, modified and removed by each update')
+    parser.add_argument('--min_docs', type=int, default=200, help='Minimum number of docs')
+    parser.add_argument('--min_confidence', type=float, default=0.7)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    main(args.nb_docs, args.nb_updates, args.files_per_update, args.min_docs, args.min_confidence, args.seed)
@@ -0,0 +1,77 @@
+"""
+Benchmarks the scoring of associations by a base model and a fine-tuned model (see csc_lib.classification.calculate_all_ppls):
+one association at a time (as before batching, with and without autograd), by batches of several sizes,
+and by batches shared across several worker processes (the CPU cores being split between them).
+
+By default, a small random BLOOM model and a LoRA adapter are built (see benchmarks.small_models), so that the benchmark runs offline on CPU.
+
+Usage (from the root of the repository):
+    python -m benchmarks.perplexity_scoring
+"""
+
+import time
+import torch
+import argparse
+import tempfile
+import numpy as np
+from csc_lib.data_loader import load_models
+from csc_lib.classification import get_ppl, get_batch_ppls
+from benchmarks.synthetic_corpus import generate_annotations_dict
+from benchmarks.small_models import build_small_model_pair
+
+
+def get_ppl_with_grad(inputs, selected_model, tokenizer):
+    """Scoring of a single association before batching, building the autograd graph"""
+    inputs = tokenizer(inputs, return_tensors='pt').to(selected_model.device)
+    loss = selected_model(input_ids=inputs['input_ids'], labels=inputs['input_ids']).loss
+    return torch.exp(loss).item()
+
+
+def main(base_model_path, ft_model_path, nb_associations, batch_sizes, workers_values):
+
+    if base_model_path is None:
+        base_model_path, ft_model_path = build_small_model_pair(tempfile.mkdtemp(prefix='csc_models_'))
+    tokenizer, base_model, ft_model = load_models(ft_model_path, base_model_path)
+    models = [base_model, ft_model]
+
+    # Associations of 3 synthetic annotations
+    associations = [', '.join(anns[:3]) for anns in generate_annotations_dict(nb_associations, vocabulary_size=5000, seed=1).values()]
+
+    start = time.perf_counter()
+    reference = np.array([[get_ppl_with_grad(association, model, tokenizer) for association in associations] for model in models])
+    durations = {'one at a time, autograd': time.perf_counter() - start}
+
+    start = time.perf_counter()
+    ppls = np.array([[get_ppl(association, model, tokenizer) for association in associations] for model in models])
+    durations['one at a time, inference mode'] = time.perf_counter() - start
+    max_differences = {'one at a time, inference mode': np.abs(ppls / reference - 1).max()}
+
+    for batch_size in batch_sizes:
+        start = time.perf_counter()
+        ppls = get_batch_ppls(associations, models, tokenizer, batch_size)
+        durations[f'batches of {batch_size}'] = time.perf_counter() - start
+        max_differences[f'batches of {batch_size}'] = np.abs(ppls / reference - 1).max()
+
+    for workers in workers_values:
+        start = time.perf_counter()
+        ppls = get_batch_ppls(associations, models, tokenizer, batch_sizes[0], workers=workers)
+        durations[f'batches of {batch_sizes[0]}, {workers} workers'] = time.perf_counter() - start
+        max_differences[f'batches of {batch_sizes[0]}, {workers} workers'] = np.abs(ppls / reference - 1).max()
+
+    print(f"\n{nb_associations} associations, scored by 2 models on {base_model.device} ({sum(p.numel() for p in base_model.parameters()) / 1e6:.1f}M parameters)")
+    print(f"{'':>32} {'associations/s':>15} {'max relative difference':>24}")
+    for name, duration in durations.items():
+        print(f"{name:>32} {nb_associations / duration:>15.1f} {max_differences.get(name, 0):>24.1e}")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmark the scoring of associations by 2 models')
+    parser.add_argument('-b', '--base_model', type=str, default=None, help='Base model path (a small random model is built by default)')
+    parser.add_argument('-ft', '--ft_model_path', type=str, default=None, help='Path to the fine-tuned model')
+    parser.add_argument('-n', '--nb_associations', type=int, default=512, help='Number of associations to score')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[8, 16, 32, 64], help='Batch sizes to benchmark')
+    parser.add_argument('--workers', type=int, nargs='*', default=[2, 4], help='Numbers of worker processes to benchmark (with the first batch size)')
+    args = parser.parse_args()
+
+    main(args.base_model, args.ft_model_path, args.nb_associations, args.batch_sizes, args.workers)
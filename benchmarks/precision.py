@@ -0,0 +1,95 @@
+"""
+Benchmarks the precisions of the weights of the models (see csc_lib.data_loader.load_models) against fp32:
+memory used by the models, perplexities of associations (see csc_lib.classification.get_batch_ppls)
+and consequents found when sampling from the fine-tuned model (see csc_lib.evaluation.sample_found_targets), with their speed.
+Each precision runs in its own process, so that the memory of the models is measured on its own.
+
+By default, a small random BLOOM model and a LoRA adapter are built (see benchmarks.small_models), so that the benchmark runs offline on CPU.
+A random model rarely generates the consequents: pass a fine-tuned model (-b, -ft) to compare the consequents found.
+
+Usage (from the root of the repository):
+    python -m benchmarks.precision
+"""
+
+import time
+import torch
+import argparse
+import tempfile
+import numpy as np
+import multiprocessing
+from csc_lib.data_loader import load_models, PRECISIONS
+from csc_lib.classification import get_batch_ppls
+from csc_lib.generation import Generator
+from csc_lib.evaluation import sample_found_targets
+from csc_lib.target_matcher import TargetMatcher
+from benchmarks.synthetic_corpus import generate_annotations_dict
+from benchmarks.small_models import build_small_model_pair
+
+
+def get_rss_mb():
+    """Returns the resident memory of the current process, in MB"""
+    with open('/proc/self/status') as f:
+        return next(int(line.split()[1]) for line in f if line.startswith('VmRSS')) / 1024
+
+
+def measure(precision, base_model_path, ft_model_path, associations, rules, nb_tries, max_new_tokens):
+    """Loads the models with the given precision and returns their memory, the perplexities of the associations and the consequents found for each rule"""
+
+    rss = get_rss_mb()
+    tokenizer, base_model, ft_model = load_models(ft_model_path, base_model_path, precision=precision)
+    results = {'rss': get_rss_mb() - rss}
+
+    start = time.perf_counter()
+    results['ppls'] = get_batch_ppls(associations, [base_model, ft_model], tokenizer)
+    results['ppl_time'] = time.perf_counter() - start
+
+    # Prompts built as in consequents_generation.py, same seed for every precision
+    prompt_template = "<|startoftext|> lexique: {antecedents},"
+    prompts = [prompt_template.format(antecedents=', '.join(antecedents)) for antecedents, _ in rules]
+    matchers = [TargetMatcher(consequents) for _, consequents in rules]
+    torch.manual_seed(0)
+    start = time.perf_counter()
+    found_targets = sample_found_targets(Generator(tokenizer, ft_model, device='cpu'), prompts, matchers, nb_tries, max_new_tokens, early_stop_interval=None, prefix=prompt_template.split('{')[0])
+    results['generation_time'] = time.perf_counter() - start
+    results['hits'] = np.array([[len(found) for found in found_each_try] for found_each_try in found_targets])
+    return results
+
+
+def main(base_model_path, ft_model_path, nb_associations, nb_rules, nb_tries, max_new_tokens, precisions):
+
+    if base_model_path is None:
+        base_model_path, ft_model_path = build_small_model_pair(tempfile.mkdtemp(prefix='csc_models_'))
+
+    # Associations of 3 synthetic annotations, and rules of 2 antecedents and 2 consequents
+    annotations = list(generate_annotations_dict(max(nb_associations, nb_rules), vocabulary_size=5000, seed=1).values())
+    associations = [', '.join(anns[:3]) for anns in annotations[:nb_associations]]
+    rules = [(anns[:2], anns[2:4]) for anns in annotations[:nb_rules]]
+
+    results = {}
+    for precision in precisions:
+        with multiprocessing.get_context('spawn').Pool(1) as pool:
+            results[precision] = pool.apply(measure, (precision, base_model_path, ft_model_path, associations, rules, nb_tries, max_new_tokens))
+
+    reference = results[precisions[0]]
+    print(f"\n{nb_associations} associations scored by the base and fine-tuned models, {nb_rules} rules x {nb_tries} tries of {max_new_tokens} new tokens, "
+          f"differences against {precisions[0]}")
+    print(f"{'precision':>13} {'models (MB)':>12} {'associations/s':>15} {'tries/s':>8} {'ppl diff. (median / max)':>25} {'consequents per try':>20} {'diff.':>7} {'same tries':>11}")
+    for precision, result in results.items():
+        differences = np.abs(result['ppls'] / reference['ppls'] - 1)
+        print(f"{precision:>13} {result['rss']:>12.0f} {nb_associations / result['ppl_time']:>15.1f} {nb_rules * nb_tries / result['generation_time']:>8.2f} "
+              f"{f'{np.median(differences):.1e} / {differences.max():.1e}':>25} {result['hits'].mean():>20.3f} {result['hits'].mean() - reference['hits'].mean():>+7.3f} {(result['hits'] == reference['hits']).mean():>11.1%}")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmark the precisions of the weights of the models against fp32')
+    parser.add_argument('-b', '--base_model', type=str, default=None, help='Base model path (a small random model is built by default)')
+    parser.add_argument('-ft', '--ft_model_path', type=str, default=None, help='Path to the fine-tuned model')
+    parser.add_argument('-n', '--nb_associations', type=int, default=256, help='Number of associations to score')
+    parser.add_argument('-r', '--nb_rules', type=int, default=16, help='Number of rules to sample consequents for')
+    parser.add_argument('--number_tries', type=int, default=30, help='Number of generations for each rule')
+    parser.add_argument('-t', '--max_tokens', type=int, default=64, help='Number of new tokens')
+    parser.add_argument('--precisions', type=str, nargs='+', default=PRECISIONS, choices=PRECISIONS, help='Precisions to benchmark (the first one is the reference)')
+    args = parser.parse_args()
+
+    main(args.base_model, args.ft_model_path, args.nb_associations, args.nb_rules, args.number_tries, args.max_tokens, args.precisions)
@@ -0,0 +1,105 @@
+"""
+Benchmarks the prefill of the prompts by Generator.complete_prompts (see csc_lib.generation), with a single new token per try:
+prompts run through the model once per try (as before), once per prompt, and once per prompt on top of the cached template prefix.
+Checks first that the logits of greedy completions of prompts of different lengths (padded batch) are the same in the three cases.
+
+By default, a small random model is built (see benchmarks.small_models), so that the benchmark runs offline on CPU:
+a BLOOM model (ALiBi, positions given by the attention mask), or a GPT-2 or Llama one (position embeddings) with --architecture.
+
+Usage (from the root of the repository):
+    python -m benchmarks.prefill
+    python -m benchmarks.prefill --architecture gpt2
+"""
+
+import time
+import torch
+import argparse
+import tempfile
+from transformers import AutoTokenizer, AutoModelForCausalLM, LogitsProcessorList
+from csc_lib.config import GEN_ARGS
+from csc_lib.generation import Generator
+from benchmarks.synthetic_corpus import generate_annotations_dict
+from benchmarks.small_models import ARCHITECTURES, build_small_causal_lm
+
+
+class ScoresRecorder:
+    """Logits processor keeping the scores of each step of generate (unchanged)"""
+
+    def __init__(self):
+        self.scores = []
+
+    def __call__(self, input_ids, scores):
+        self.scores.append(scores.clone())
+        return scores
+
+
+def check_same_logits(tokenizer, model, prompts, prefix, max_new_tokens=4):
+    """Asserts that the logits of greedy completions are the same whether prompts are run once per try, once per prompt, or on top of the cached prefix"""
+    scores = {}
+    for reuse_prefill, prompt_prefix in [(False, None), (True, None), (True, prefix)]:
+        recorder = ScoresRecorder()
+        Generator(tokenizer, model, device='cpu', reuse_prefill=reuse_prefill).complete_prompts(
+            prompts, {'do_sample': False, 'logits_processor': LogitsProcessorList([recorder])}, max_new_tokens, prefix=prompt_prefix)
+        scores[reuse_prefill, prompt_prefix] = torch.stack(recorder.scores)
+    reference = scores[False, None]
+    for (reuse_prefill, prompt_prefix), step_scores in scores.items():
+        difference = (step_scores - reference).abs().max().item()
+        assert torch.allclose(step_scores, reference, atol=1e-4), \
+            f"Logits differ with reuse_prefill={reuse_prefill}, prefix={prompt_prefix!r} (max difference {difference:.2e})"
+
+
+def main(model_path, nb_prompts, nb_tries, nb_antecedents, prompts_per_call, repeats, architecture='bloom'):
+
+    if model_path is None:
+        model_path = build_small_causal_lm(tempfile.mkdtemp(prefix='csc_model_'), architecture=architecture)
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    model = AutoModelForCausalLM.from_pretrained(model_path)
+
+    # Prompts built as in consequents_generation.py
+    prompt_template = "<|startoftext|> lexique: {antecedents},"
+    prefix = prompt_template.split('{')[0]
+    prompts = [prompt_template.format(antecedents=', '.join(anns[:nb_antecedents])) for anns in generate_annotations_dict(nb_prompts, vocabulary_size=5000, seed=2).values()]
+    nb_tokens = sum(len(ids) for ids in tokenizer(prompts).input_ids) / nb_prompts
+
+    # Prompts with 1 to 4 antecedents, so that most of them are padded
+    check_prompts = [prompt_template.format(antecedents=', '.join(anns[:1 + i % 4])) for i, anns in enumerate(generate_annotations_dict(8, vocabulary_size=5000, seed=3).values())]
+    check_same_logits(tokenizer, model, check_prompts, prefix)
+    print(f"Same logits with and without reuse of the prefill, on a padded batch of {len(check_prompts)} prompts ({model.config.model_type} model)")
+
+    configurations = {
+        'once per try': (False, None),
+        'once per prompt': (True, None),
+        'once per prompt, cached prefix': (True, prefix)
+    }
+    durations, completions = {}, {}
+    for name, (reuse_prefill, prompt_prefix) in configurations.items():
+        generator = Generator(tokenizer, model, device='cpu', reuse_prefill=reuse_prefill)
+        durations[name] = float('inf')
+        for _ in range(repeats):
+            torch.manual_seed(0)
+            start = time.perf_counter()
+            completions[name] = [completion for i in range(0, len(prompts), prompts_per_call)
+                                 for completion in generator.complete_prompts(prompts[i:i + prompts_per_call], GEN_ARGS, 1, num_return_sequences=nb_tries, prefix=prompt_prefix)]
+            durations[name] = min(durations[name], time.perf_counter() - start)
+
+    print(f"\n{nb_prompts} prompts ({nb_tokens:.1f} tokens on average, prefix of {len(tokenizer(prefix).input_ids)} tokens) x {nb_tries} tries, "
+          f"{prompts_per_call} prompt(s) per call, on {model.device} ({sum(p.numel() for p in model.parameters()) / 1e6:.1f}M parameters)")
+    print(f"{'prompts run through the model':>32} {'time (s)':>9} {'speedup':>8} {'same first tokens':>18}")
+    reference = next(iter(durations))
+    for name, duration in durations.items():
+        print(f"{name:>32} {duration:>9.3f} {durations[reference] / duration:>7.1f}x {str(completions[name] == completions[reference]):>18}")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmark the prefill of the prompts of several tries')
+    parser.add_argument('-m', '--model', type=str, default=None, help='Model path (a small random model is built by default)')
+    parser.add_argument('-p', '--nb_prompts', type=int, default=16, help='Number of prompts')
+    parser.add_argument('-n', '--number_tries', type=int, default=30, help='Number of generations for each prompt')
+    parser.add_argument('-a', '--nb_antecedents', type=int, default=2, help='Number of antecedents in each prompt')
+    parser.add_argument('--prompts_per_call', type=int, default=2, help='Number of prompts sampled with each call to generate')
+    parser.add_argument('--repeats', type=int, default=3, help='Number of runs of each configuration (the fastest one is kept)')
+    parser.add_argument('--architecture', type=str, default='bloom', choices=ARCHITECTURES, help='Architecture of the small random model built when no model is given')
+    args = parser.parse_args()
+
+    main(args.model, args.nb_prompts, args.number_tries, args.nb_antecedents, args.prompts_per_call, args.repeats, args.architecture)
@@ -0,0 +1,111 @@
+"""
+Checks the enumerations of rare combinations (see csc_lib.tree_builder) against the baseline search on random synthetic corpora,
+and reports their speed:
+- baseline: tree of every permutation of the annotations, documents as Python sets (the search before the document-set engine, copied below)
+- permutations / canonical: tree built with csc_lib.tree_builder.build_tree, then get_rare_combinations
+- streamed: iter_rare_combinations, in a single process and with several workers
+Every enumeration must return the same rare combinations, with the same documents, each combination once;
+the streamed ones must also return them in the same order as the canonical tree. Exits with an AssertionError otherwise.
+
+Usage (from the root of the repository):
+    python -m benchmarks.rare_combinations
+"""
+
+import time
+import argparse
+import numpy as np
+from itertools import combinations
+from csc_lib.annotation_processor import reverse_annotations_dict
+from csc_lib.tree_builder import build_tree, get_rare_combinations, iter_rare_combinations
+from benchmarks.synthetic_corpus import generate_annotations_dict
+
+
+def baseline_rare_combinations(annotations, max_depth, threshold_nb_docs, dico_anns_filtered):
+    """Rare combinations found by the baseline search: tree of every permutation (nodes as dictionaries), then flagged as by get_rare_combinations"""
+
+    def build(annotations, docs, depth):
+        children = []
+        if depth < max_depth:
+            for annotation in annotations:
+                child_docs = docs & set(dico_anns_filtered[annotation])
+                if len(child_docs) > 0:
+                    child = {'annotation': annotation, 'docs': child_docs, 'children': []}
+                    if len(child_docs) >= threshold_nb_docs:
+                        child['children'] = build([a for a in annotations if a != annotation], child_docs, depth + 1)
+                    children.append(child)
+        return children
+
+    root = {'annotation': annotations[0], 'docs': set(dico_anns_filtered[annotations[0]])}
+    root['children'] = build(annotations[1:], root['docs'], 0)
+
+    results, flagged = [], set()
+    def retrieve(node, combination):
+        combination = combination | {node['annotation']}
+        if len(node['docs']) <= threshold_nb_docs and not any(tuple(sorted(subset)) in flagged for i in range(1, len(combination)) for subset in combinations(combination, i)):
+            if tuple(sorted(combination)) not in flagged:
+                flagged.add(tuple(sorted(combination)))
+                results.append({'combination': sorted(combination - {annotations[0]}), 'docs': node['docs']})
+        for child in node['children']:
+            retrieve(child, combination)
+    retrieve(root, set())
+    return results
+
+
+def as_set(rare_combinations):
+    """Returns the rare combinations as a set of (combination, documents), checking that each combination is found once"""
+    found = {(frozenset(rare_combination['combination']), frozenset(rare_combination['docs'])) for rare_combination in rare_combinations}
+    assert len(found) == len(rare_combinations), "A combination is found several times"
+    return found
+
+
+def main(nb_corpora, workers, seed):
+
+    rng = np.random.default_rng(seed)
+    durations = {}
+    nb_combinations = 0
+    for corpus_idx in range(nb_corpora):
+        nb_docs, vocabulary_size = int(rng.integers(20, 80)), int(rng.integers(20, 60))
+        max_depth, threshold_nb_docs = int(rng.integers(1, 4)), int(rng.integers(1, 6))
+        dico_anns = generate_annotations_dict(nb_docs, vocabulary_size, min_anns=3, max_anns=10, seed=int(rng.integers(2**31)))
+        dico_anns_filtered = reverse_annotations_dict(dico_anns)
+        annotations = list(dico_anns_filtered.keys())
+
+        enumerations = {
+            'baseline': lambda: baseline_rare_combinations(annotations, max_depth, threshold_nb_docs, dico_anns_filtered),
+            'permutations': lambda: get_rare_combinations(build_tree(annotations, max_depth, threshold_nb_docs, dico_anns_filtered, canonical_order=False).to_dict(), threshold_nb_docs, max_depth),
+            'canonical': lambda: get_rare_combinations(build_tree(annotations, max_depth, threshold_nb_docs, dico_anns_filtered).to_dict(), threshold_nb_docs, max_depth),
+            'streamed': lambda: list(iter_rare_combinations(annotations, max_depth, threshold_nb_docs, dico_anns_filtered)),
+            f'streamed ({workers} workers)': lambda: list(iter_rare_combinations(annotations, max_depth, threshold_nb_docs, dico_anns_filtered, workers=workers, chunk_size=7))
+        }
+        results = {}
+        for name, enumerate_rare_combinations in enumerations.items():
+            start = time.perf_counter()
+            results[name] = enumerate_rare_combinations()
+            durations[name] = durations.get(name, 0) + time.perf_counter() - start
+
+        description = f"corpus {corpus_idx} ({nb_docs} docs, max_depth={max_depth}, threshold_nb_docs={threshold_nb_docs})"
+        reference = as_set(results['baseline'])
+        for name, rare_combinations in results.items():
+            assert as_set(rare_combinations) == reference, f"{name} differs from the baseline on {description}"
+        # Annotations of a combination of the tree are listed in the order of a set
+        canonical_order = [(frozenset(rare_combination['combination']), sorted(rare_combination['docs'])) for rare_combination in results['canonical']]
+        for name in ['streamed', f'streamed ({workers} workers)']:
+            assert [(frozenset(rare_combination['combination']), sorted(rare_combination['docs'])) for rare_combination in results[name]] == canonical_order, \
+                f"{name} is not in the order of the canonical tree on {description}"
+        nb_combinations += len(reference)
+
+    print(f"{nb_corpora} corpora, {nb_combinations} rare combinations: all the enumerations match the baseline")
+    print(f"{'enumeration':>22} {'time (s)':>9}")
+    for name, duration in durations.items():
+        print(f"{name:>22} {duration:>9.2f}")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Check the enumerations of rare combinations against the baseline search, and benchmark them')
+    parser.add_argument('-n', '--nb_corpora', type=int, default=40, help='Number of random corpora')
+    parser.add_argument('--workers', type=int, default=3, help='Number of processes of the sharded enumeration')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    main(args.nb_corpora, args.workers, args.seed)
@@ -0,0 +1,85 @@
+"""
+Checks that resuming an interrupted run of measure_chances_generating_target (see csc_lib.evaluation) gives the same results as an uninterrupted run,
+with overlapping blocks (step < block_size, each row being studied in several blocks):
+the run is interrupted after a few calls to generate, the last record of the JSON Lines file is dropped (as a crash in the middle of a call would),
+and the run is resumed. The tries of each (block, row) and the measures must be the same. Exits with an AssertionError otherwise.
+
+By default, a small random BLOOM model is built (see benchmarks.small_models), so that the check runs offline on CPU.
+
+Usage (from the root of the repository):
+    python -m benchmarks.resume
+"""
+
+import os
+import argparse
+import tempfile
+import pandas as pd
+from transformers import AutoTokenizer, AutoModelForCausalLM
+from csc_lib.generation import Generator
+from csc_lib.evaluation import measure_chances_generating_target, read_found_targets
+from benchmarks.synthetic_corpus import generate_annotations_dict
+from benchmarks.small_models import build_small_causal_lm
+
+
+class InterruptedGenerator(Generator):
+    """Generator interrupted (as with Ctrl+C) at its nb_calls-th call"""
+
+    def __init__(self, tokenizer, model, nb_calls, **kwargs):
+        super().__init__(tokenizer, model, **kwargs)
+        self.nb_calls = nb_calls
+
+    def complete_prompts(self, *args, **kwargs):
+        self.nb_calls -= 1
+        if self.nb_calls == 0:
+            raise KeyboardInterrupt
+        return super().complete_prompts(*args, **kwargs)
+
+
+def main(model_path, nb_rows, step, block_size, nb_tries, interrupt_after):
+
+    if model_path is None:
+        model_path = build_small_causal_lm(tempfile.mkdtemp(prefix='csc_model_'))
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    model = AutoModelForCausalLM.from_pretrained(model_path)
+
+    # Digits as consequents (targets are searched as substrings), so that the tries of a random model find some of them and differ
+    annotations = list(generate_annotations_dict(nb_rows, vocabulary_size=50, seed=4).values())
+    df = pd.DataFrame({'antecedents': [anns[:2] for anns in annotations], 'consequents': [sorted({ann[-1] for ann in anns[2:4]}) for anns in annotations]})
+    kwargs = dict(target_column='consequents', prompt_template="<|startoftext|> lexique: {antecedents},", nb_tries=nb_tries, max_new_tokens=16,
+                  step=step, block_size=block_size, batch_size=2 * nb_tries, workers=1)
+
+    output_dir = tempfile.mkdtemp(prefix='csc_resume_')
+    uninterrupted_path, resumed_path = os.path.join(output_dir, 'uninterrupted.jsonl'), os.path.join(output_dir, 'resumed.jsonl')
+    uninterrupted = measure_chances_generating_target(Generator(tokenizer, model, device='cpu'), df.copy(), output_path=uninterrupted_path, **kwargs)
+
+    try:
+        measure_chances_generating_target(InterruptedGenerator(tokenizer, model, interrupt_after, device='cpu'), df.copy(), output_path=resumed_path, **kwargs)
+        raise AssertionError("The run was not interrupted, use a smaller --interrupt_after")
+    except KeyboardInterrupt:
+        pass
+    with open(resumed_path) as f:
+        lines = f.readlines()
+    with open(resumed_path, 'w') as f:
+        f.writelines(lines[:-1])
+    resumed = measure_chances_generating_target(Generator(tokenizer, model, device='cpu'), df.copy(), output_path=resumed_path, resume=True, **kwargs)
+
+    tries = read_found_targets(uninterrupted_path, by_block=True)
+    assert read_found_targets(resumed_path, by_block=True) == tries, "The resumed run does not have the tries of the uninterrupted run"
+    assert resumed.astype(str).equals(uninterrupted.astype(str)), "The resumed run does not have the measures of the uninterrupted run"
+    nb_found = sum(len(found) for found_targets_each_try in tries.values() for found in found_targets_each_try)
+    print(f"{len(tries)} (block, row) pairs of {nb_rows} rows (step={step}, block_size={block_size}), interrupted after {len(lines) - 1} records: "
+          f"resumed run identical to the uninterrupted run ({nb_found} consequents found)")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Check that a resumed run gives the results of an uninterrupted run')
+    parser.add_argument('-m', '--model', type=str, default=None, help='Model path (a small random model is built by default)')
+    parser.add_argument('-r', '--nb_rows', type=int, default=12, help='Number of rows (rules)')
+    parser.add_argument('--step', type=int, default=2, help='Step between blocks')
+    parser.add_argument('--block_size', type=int, default=5, help='Number of rows of each block')
+    parser.add_argument('-n', '--number_tries', type=int, default=3, help='Number of generations for each row')
+    parser.add_argument('--interrupt_after', type=int, default=6, help='Call to generate interrupting the first run')
+    args = parser.parse_args()
+
+    main(args.model, args.nb_rows, args.step, args.block_size, args.number_tries, args.interrupt_after)
@@ -0,0 +1,65 @@
+"""
+Contains functions used to build small causal language models for benchmarks, without downloading anything:
+a byte-level BPE tokenizer trained on synthetic annotations and a randomly initialized BLOOM model
+(same architecture as bigscience/bloom-1b1, much smaller), or a GPT-2 or Llama model (position embeddings instead of ALiBi).
+"""
+
+import os
+import torch
+from tokenizers import Tokenizer, models, pre_tokenizers, decoders, trainers
+from transformers import PreTrainedTokenizerFast, BloomConfig, BloomForCausalLM, GPT2Config, GPT2LMHeadModel, LlamaConfig, LlamaForCausalLM
+from peft import LoraConfig, get_peft_model
+from benchmarks.synthetic_corpus import generate_annotations_dict
+
+
+ARCHITECTURES = ['bloom', 'gpt2', 'llama']
+
+
+def build_small_causal_lm(model_dir, hidden_size=384, n_layer=6, n_head=6, vocab_size=4096, seed=0, architecture='bloom'):
+    """Saves a tokenizer and a randomly initialized model (see ARCHITECTURES) to model_dir, and returns model_dir"""
+
+    # Train the tokenizer on associations of synthetic annotations
+    texts = [', '.join(anns[:3]) for anns in generate_annotations_dict(5000, vocabulary_size=5000, seed=seed).values()]
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    tokenizer.train_from_iterator(texts, trainers.BpeTrainer(vocab_size=vocab_size, special_tokens=['<pad>', '<s>', '</s>', '<unk>'], initial_alphabet=pre_tokenizers.ByteLevel.alphabet()))
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=tokenizer, pad_token='<pad>', bos_token='<s>', eos_token='</s>', unk_token='<unk>', model_input_names=['input_ids', 'attention_mask'])
+    tokenizer.save_pretrained(model_dir)
+
+    torch.manual_seed(seed)
+    special_tokens = dict(pad_token_id=tokenizer.pad_token_id, bos_token_id=tokenizer.bos_token_id, eos_token_id=tokenizer.eos_token_id)
+    if architecture == 'bloom':
+        model = BloomForCausalLM(BloomConfig(vocab_size=len(tokenizer), hidden_size=hidden_size, n_layer=n_layer, n_head=n_head, **special_tokens))
+    elif architecture == 'gpt2':
+        model = GPT2LMHeadModel(GPT2Config(vocab_size=len(tokenizer), n_embd=hidden_size, n_layer=n_layer, n_head=n_head, **special_tokens))
+    elif architecture == 'llama':
+        model = LlamaForCausalLM(LlamaConfig(vocab_size=len(tokenizer), hidden_size=hidden_size, intermediate_size=4 * hidden_size, num_hidden_layers=n_layer,
+                                             num_attention_heads=n_head, **special_tokens))
+    else:
+        raise ValueError(f"Unknown architecture '{architecture}', expected one of {ARCHITECTURES}.")
+    model.save_pretrained(model_dir)
+    return model_dir
+
+
+def build_lora_adapter(base_model_dir, adapter_dir, r=8, seed=1):
+    """Saves a LoRA adapter of the model in base_model_dir (with random non-zero weights, as a fine-tuned one) to adapter_dir, and returns adapter_dir"""
+
+    torch.manual_seed(seed)
+    model = get_peft_model(BloomForCausalLM.from_pretrained(base_model_dir), LoraConfig(r=r, target_modules=['query_key_value'], task_type='CAUSAL_LM'))
+    with torch.no_grad():
+        for name, parameter in model.named_parameters():
+            if 'lora_B' in name:
+                parameter.normal_(std=0.02)
+    model.save_pretrained(adapter_dir)
+    return adapter_dir
+
+
+def build_small_model_pair(root_dir, **kwargs):
+    """Saves a small base model and a LoRA adapter of it to root_dir (if not already there), and returns their paths"""
+    base_model_dir, adapter_dir = os.path.join(root_dir, 'base_model'), os.path.join(root_dir, 'ft_model')
+    if not os.path.isfile(os.path.join(base_model_dir, 'config.json')):
+        build_small_causal_lm(base_model_dir, **kwargs)
+    if not os.path.isfile(os.path.join(adapter_dir, 'adapter_config.json')):
+        build_lora_adapter(base_model_dir, adapter_dir)
+    return base_model_dir, adapter_dir
@@ -0,0 +1,48 @@
+"""
+Contains functions used to generate synthetic annotated corpora for benchmarks
+"""
+
+import os
+import numpy as np
+
+
+def generate_annotations_dict(nb_docs, vocabulary_size, min_anns=10, max_anns=40, zipf_exponent=1.1, seed=0):
+    """
+    Returns a dictionary where each key is a filename and each value is the list of annotations found in that file.
+    Annotations are drawn from a Zipf-like distribution over a vocabulary of vocabulary_size terms.
+    """
+    rng = np.random.default_rng(seed)
+    probabilities = 1.0 / np.arange(1, vocabulary_size + 1) ** zipf_exponent
+    probabilities /= probabilities.sum()
+
+    dico_anns = {}
+    for i in range(nb_docs):
+        nb_anns = rng.integers(min_anns, max_anns)
+        dico_anns[f'doc_{i:06d}.ann'] = [f'terme_{j}' for j in rng.choice(vocabulary_size, size=nb_anns, p=probabilities)]
+    return dico_anns
+
+
+def write_brat_folder(dico_anns, folder_path, types=('PROC', 'DISO', 'CHEM', 'ANAT'), seed=0):
+    """
+    Writes the annotations of a dictionary (as returned by generate_annotations_dict) to .ann files using the BRAT format.
+    Some overlapping annotations, attributes and notes are added, as found in real annotated files.
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(folder_path, exist_ok=True)
+
+    for filename, annotations in dico_anns.items():
+        lines, position = [], 0
+        for annotation in annotations:
+            type_ann = types[rng.integers(len(types))]
+            start, end = position, position + len(annotation)
+            lines.append(f'T{len(lines) + 1}\t{type_ann} {start} {end}\t{annotation}')
+            if rng.random() < 0.15:
+                lines.append(f'T{len(lines) + 1}\t{type_ann} {start} {end - 2}\t{annotation[:-2]}')
+            if rng.random() < 0.05:
+                lines.append(f'A{len(lines) + 1}\tNegation T{len(lines)}')
+            if rng.random() < 0.05:
+                lines.append(f'#{len(lines) + 1}\tAnnotatorNotes T{len(lines)}\tnote')
+            position = end + int(rng.integers(1, 10))
+
+        with open(os.path.join(folder_path, filename), 'w') as f:
+            f.write('\n'.join(lines) + '\n')
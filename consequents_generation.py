@@ -1,41 +1,76 @@
 import os
-import pandas as pd
 import argparse
-from csc_lib.data_loader import load_models
-from csc_lib.data_processing import correct_literal_eval
+from csc_lib.data_loader import load_models, PRECISIONS
+from csc_lib.artifacts import load_association_rules
 from csc_lib.generation import Generator
-from csc_lib.evaluation import measure_chances_generating_target
+from csc_lib.model_server import connect_models, RemoteGenerator
+from csc_lib.evaluation import measure_chances_generating_target, measure_chances_adaptive
 from csc_lib.visualize import violin_plot
-from csc_lib.config import FT_MODEL_PATH, OUTPUT_PATH
+from csc_lib.config import FT_MODEL_PATH, OUTPUT_PATH, EARLY_STOP_INTERVAL, ADAPTIVE_PRECISION, MODEL_PRECISION, GENERATION_SEED, GENERATION_WORKERS, MODEL_SERVER_ADDRESS
 
-def main(association_rules_path, experiment_name, nb_tries, max_new_tokens, step, block_size, ft_model_path=FT_MODEL_PATH):
+def main(association_rules_path, experiment_name, nb_tries, max_new_tokens, step, block_size, ft_model_path=FT_MODEL_PATH, ignore_case=False, ignore_accents=False, early_stop_interval=EARLY_STOP_INTERVAL, budget=None, precision=ADAPTIVE_PRECISION, resume=False, model_precision=MODEL_PRECISION, seed=GENERATION_SEED, workers=GENERATION_WORKERS, server=None):
 
     # Check if association rules path exists
     if not os.path.isfile(association_rules_path):
-        raise FileNotFoundError(f"The specified path for CSV file containing association rules is not correct: {association_rules_path}")
+        raise FileNotFoundError(f"The specified path for the file containing association rules is not correct: {association_rules_path}")
     
     # Load association rules
-    df_rules = pd.read_csv(association_rules_path, index_col=0)
-    df_rules = correct_literal_eval(df_rules, ['antecedents', 'consequents'])
+    df_rules = load_association_rules(association_rules_path)
 
-    # Prepare fine-tuned model to complete new prompts
-    tokenizer, base_model, ft_model = load_models(ft_model_path)
-    generator = Generator(tokenizer, ft_model)
+    # Prepare fine-tuned model to complete new prompts (or use the one of a model server, already loaded)
+    if server is not None:
+        client, base_model, ft_model = connect_models(server)
+        generator = RemoteGenerator(client, 'ft')
+    else:
+        tokenizer, base_model, ft_model = load_models(ft_model_path, precision=model_precision)
+        generator = Generator(tokenizer, ft_model)
     # prompt_template = 'Profil:\nage{age} ; sexe : {sexe} ; lexique: {indication}\nCas clinique:\n'
     # prompt_template = "<|startoftext|> lexique: {', '.join(antecedents)},"
     prompt_template = "<|startoftext|> lexique: {antecedents},"
 
+    # Tries are streamed to a file as they are sampled, so that an interrupted run can be resumed
+    save_path = os.path.join(OUTPUT_PATH, experiment_name)
+    os.makedirs(save_path, exist_ok=True)
+    tries_path = os.path.join(save_path, 'tries.jsonl')
+
     # Measure chances that our fine-tuned model generates consequents when prompting antecedents
-    df_measures = measure_chances_generating_target(
-        generator=generator,
-        df=df_rules,
-        target_column='consequents',
-        prompt_template=prompt_template,
-        nb_tries=nb_tries,
-        max_new_tokens=max_new_tokens,
-        step=step,
-        block_size=block_size
-        )
+    if budget is None:
+        df_measures = measure_chances_generating_target(
+            generator=generator,
+            df=df_rules,
+            target_column='consequents',
+            prompt_template=prompt_template,
+            nb_tries=nb_tries,
+            max_new_tokens=max_new_tokens,
+            step=step,
+            block_size=block_size,
+            ignore_case=ignore_case,
+            ignore_accents=ignore_accents,
+            early_stop_interval=early_stop_interval,
+            output_path=tries_path,
+            resume=resume,
+            seed=seed,
+            workers=workers
+            )
+    # With a budget, all the rules are studied, with up to nb_tries tries each
+    else:
+        df_measures = measure_chances_adaptive(
+            generator=generator,
+            df=df_rules,
+            target_column='consequents',
+            prompt_template=prompt_template,
+            budget=budget,
+            max_new_tokens=max_new_tokens,
+            max_tries=nb_tries,
+            precision=precision,
+            ignore_case=ignore_case,
+            ignore_accents=ignore_accents,
+            early_stop_interval=early_stop_interval,
+            output_path=tries_path,
+            resume=resume,
+            seed=seed,
+            workers=workers
+            )
     
     # Plot the results
     violin_plot_figure = violin_plot(
@@ -45,8 +80,6 @@ def main(association_rules_path, experiment_name, nb_tries, max_new_tokens, step
     )
     
     # Save the results
-    save_path = os.path.join(OUTPUT_PATH, experiment_name)
-    os.makedirs(save_path, exist_ok=True)
     df_measures.to_csv(os.path.join(save_path,'measures.csv'))
     violin_plot_figure.savefig(os.path.join(save_path, 'violin_plot.png'))
 
@@ -54,15 +87,28 @@ def main(association_rules_path, experiment_name, nb_tries, max_new_tokens, step
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description='Measure to which extent a model can generate consequents when prompting antecedents')
-    parser.add_argument('-p', '--path_rules', type=str, required=True, help='Path to the association rules CSV file to study')
+    parser.add_argument('-p', '--path_rules', type=str, required=True, help='Path to the association rules file to study (.parquet or .csv)')
     parser.add_argument('-ft', '--ft_model_path', type=str, default=FT_MODEL_PATH, help='Path to the fine-tuned model')
     parser.add_argument('-n', '--number_tries', type=int, default=30, help='Number of generations for each studied case.')
     parser.add_argument('-t', '--max_tokens', type=int, default=300, help='Number of new tokens.')
     parser.add_argument('-s', '--step', type=int, default=1, help='Step size between blocks.')
     parser.add_argument('-b', '--block_size', type=int, default=1, help='Block size')
     parser.add_argument('-e', '--experiment_name', type=str, required=True)
+    parser.add_argument('--ignore_case', action='store_true', help='Find consequents in generated texts regardless of case')
+    parser.add_argument('--ignore_accents', action='store_true', help='Find consequents in generated texts regardless of accents')
+    parser.add_argument('--early_stop_interval', type=int, default=EARLY_STOP_INTERVAL, help='Number of new tokens between two checks of the consequents found, each try stops once all are found (0 to always generate max_tokens tokens)')
+    parser.add_argument('--budget', type=int, default=None, help='Total number of generations, spent adaptively across all the rules (up to --number_tries each) instead of --number_tries for each rule of the blocks')
+    parser.add_argument('--precision', type=float, default=ADAPTIVE_PRECISION, help='With --budget, a rule gets no more tries once the confidence interval of its success rate is within +/- precision')
+    parser.add_argument('--model_precision', type=str, default=MODEL_PRECISION, choices=PRECISIONS, help='Precision of the weights of the model (bf16 and int8-dynamic use less memory, int8-dynamic runs on CPU only)')
+    parser.add_argument('--seed', type=int, default=GENERATION_SEED, help='Seed from which the seed of each call to the model is derived (the tries are the same whatever the number of workers)')
+    parser.add_argument('--workers', type=int, default=GENERATION_WORKERS, help='Number of processes sharing the generations (model on CPU only), each with its share of the CPU cores')
+    parser.add_argument('--server', type=str, nargs='?', const=MODEL_SERVER_ADDRESS, default=None, help='Use the model of a model server (see serve_models.py) at this address (default: MODEL_SERVER_ADDRESS) instead of loading it')
+    parser.add_argument('--resume', action='store_true', help='Resume an interrupted run of the same experiment (with the same arguments), without sampling again the tries already saved')
     args = parser.parse_args()
 
     association_rules_path, experiment_name, nb_tries, max_new_tokens, step, block_size, ft_model_path, = args.path_rules, args.experiment_name, args.number_tries, args.max_tokens, args.step, args.block_size, args.ft_model_path
+    ignore_case, ignore_accents, early_stop_interval = args.ignore_case, args.ignore_accents, args.early_stop_interval
+    budget, precision, resume, model_precision, seed, workers = args.budget, args.precision, args.resume, args.model_precision, args.seed, args.workers
+    server = args.server
 
-    main(association_rules_path, experiment_name, nb_tries, max_new_tokens, step, block_size, ft_model_path)
\ No newline at end of file
+    main(association_rules_path, experiment_name, nb_tries, max_new_tokens, step, block_size, ft_model_path, ignore_case, ignore_accents, early_stop_interval, budget, precision, resume, model_precision, seed, workers, server)
\ No newline at end of file
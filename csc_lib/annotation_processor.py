@@ -1,48 +1,80 @@
 import os
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from tqdm import tqdm
 import pandas as pd
-from csc_lib.config import TYPES_TO_KEEP, FILTER_OUT
+from csc_lib.config import TYPES_TO_KEEP, FILTER_OUT, LOADER_WORKERS, LOADER_EXECUTOR
 
-def load_annotations_from_folder(folder_path):
+def get_annotations_from_file(file_path):
     """
-    Returns a dictionary where each key is a filename and each value is the list of annotations found in that file.
+    Returns the list of annotations found in a .ann file.
     Annotations are filtered depending on their type (PROC, DISO...) and their span.
-    At the scale of a document, when the spans of 2 annotations overlap, only the largest annotation is kept.
+    When the spans of 2 annotations overlap, only the largest annotation is kept.
     """
-    
-    # kept_annotations = []
-    filenames = [f for f in os.listdir(folder_path) if f.endswith('.ann')]
-    dico_anns = {filename: [] for filename in filenames}
 
-    for filename in tqdm(filenames, desc="Processing annotations..."):
+    # Store all annotations
+    annotations = []
+    with open(file_path, 'r') as f:
+        for line in f:
+            # Only entities (T lines) are annotations: relations, events, attributes, notes... are skipped
+            if not line.startswith('T'):
+                continue
+            line = line.strip().split('\t')
+            type_ann, span = line[1].split(' ', 1)
+            if type_ann in TYPES_TO_KEEP:
+                # Discontinuous spans (eg, "10 20;25 30") are considered from their first start to their last end
+                span = span.replace(';', ' ').split()
+                annotations.append((int(span[0]), int(span[-1]), line[-1]))
+
+    # Sort spans (stable sort, so that files whose spans are already sorted are processed in the same order)
+    annotations.sort(key=lambda annotation: annotation[0])
+
+    # Filter annotations depending on their type (PROC, DISO...) and their span
+    # In case of overlapping spans (ie, they relate to the same portion of text), we only keep the largest one
+    kept_annotations = []
+    if annotations:
+        current_start, current_end, current_annotation = annotations[0]
+        for start, end, annotation in annotations[1:]:
+            if start >= current_end:
+                if current_annotation not in FILTER_OUT:
+                    kept_annotations.append(current_annotation)
+                current_start, current_end, current_annotation = start, end, annotation
+            elif len(annotation) > len(current_annotation):
+                current_start, current_end, current_annotation = start, end, annotation
 
-        with open(os.path.join(folder_path, f"{filename}"), 'r') as f:
+        if current_annotation not in FILTER_OUT:
+            kept_annotations.append(current_annotation)
 
-            # Store all annotations
-            annotations = []
-            for line in f:
-                line = line.strip().split('\t')
-                type_ann, start_ann, end_ann = line[1].split()
-                annotation = line[-1]
-                if type_ann in TYPES_TO_KEEP:
-                    annotations.append((int(start_ann), int(end_ann), annotation))
-                
-            # Filter annotations depending on their type (PROC, DISO...) and their span
-            # In case of overlapping spans (ie, they relate to the same portion of text), we only keep the largest one
-            if annotations:
-                current_start, current_end, current_annotation = annotations[0]
-                for i, (start, end, annotation) in enumerate(annotations[1:]):
-                    if start >= current_end:
-                        if current_annotation not in FILTER_OUT:
-                            dico_anns[filename].append(current_annotation)
-                        current_start, current_end, current_annotation = start, end, annotation
-                    elif len(annotation) > len(current_annotation):
-                        current_start, current_end, current_annotation = start, end, annotation
+    return kept_annotations
 
-                if current_annotation not in FILTER_OUT:
-                    dico_anns[filename].append(current_annotation)
 
-    return dico_anns
+def get_annotations_from_files(file_paths, workers=LOADER_WORKERS, executor=LOADER_EXECUTOR):
+    """
+    Returns the list of annotations found in each .ann file (see get_annotations_from_file), in the same order as file_paths.
+    Files are read and parsed by a pool of workers: threads (best when reading files is the bottleneck, eg on a network filesystem)
+    or processes (best when parsing is the bottleneck).
+    """
+
+    if workers <= 1:
+        return list(tqdm(map(get_annotations_from_file, file_paths), desc="Processing annotations...", total=len(file_paths)))
+
+    pool_executor = {'thread': ThreadPoolExecutor, 'process': ProcessPoolExecutor}[executor]
+    with pool_executor(max_workers=workers) as pool:
+        # Files are sent to workers by chunks to limit the communication overhead, results are kept in order
+        annotations = pool.map(get_annotations_from_file, file_paths, chunksize=max(1, min(256, len(file_paths) // (4 * workers))))
+        return list(tqdm(annotations, desc="Processing annotations...", total=len(file_paths)))
+
+
+def load_annotations_from_folder(folder_path, workers=LOADER_WORKERS, executor=LOADER_EXECUTOR):
+    """
+    Returns a dictionary where each key is a filename and each value is the list of annotations found in that file.
+    Annotations are filtered depending on their type (PROC, DISO...) and their span.
+    At the scale of a document, when the spans of 2 annotations overlap, only the largest annotation is kept.
+    Files are read and parsed by a pool of workers (see get_annotations_from_files).
+    """
+    
+    filenames = [f for f in os.listdir(folder_path) if f.endswith('.ann')]
+    annotations = get_annotations_from_files([os.path.join(folder_path, filename) for filename in filenames], workers, executor)
+    return dict(zip(filenames, annotations))
 
 
 def flatten_annotations_dict(dict_anns):
@@ -0,0 +1,125 @@
+"""
+Contains functions used to save and load results (association rules, rare combinations) as Parquet files:
+itemsets are stored as native lists of strings (instead of their string representation in CSV files, parsed back with literal_eval),
+rows are grouped by length in row groups, so that loaders can read only some columns and skip the row groups of other lengths.
+CSV files are still supported, as an export format.
+"""
+
+import json
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from csc_lib.data_processing import correct_literal_eval
+from csc_lib.result_writers import SortedParquetWriter
+
+ARTIFACT_FORMATS = ['parquet', 'csv']
+
+# Maximum number of rows of a row group (row groups never mix itemsets of different lengths)
+ROW_GROUP_SIZE = 100_000
+
+RARE_COMBINATIONS_SCHEMA = pa.schema([
+    ('combination', pa.list_(pa.string())),
+    ('docs', pa.list_(pa.int32())),
+    ('# docs', pa.int64()),
+    ('# annotations', pa.int64())
+])
+
+
+def save_association_rules(df, path, row_group_size=ROW_GROUP_SIZE):
+    """
+    Saves association rules (as returned by mlxtend.frequent_patterns.association_rules) to a Parquet file,
+    with antecedents and consequents as sorted lists, the index of each rule ('rule') and the number of annotations of each rule ('length').
+    Rules are sorted by length, each row group holding rules of the same length.
+    """
+
+    lengths = df['antecedents'].map(len) + df['consequents'].map(len)
+    order = lengths.argsort(kind='stable')
+    df, lengths = df.iloc[order], lengths.iloc[order]
+
+    table = pa.Table.from_pandas(df.drop(columns=['antecedents', 'consequents']), preserve_index=False)
+    table = table.add_column(0, 'rule', pa.array(df.index))
+    table = table.add_column(1, 'antecedents', pa.array([sorted(itemset) for itemset in df['antecedents']], type=pa.list_(pa.string())))
+    table = table.add_column(2, 'consequents', pa.array([sorted(itemset) for itemset in df['consequents']], type=pa.list_(pa.string())))
+    table = table.add_column(3, 'length', pa.array(lengths, type=pa.int16()))
+
+    with pq.ParquetWriter(path, table.schema) as writer:
+        start = 0
+        for nb_rules in lengths.value_counts(sort=False).sort_index():
+            writer.write_table(table.slice(start, nb_rules), row_group_size=row_group_size)
+            start += nb_rules
+
+
+def load_association_rules(path, columns=None, lengths=None):
+    """
+    Loads association rules from a Parquet file written by save_association_rules (or from a CSV file), in their original order,
+    with antecedents and consequents as frozensets.
+    Only the given columns are read (all of them by default) and, if lengths is given, only the rules of these lengths (number of annotations),
+    skipping the row groups of other lengths.
+    """
+
+    if path.endswith('.csv'):
+        df = pd.read_csv(path, index_col=0)
+        df = correct_literal_eval(df, ['antecedents', 'consequents'])
+        if lengths is not None:
+            df = df[(df['antecedents'].map(len) + df['consequents'].map(len)).isin(lengths)]
+        return df if columns is None else df[columns]
+
+    filters = [('length', 'in', list(lengths))] if lengths is not None else None
+    table = pq.read_table(path, columns=None if columns is None else ['rule'] + [column for column in columns if column != 'rule'], filters=filters)
+
+    df = table.drop_columns([column for column in ['antecedents', 'consequents'] if column in table.column_names]).to_pandas()
+    for column in ['antecedents', 'consequents']:
+        if column in table.column_names:
+            df[column] = [frozenset(itemset) for itemset in table.column(column).to_pylist()]
+
+    df = df.set_index('rule').sort_index()
+    df.index.name = None
+    if columns is None:
+        columns = [column for column in table.column_names if column not in ['rule', 'length']]
+    return df[[column for column in columns if column != 'rule']]
+
+
+def rare_combinations_writer(path, filenames, max_buffer_bytes=512 * 2**20):
+    """
+    Returns a writer streaming rare combinations to a Parquet file, sorted by number of documents and annotations (as the CSV files),
+    with the documents of each combination as integer IDs (position in filenames, stored in the metadata of the file).
+    Rows are written with writer.write((# docs, # annotations), [combination, docs IDs, # docs, # annotations]).
+    """
+    return SortedParquetWriter(path, RARE_COMBINATIONS_SCHEMA, max_buffer_bytes=max_buffer_bytes, metadata={'filenames': json.dumps(list(filenames))})
+
+
+def load_rare_combinations(path, columns=None, nb_annotations=None, max_docs=None, decode_filenames=True):
+    """
+    Loads rare combinations from a Parquet file written by rare_combinations_writer (or from a CSV file).
+    Only the given columns are read (all of them by default) and, if given, only the combinations of nb_annotations annotations (int or list)
+    and in at most max_docs documents, skipping the other row groups.
+    With decode_filenames, documents are given by filename, else by ID.
+    """
+
+    nb_annotations = [nb_annotations] if isinstance(nb_annotations, int) else nb_annotations
+
+    if path.endswith('.csv'):
+        df = pd.read_csv(path, index_col=0)
+        df = correct_literal_eval(df, ['combination', 'docs'])
+        if nb_annotations is not None:
+            df = df[df['# annotations'].isin(nb_annotations)]
+        if max_docs is not None:
+            df = df[df['# docs'] <= max_docs]
+        return df if columns is None else df[columns]
+
+    filters = []
+    if nb_annotations is not None:
+        filters.append(('# annotations', 'in', list(nb_annotations)))
+    if max_docs is not None:
+        filters.append(('# docs', '<=', max_docs))
+    df = pq.read_table(path, columns=columns, filters=filters or None).to_pandas()
+
+    if 'combination' in df.columns:
+        df['combination'] = df['combination'].map(list)
+    if 'docs' in df.columns:
+        if decode_filenames:
+            filenames = json.loads(pq.read_schema(path).metadata[b'filenames'])
+            df['docs'] = [[filenames[doc] for doc in docs] for docs in df['docs']]
+        else:
+            df['docs'] = df['docs'].map(list)
+    return df
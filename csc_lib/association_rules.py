@@ -1,33 +1,161 @@
+import math
+import warnings
+import numpy as np
 import pandas as pd
+from scipy.sparse import csr_matrix
 from mlxtend.frequent_patterns import fpgrowth, association_rules
+from csc_lib.document_sets import DocumentSets
 
-def get_associations(set_all_anns:set, anns_dict:dict, min_docs:int, min_confidence:float):
+
+def get_frequent_itemsets_fpgrowth(set_all_anns:set, anns_dict:dict, min_support:float):
+    """
+    Returns the frequent itemsets (annotations) found with mlxtend's fpgrowth algorithm,
+    as a DataFrame with 'support' and 'itemsets' columns.
+    """
+
+    # Get a list of all filenames from the dictionary
+    filenames = list(anns_dict.keys())
+
+    # Encode the annotations as a sparse one-hot matrix in a single pass over the annotations,
+    # where each row represents a file and each column an annotation (True if the annotation is present in the file)
+    columns = list(set_all_anns)
+    column_ids = {ann: i for i, ann in enumerate(columns)}
+    indptr, indices = [0], []
+    for filename in filenames:
+        indices.extend(sorted({column_ids[ann] for ann in anns_dict[filename] if ann in column_ids}))
+        indptr.append(len(indices))
+    one_hot = csr_matrix((np.ones(len(indices), dtype=bool), indices, indptr), shape=(len(filenames), len(columns)))
+    with warnings.catch_warnings():
+        # pandas warns about its own fill_value (0 instead of False) for boolean sparse matrices
+        warnings.simplefilter('ignore', FutureWarning)
+        one_hot_df = pd.DataFrame.sparse.from_spmatrix(one_hot, columns=columns)
+
+    return fpgrowth(one_hot_df, min_support=min_support, use_colnames=True)
+
+
+def get_min_counts(min_support:float, nb_files:int):
+    """
+    Returns the minimum number of files of a frequent annotation and of a frequent itemset of several annotations, as in fpgrowth:
+    the support of each annotation is compared to min_support, while the number of files of larger itemsets is compared to
+    ceil(min_support * nb_files), which can be one more because of rounding errors.
+    """
+    min_count = math.ceil(min_support * nb_files)
+    min_count_items = min_count
+    while min_count_items > 0 and (min_count_items - 1) / nb_files >= min_support:
+        min_count_items -= 1
+    while min_count_items / nb_files < min_support:
+        min_count_items += 1
+    return min_count_items, min_count
+
+
+def get_itemset_counts_eclat(files_by_ann:dict, min_counts:tuple, negative_border:bool=False):
+    """
+    Returns a dictionary where each key is a frequent itemset (frozenset of annotations) and each value is its number of files,
+    found with the Eclat algorithm. min_counts holds the minimum number of files of a frequent annotation and of a frequent itemset
+    of several annotations (see get_min_counts).
+    With negative_border, also returns the negative border: the infrequent itemsets whose subsets are all frequent
+    (only the ones present in at least one file).
+
+    Eclat mines the data vertically: each annotation is represented by the set of files containing it (stored as a bitset),
+    and the support of an itemset is the size of the intersection of the sets of its annotations.
+    Each frequent itemset is only extended with the annotations that come after it and are frequent with its prefix.
+
+    Input: A dictionary where each key is an annotation and each value is the list of (distinct) files where that annotation was found.
+    """
+
+    min_count_items, min_count = min_counts
+    doc_sets = DocumentSets(files_by_ann)
+
+    # Keep frequent annotations, from the least to the most frequent one to keep intersections small
+    counts = np.array([len(files) for files in files_by_ann.values()], dtype=np.int64)
+    frequent_rows = np.flatnonzero(counts >= min_count_items)
+    frequent_rows = frequent_rows[np.argsort(counts[frequent_rows], kind='stable')]
+
+    # Infrequent extensions of frequent itemsets are candidates to the negative border
+    frequent, candidates = {}, {}
+
+    def eclat(itemset, docs, candidate_rows):
+        extensions = []
+        for i, child_docs, count in doc_sets.intersect(docs, candidate_rows, min_count=1 if negative_border else min_count, compact=False):
+            if count >= min_count:
+                extensions.append((i, child_docs, count))
+            else:
+                candidates[itemset | {doc_sets.annotations[candidate_rows[i]]}] = count
+        extension_rows = candidate_rows[[i for i, _, _ in extensions]]
+        for k, (row, (_, child_docs, count)) in enumerate(zip(extension_rows, extensions)):
+            child_itemset = itemset | {doc_sets.annotations[row]}
+            frequent[child_itemset] = count
+            if k + 1 < len(extensions):
+                eclat(child_itemset, child_docs, extension_rows[k+1:])
+
+    for k, row in enumerate(frequent_rows):
+        itemset = frozenset([doc_sets.annotations[row]])
+        frequent[itemset] = int(counts[row])
+        if k + 1 < len(frequent_rows):
+            eclat(itemset, doc_sets.get(doc_sets.annotations[row]), frequent_rows[k+1:])
+
+    if not negative_border:
+        return frequent
+
+    # Infrequent annotations, and infrequent extensions whose subsets are all frequent
+    border = {frozenset([doc_sets.annotations[row]]): int(count) for row, count in enumerate(counts) if 0 < count < min_count_items}
+    for itemset, count in candidates.items():
+        if all(itemset - {annotation} in frequent for annotation in itemset):
+            border[itemset] = count
+
+    return frequent, border
+
+
+def get_frequent_itemsets_eclat(set_all_anns:set, anns_dict:dict, min_support:float):
+    """
+    Returns the frequent itemsets (annotations) found with the Eclat algorithm (see get_itemset_counts_eclat),
+    as a DataFrame with 'support' and 'itemsets' columns (same itemsets and supports as fpgrowth).
+    """
+
+    nb_files = len(anns_dict)
+
+    # Files containing each annotation
+    files_by_ann = {ann: [] for ann in set_all_anns}
+    for filename, annotations in anns_dict.items():
+        for ann in set(annotations):
+            if ann in files_by_ann:
+                files_by_ann[ann].append(filename)
+
+    frequent = get_itemset_counts_eclat(files_by_ann, get_min_counts(min_support, nb_files))
+
+    return pd.DataFrame({'support': [count / nb_files for count in frequent.values()], 'itemsets': list(frequent)})
+
+
+# Available backends to mine frequent itemsets
+MINING_BACKENDS = {
+    'fpgrowth': get_frequent_itemsets_fpgrowth,
+    'eclat': get_frequent_itemsets_eclat
+}
+
+
+def get_associations(set_all_anns:set, anns_dict:dict, min_docs:int, min_confidence:float, backend:str='fpgrowth'):
     """
     Input:
     set_all_anns (set): A set of all unique filtered annotations in the specified folder of .ann files.
     anns_dict (dict): A dictionary where keys are filenames and values are lists of annotations.
     min_docs (int): The minimum number of documents an annotation must appear in to be considered.
     min_confidence (float): The minimum confidence required for an association rule.
+    backend (str): The algorithm used to find frequent itemsets (see MINING_BACKENDS).
 
     Output:
     rules (pd.DataFrame): A DataFrame of association rules.
     """
 
-    # Get a list of all filenames from the dictionary
-    filenames = list(anns_dict.keys())
-
-    # Encode the annotations as a list of dictionaries, where each dictionary represents a file
-    # and contains annotations as keys and boolean values indicating presence/absence as values
-    encoded_anns = [{ann: (ann in anns_dict[filename]) for ann in set_all_anns} for filename in filenames]
-    one_hot_df = pd.DataFrame(encoded_anns)
+    if backend not in MINING_BACKENDS:
+        raise ValueError(f"Unknown mining backend '{backend}'. Available backends: {', '.join(MINING_BACKENDS)}")
 
     # Calculate the minimum support required for an annotation to be considered frequent
-    min_support = min_docs / len(filenames)
+    min_support = min_docs / len(anns_dict)
 
-    # Use the fpgrowth algorithm to find frequent itemsets (annotations)
-    frequent_itemsets = fpgrowth(one_hot_df, min_support=min_support, use_colnames=True)
+    # Find frequent itemsets (annotations)
+    frequent_itemsets = MINING_BACKENDS[backend](set_all_anns, anns_dict, min_support)
 
     # Generate association rules from the frequent itemsets
     rules = association_rules(frequent_itemsets, min_threshold=min_confidence)
 
-    return rules
\ No newline at end of file
+    return rules
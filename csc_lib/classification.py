@@ -1,43 +1,193 @@
-import torch
-import math
+import importlib
+import numpy as np
 import pandas as pd
 from tqdm import tqdm
-from sklearn.utils import resample
-from sklearn.model_selection import train_test_split, GridSearchCV
-from sklearn.preprocessing import StandardScaler
-from sklearn.pipeline import Pipeline
-from imblearn.over_sampling import SMOTE
-from imblearn.pipeline import Pipeline as ImbPipeline
-from sklearn.metrics import confusion_matrix, accuracy_score, precision_score, roc_auc_score, make_scorer, roc_curve
-import matplotlib.pyplot as plt
+from csc_lib.config import PPL_BATCH_SIZE, PPL_WORKERS, PPL_THREADS_PER_WORKER
+from csc_lib.rule_table import select_rules, get_length_mask
+from csc_lib.data_loader import AdapterDisabledModel, model_worker_pool
+from csc_lib.model_server import RemoteModel
 
 import os
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
+# torch, sklearn, imblearn and matplotlib are imported by the functions using them, so that importing this module stays fast
+
+
+def build_model(model_info):
+    """Returns a new instance of a classifier of config.models_and_params (its class is imported at this point)"""
+    module_name, class_name = model_info['model'].rsplit('.', 1)
+    return getattr(importlib.import_module(module_name), class_name)(**model_info.get('model_args', {}))
+
+
 def get_ppl(inputs, selected_model, tokenizer):
     """
     Returns the perplexity of the selected model for the given inputs
     """
 
-    inputs = tokenizer(inputs, return_tensors='pt').to('cuda')
-    loss = selected_model(
-        input_ids = inputs['input_ids'],
-        labels = inputs['input_ids']
-    ).loss
+    import torch
+
+    inputs = tokenizer(inputs, return_tensors='pt').to(selected_model.device)
+    with torch.inference_mode():
+        loss = selected_model(
+            input_ids = inputs['input_ids'],
+            labels = inputs['input_ids']
+        ).loss
     ppl = torch.exp(loss)
     return ppl.item()
 
 
+def get_batch_losses(selected_model, input_ids, attention_mask, **kwargs):
+    """
+    Returns the mean loss of each sequence of a right-padded batch (the same loss as the one computed by the model for a single sequence)
+    """
+
+    import torch
+
+    with torch.inference_mode():
+        logits = selected_model(input_ids=input_ids, attention_mask=attention_mask, **kwargs).logits
+
+        # Each token is predicted from the previous ones, padding tokens are ignored
+        labels, mask = input_ids[:, 1:], attention_mask[:, 1:]
+        token_losses = torch.nn.functional.cross_entropy(logits[:, :-1].transpose(1, 2).float(), labels, reduction='none')
+        return (token_losses * mask).sum(dim=1) / mask.sum(dim=1)
+
+
+def get_shared_peft_model(selected_models):
+    """
+    Returns the LoRA PeftModel shared by all the selected models (the PeftModel itself or its base model, see data_loader.AdapterDisabledModel)
+    and the adapter each model runs with ('__base__' for the base model), or None if the models do not share one
+    """
+
+    from peft import PeftModel, PeftType
+
+    peft_models = [model.peft_model if isinstance(model, AdapterDisabledModel) else model for model in selected_models]
+    if len(selected_models) < 2 or not isinstance(peft_models[0], PeftModel) or any(peft_model is not peft_models[0] for peft_model in peft_models):
+        return None
+    if peft_models[0].active_peft_config.peft_type != PeftType.LORA:
+        return None
+    return peft_models[0], ['__base__' if isinstance(model, AdapterDisabledModel) else model.active_adapter for model in selected_models]
+
+
+def get_models_batch_losses(selected_models, input_ids, attention_mask):
+    """
+    Returns the losses of a batch (see get_batch_losses) for each of the selected models (rows).
+    Models sharing a LoRA PeftModel (see get_shared_peft_model) score the batch in a single pass: the batch is repeated once per model,
+    each copy running with the adapter of its model (mixed adapter batches of peft).
+    """
+
+    import torch
+
+    shared = get_shared_peft_model(selected_models)
+    if shared is None:
+        return torch.stack([get_batch_losses(model, input_ids.to(model.device), attention_mask.to(model.device)).cpu() for model in selected_models])
+
+    peft_model, adapter_names = shared
+    nb_models, nb_sequences = len(selected_models), len(input_ids)
+    losses = get_batch_losses(peft_model, input_ids.repeat(nb_models, 1).to(peft_model.device), attention_mask.repeat(nb_models, 1).to(peft_model.device),
+                              adapter_names=[name for name in adapter_names for _ in range(nb_sequences)])
+    return losses.view(nb_models, nb_sequences).cpu()
+
+
+def score_batch(selected_models, batch_input_ids, pad_token_id):
+    """Returns an array with the perplexity of each sequence of token IDs of a batch (columns) for each of the selected models (rows)"""
+
+    import torch
+
+    max_length = max(len(ids) for ids in batch_input_ids)
+    batch_ids = torch.full((len(batch_input_ids), max_length), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(batch_input_ids), max_length), dtype=torch.long)
+    for row, ids in enumerate(batch_input_ids):
+        batch_ids[row, :len(ids)] = torch.tensor(ids)
+        attention_mask[row, :len(ids)] = 1
+
+    return torch.exp(get_models_batch_losses(selected_models, batch_ids, attention_mask)).numpy()
+
+
+# State of each perplexity worker process, set once by init_ppl_worker
+worker_state = {}
+
+def init_ppl_worker(selected_models, pad_token_id):
+    """Stores the models of the worker (see data_loader.model_worker_pool)"""
+    worker_state.update({'selected_models': selected_models, 'pad_token_id': pad_token_id})
+
+
+def score_batch_worker(batch_input_ids):
+    """Scores a batch (see score_batch) with the models of the worker"""
+    return score_batch(worker_state['selected_models'], batch_input_ids, worker_state['pad_token_id'])
+
+
+def get_batch_ppls(texts, selected_models, tokenizer, batch_size=PPL_BATCH_SIZE, workers=PPL_WORKERS, threads_per_worker=PPL_THREADS_PER_WORKER):
+    """
+    Returns an array with the perplexity of each text (columns) for each of the selected models (rows), as get_ppl.
+    Texts are sorted by number of tokens and scored by batches of similar lengths, to limit padding.
+    Each batch is scored by all the models before moving to the next one (in a single pass for models sharing a LoRA PeftModel, see get_models_batch_losses).
+
+    With several workers, batches are shared across a pool of processes forked with the models (CPU only, see data_loader.model_worker_pool),
+    each using threads_per_worker threads. Batches are merged in order, so that the results are the same as with a single process.
+
+    Models of a model server (see model_server.RemoteModel) are scored by the server, batched with the texts of its other clients (tokenizer and workers are then not used).
+    """
+
+    if len(selected_models) > 0 and all(isinstance(model, RemoteModel) for model in selected_models):
+        return selected_models[0].client.score_perplexity(texts, [model.name for model in selected_models], batch_size)
+
+    input_ids = tokenizer(list(texts))['input_ids']
+    order = sorted(range(len(input_ids)), key=lambda i: len(input_ids[i]))
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else 0
+    batches = [order[start:start + batch_size] for start in range(0, len(order), batch_size)]
+    batches_input_ids = ([input_ids[i] for i in batch] for batch in batches)
+
+    ppls = np.empty((len(selected_models), len(input_ids)))
+    if workers <= 1 or len(batches) <= 1:
+        for batch, batch_input_ids in tqdm(zip(batches, batches_input_ids), total=len(batches), desc='Calculating perplexities...'):
+            ppls[:, batch] = score_batch(selected_models, batch_input_ids, pad_token_id)
+        return ppls
+
+    if any(model.device.type != 'cpu' for model in selected_models):
+        raise ValueError("Perplexities can only be calculated by several workers with models on CPU.")
+    with model_worker_pool(workers, threads_per_worker, init_ppl_worker, (selected_models, pad_token_id)) as pool:
+        scored_batches = pool.imap(score_batch_worker, batches_input_ids)
+        for batch, batch_ppls in tqdm(zip(batches, scored_batches), total=len(batches), desc=f'Calculating perplexities ({workers} workers)...'):
+            ppls[:, batch] = batch_ppls
+    return ppls
+
+
+def get_cached_ppls(texts, selected_models, tokenizer, cache, batch_size=PPL_BATCH_SIZE, workers=PPL_WORKERS, threads_per_worker=PPL_THREADS_PER_WORKER):
+    """
+    Same as get_batch_ppls, but perplexities are looked up in a PerplexityCache first, and only cache misses are scored (then cached).
+    Texts missing for all the models are scored by all of them at once, the other ones only by the models they are missing for.
+    """
+
+    texts = list(texts)
+    fingerprints = [cache.fingerprint(selected_model, tokenizer) for selected_model in selected_models]
+    found = [cache.get_many(fingerprint, texts) for fingerprint in fingerprints]
+    misses = [[text for text in dict.fromkeys(texts) if text not in found_model] for found_model in found]
+
+    common_misses = set(misses[0]).intersection(*misses[1:])
+    to_score = [([text for text in misses[0] if text in common_misses], list(range(len(selected_models))))]
+    to_score += [([text for text in misses_model if text not in common_misses], [k]) for k, misses_model in enumerate(misses)]
+
+    for texts_to_score, model_ids in to_score:
+        if len(texts_to_score) > 0:
+            ppls = get_batch_ppls(texts_to_score, [selected_models[k] for k in model_ids], tokenizer, batch_size, workers, threads_per_worker)
+            for k, model_ppls in zip(model_ids, ppls):
+                scored = dict(zip(texts_to_score, model_ppls))
+                cache.put_many(fingerprints[k], scored)
+                found[k].update(scored)
+
+    return np.array([[found_model[text] for text in texts] for found_model in found])
+
+
 def get_associations(df:pd.DataFrame, len_associations=3):
     """
     Yields associations (antecedents + consequents) from a dataframe in order to iterate over them.
     By default, we consider associations of 3 annotations
+    Antecedents and consequents are sorted, so that an association is always written the same way (the order of a frozenset changes between runs).
     """
 
-    for _, row in df.iterrows():
-        antecedents, consequents = list(row['antecedents']), list(row['consequents'])
-        if len(antecedents) + len(consequents) == len_associations:
-            yield antecedents + consequents
+    rules = select_rules(df, len_associations)
+    for antecedents, consequents in zip(rules['antecedents'], rules['consequents']):
+        yield sorted(antecedents) + sorted(consequents)
 
 
 def count_considered_associations(df: pd.DataFrame, len_associations=3):
@@ -45,28 +195,29 @@ def count_considered_associations(df: pd.DataFrame, len_associations=3):
     Counts the number of associations that meet the length requirement.
     Used for display purposes when using tqdm bar.
     """
-    count = 0
-    for _, row in df.iterrows():
-        antecedents, consequents = list(row['antecedents']), list(row['consequents'])
-        if len(antecedents) + len(consequents) == len_associations:
-            count += 1
-    return count
+    return int(get_length_mask(df, len_associations).sum())
 
 
-def calculate_all_ppls(df:pd.DataFrame, base_model, ft_model, tokenizer, len_associations=3):
+def calculate_all_ppls(df:pd.DataFrame, base_model, ft_model, tokenizer, len_associations=3, batch_size=PPL_BATCH_SIZE, cache=None, workers=PPL_WORKERS, threads_per_worker=PPL_THREADS_PER_WORKER):
     """
     Returns a dataframe containing, for each association, the perplexity obtained with 2 distinct models and the ratio of their log-perplexity
+    If a PerplexityCache is given, only the associations missing from the cache are scored.
+    With several workers, associations are scored by a pool of processes (see get_batch_ppls).
     """
 
-    # Counts the associations that meet the length requirement (default: 3)
-    considered_associations_count = count_considered_associations(df, len_associations)
+    # Associations that meet the length requirement (default: 3)
+    associations = [', '.join(association) for association in get_associations(df, len_associations)]
 
-    result_df = pd.DataFrame(columns=['association', 'base_ppl', 'finetuned_ppl', 'ratio_ppls'])
-    for input in tqdm(get_associations(df, len_associations), desc=f'Calculating perplexities...', total=considered_associations_count):
-        input = ', '.join(input)
-        ppls = [get_ppl(input, selected_model, tokenizer) for selected_model in [base_model, ft_model]]
-        result_df.loc[len(result_df)] = [input, ppls[0], ppls[1], math.log(ppls[0])/math.log(ppls[1])]
-    return result_df
+    if cache is None:
+        base_ppls, ft_ppls = get_batch_ppls(associations, [base_model, ft_model], tokenizer, batch_size, workers, threads_per_worker)
+    else:
+        base_ppls, ft_ppls = get_cached_ppls(associations, [base_model, ft_model], tokenizer, cache, batch_size, workers, threads_per_worker)
+    return pd.DataFrame({
+        'association': associations,
+        'base_ppl': base_ppls,
+        'finetuned_ppl': ft_ppls,
+        'ratio_ppls': np.log(base_ppls) / np.log(ft_ppls)
+    })
 
 
 def prepare_data_downsample(df0, df1):
@@ -74,6 +225,10 @@ def prepare_data_downsample(df0, df1):
     Train test split on balanced data (balanced by downsampling the larger df)
     """
 
+    from sklearn.utils import resample
+    from sklearn.model_selection import train_test_split
+    from sklearn.preprocessing import StandardScaler
+
     df0['label'] = 0
     df1['label'] = 1
 
@@ -109,8 +264,15 @@ def train_and_evaluate_model(X_train, X_test, y_train, y_test, model, param_grid
     Apply grid search on precision
     """
 
+    import matplotlib.pyplot as plt
+    from sklearn.model_selection import GridSearchCV
+    from sklearn.pipeline import Pipeline
+    from sklearn.metrics import confusion_matrix, accuracy_score, precision_score, roc_auc_score, make_scorer, roc_curve
+
     # Currently not used (to augment the data)
     if use_smote:
+        from imblearn.over_sampling import SMOTE
+        from imblearn.pipeline import Pipeline as ImbPipeline
         pipeline = ImbPipeline([
             ('smote', SMOTE(random_state=42)),
             ('model', model)
@@ -1,12 +1,27 @@
-from sklearn.svm import SVC
-from xgboost import XGBClassifier
-
 DATA_PATH = "DATASET/corpus_propre"
 OUTPUT_PATH = "Outputs"
 FT_MODEL_PATH = "path/to/model"
 
+# Load a PEFT fine-tuned model once, its base weights also serving as the base model (with the adapters disabled),
+# instead of loading the base weights twice
+SHARE_BASE_WEIGHTS = True
+
+# Precision of the weights of the models: 'fp32', 'bf16' (weights loaded in bfloat16)
+# or 'int8-dynamic' (linear layers quantized to int8 with PyTorch dynamic quantization, CPU only)
+MODEL_PRECISION = "fp32"
+
+# Format of the association rules and rare combinations saved by the scripts ('parquet' or 'csv')
+ARTIFACT_FORMAT = "parquet"
+
 TYPES_TO_KEEP = {'PROC', 'DISO', 'CHEM'}
 
+# Pool used to read and parse .ann files: number of workers and type of workers ('thread' or 'process')
+LOADER_WORKERS = 8
+LOADER_EXECUTOR = 'thread'
+
+# Folder where the parsed annotations of each folder of .ann files are cached (None to parse all files on each run)
+CORPUS_INDEX_PATH = "Outputs/corpus_index"
+
 FILTER_OUT = {
     'examen clinique',
     'examen',
@@ -51,11 +66,58 @@ GEN_ARGS = {
     "output_scores": True,
 }
 
+# Maximum number of sequences sampled at once when measuring the chances of generating consequents
+# (all the tries of a prompt are always sampled at once)
+GENERATION_BATCH_SIZE = 64
+
+# Seed from which the seed of each call to generate is derived, so that tries are reproducible (None to use the global random state)
+GENERATION_SEED = 0
+
+# Number of processes sharing the calls to generate on CPU (1 to sample in the main process),
+# and number of threads of each process (None to split the CPU cores between the processes)
+GENERATION_WORKERS = 1
+GENERATION_THREADS_PER_WORKER = None
+
+# Number of new tokens between two checks of the consequents found so far: a sequence stops once all of them are found
+# (None to always generate max_new_tokens tokens)
+EARLY_STOP_INTERVAL = 16
+
+# Adaptive allocation of a budget of tries across association rules (see csc_lib.evaluation.measure_chances_adaptive):
+# tries given to every rule first, then to each uncertain rule at each round,
+# until the confidence interval of its success rate is narrower than +/- ADAPTIVE_PRECISION
+ADAPTIVE_MIN_TRIES = 5
+ADAPTIVE_ROUND_TRIES = 5
+ADAPTIVE_PRECISION = 0.1
+ADAPTIVE_CONFIDENCE = 0.95
+
+# Number of associations scored at once when calculating perplexities
+# (memory grows with batch size x number of tokens x vocabulary size of the model)
+PPL_BATCH_SIZE = 16
+
+# Number of processes sharing the batches of associations when calculating perplexities on CPU (1 to calculate them in the main process),
+# and number of threads of each process (None to split the CPU cores between the processes)
+PPL_WORKERS = 1
+PPL_THREADS_PER_WORKER = None
+
+# SQLite database where perplexities are cached, by model and association (None to disable the cache)
+PPL_CACHE_PATH = "Outputs/ppl_cache.sqlite"
+
+# Address of the model server started by serve_models.py and used by the scripts run with --server:
+# path of a Unix socket, or "localhost:port"
+MODEL_SERVER_ADDRESS = "Outputs/model_server.sock"
+# Key checked when a client connects to the model server (bytes, None for no check), required when the server listens on host:port
+MODEL_SERVER_AUTHKEY = None
+# Time (in seconds) the model server waits after a request for the requests of other clients, run with it
+MODEL_SERVER_BATCH_WAIT = 0.005
+
 
+# Classifiers trained by determine_source_corpus.py: class (as an import path, imported only when the classifier is built,
+# see csc_lib.classification.build_model), arguments of the class and grid of hyperparameters
 models_and_params = {
     
     'SVC': {
-        'model': SVC(probability=True, random_state=42),
+        'model': 'sklearn.svm.SVC',
+        'model_args': {'probability': True, 'random_state': 42},
         'param_grid': {
             'model__C': [0.1, 1, 10],
             'model__gamma': [0.001, 0.01, 0.1]
@@ -63,7 +125,8 @@ models_and_params = {
     },
 
     'XGB': {
-        'model': XGBClassifier(eval_metric='logloss', random_state=42),
+        'model': 'xgboost.XGBClassifier',
+        'model_args': {'eval_metric': 'logloss', 'random_state': 42},
         'param_grid': {
             'model__n_estimators': [100, 200, 300],
             'model__max_depth': [3, 5, 7],
@@ -0,0 +1,198 @@
+"""
+Contains a persistent on-disk index of the annotations of a folder of .ann files, so that files are only parsed again when they change
+"""
+
+import os
+import json
+import hashlib
+import numpy as np
+from csc_lib.config import TYPES_TO_KEEP, FILTER_OUT, CORPUS_INDEX_PATH, LOADER_WORKERS, LOADER_EXECUTOR
+from csc_lib.annotation_processor import get_annotations_from_files
+
+MAGIC = b'CSCIDX01'
+
+# To be increased when the parsing of .ann files changes, so that existing indexes are rebuilt
+PARSER_VERSION = 1
+
+
+def get_filter_hash():
+    """Returns a hash of the configuration used to parse and filter annotations"""
+    config = {'types_to_keep': sorted(TYPES_TO_KEEP), 'filter_out': sorted(FILTER_OUT), 'parser_version': PARSER_VERSION}
+    return hashlib.sha256(json.dumps(config).encode('utf-8')).hexdigest()
+
+
+def encode_strings(strings):
+    """Encodes a list of strings as a UTF-8 blob and the offsets of each string in the blob"""
+    encoded = [string.encode('utf-8') for string in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(string) for string in encoded], out=offsets[1:])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+def decode_strings(blob, offsets):
+    """Decodes a list of strings encoded with encode_strings"""
+    data = blob.tobytes()
+    return [data[start:end].decode('utf-8') for start, end in zip(offsets[:-1].tolist(), offsets[1:].tolist())]
+
+
+class CorpusIndex:
+    """
+    Annotations of a folder of .ann files, with interned annotations (vocabulary) and filenames (doc IDs), stored as:
+    - forward postings (CSR): for each document, the IDs of its annotations, in order (as in load_annotations_from_folder)
+    - inverted postings (CSR): for each annotation, the IDs of the documents containing it, once per occurrence (as in reverse_annotations_dict)
+    The index is saved to a single binary file, whose arrays are memory-mapped when it is opened.
+    """
+
+    def __init__(self, filenames, vocabulary, forward_indptr, forward_indices, inverted_indptr, inverted_indices, files_stats=None, filter_hash=None):
+        self.filenames = filenames
+        self.vocabulary = vocabulary
+        self.forward_indptr = forward_indptr
+        self.forward_indices = forward_indices
+        self.inverted_indptr = inverted_indptr
+        self.inverted_indices = inverted_indices
+        self.files_stats = files_stats if files_stats is not None else {}
+        self.filter_hash = filter_hash
+
+    @classmethod
+    def from_annotations_dict(cls, dico_anns, files_stats=None, filter_hash=None):
+        """Builds the index of a dictionary where each key is a filename and each value is the list of annotations found in that file"""
+
+        # Intern annotations in order of first appearance
+        vocabulary_ids = {}
+        forward_indices = np.fromiter((vocabulary_ids.setdefault(ann, len(vocabulary_ids)) for anns in dico_anns.values() for ann in anns), dtype=np.int32)
+        forward_indptr = np.zeros(len(dico_anns) + 1, dtype=np.int64)
+        np.cumsum([len(anns) for anns in dico_anns.values()], out=forward_indptr[1:])
+
+        # Invert the postings, a stable sort by annotation keeps the documents of each annotation in order
+        doc_ids = np.repeat(np.arange(len(dico_anns), dtype=np.int32), np.diff(forward_indptr))
+        inverted_indices = doc_ids[np.argsort(forward_indices, kind='stable')]
+        inverted_indptr = np.zeros(len(vocabulary_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(forward_indices, minlength=len(vocabulary_ids)), out=inverted_indptr[1:])
+
+        return cls(list(dico_anns), list(vocabulary_ids), forward_indptr, forward_indices, inverted_indptr, inverted_indices, files_stats, filter_hash)
+
+    def annotations_dict(self):
+        """Returns the same dictionary as load_annotations_from_folder (filename -> list of annotations)"""
+        indptr, indices = self.forward_indptr.tolist(), self.forward_indices.tolist()
+        return {filename: [self.vocabulary[i] for i in indices[indptr[doc]:indptr[doc + 1]]] for doc, filename in enumerate(self.filenames)}
+
+    def annotations(self, doc):
+        """Returns the list of annotations of a document, given by its ID"""
+        start, end = self.forward_indptr[doc], self.forward_indptr[doc + 1]
+        return [self.vocabulary[i] for i in self.forward_indices[start:end].tolist()]
+
+    def reversed_annotations_dict(self):
+        """Returns the same dictionary as reverse_annotations_dict (annotation -> list of filenames, with '' for all files)"""
+        indptr, indices = self.inverted_indptr.tolist(), self.inverted_indices.tolist()
+        reversed_dico_anns = {'': list(self.filenames)}
+        for ann_id, annotation in enumerate(self.vocabulary):
+            reversed_dico_anns[annotation] = [self.filenames[doc] for doc in indices[indptr[ann_id]:indptr[ann_id + 1]]]
+        return reversed_dico_anns
+
+    def save(self, path):
+        """Saves the index to a single binary file (written to a temporary file first, so that an existing index is never left half-written)"""
+
+        filenames_blob, filenames_offsets = encode_strings(self.filenames)
+        vocabulary_blob, vocabulary_offsets = encode_strings(self.vocabulary)
+        arrays = {
+            'filenames_blob': filenames_blob,
+            'filenames_offsets': filenames_offsets,
+            'vocabulary_blob': vocabulary_blob,
+            'vocabulary_offsets': vocabulary_offsets,
+            'forward_indptr': self.forward_indptr,
+            'forward_indices': self.forward_indices,
+            'inverted_indptr': self.inverted_indptr,
+            'inverted_indices': self.inverted_indices
+        }
+
+        # Arrays are stored one after another, each one aligned on 64 bytes
+        layout, offset = {}, 0
+        for name, array in arrays.items():
+            layout[name] = [offset, array.dtype.str, len(array)]
+            offset += -(-array.nbytes // 64) * 64
+        header = json.dumps({'filter_hash': self.filter_hash, 'files_stats': self.files_stats, 'arrays': layout}).encode('utf-8')
+        data_start = -(-(len(MAGIC) + 8 + len(header)) // 64) * 64
+
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(np.uint64(len(header)).tobytes())
+            f.write(header)
+            for name, array in arrays.items():
+                f.seek(data_start + layout[name][0])
+                f.write(np.ascontiguousarray(array).tobytes())
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Opens an index saved with save(), memory-mapping its arrays"""
+
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not a corpus index.")
+            header_length = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+            header = json.loads(f.read(header_length).decode('utf-8'))
+        data_start = -(-(len(MAGIC) + 8 + header_length) // 64) * 64
+
+        data = np.memmap(path, dtype=np.uint8, mode='r')
+        arrays = {}
+        for name, (offset, dtype, length) in header['arrays'].items():
+            dtype = np.dtype(dtype)
+            start = data_start + offset
+            arrays[name] = data[start:start + length * dtype.itemsize].view(dtype)
+
+        return cls(
+            decode_strings(arrays['filenames_blob'], arrays['filenames_offsets']),
+            decode_strings(arrays['vocabulary_blob'], arrays['vocabulary_offsets']),
+            arrays['forward_indptr'], arrays['forward_indices'], arrays['inverted_indptr'], arrays['inverted_indices'],
+            header['files_stats'], header['filter_hash']
+        )
+
+
+def load_corpus_index(folder_path, index_dir=CORPUS_INDEX_PATH, workers=LOADER_WORKERS, executor=LOADER_EXECUTOR):
+    """
+    Returns the CorpusIndex of a folder of .ann files.
+    The index is stored in index_dir and keyed by the files of the folder (filename, modification time, size) and by the filter configuration:
+    it is opened as is when nothing changed, otherwise only new or modified files are parsed.
+    If index_dir is None, all files are parsed and the index is not saved.
+    """
+
+    # Same order of files as load_annotations_from_folder
+    filenames = [f for f in os.listdir(folder_path) if f.endswith('.ann')]
+    files_stats = {}
+    for filename in filenames:
+        stats = os.stat(os.path.join(folder_path, filename))
+        files_stats[filename] = [stats.st_mtime_ns, stats.st_size]
+    filter_hash = get_filter_hash()
+
+    # Open the previous index of the folder, if any (an index built with another filter configuration is discarded)
+    index_path, previous_index = None, None
+    if index_dir is not None:
+        index_path = os.path.join(index_dir, hashlib.sha256(os.path.abspath(folder_path).encode('utf-8')).hexdigest()[:16] + '.idx')
+        if os.path.isfile(index_path):
+            try:
+                previous_index = CorpusIndex.load(index_path)
+            except (ValueError, KeyError, OSError):
+                previous_index = None
+            if previous_index is not None and previous_index.filter_hash != filter_hash:
+                previous_index = None
+
+    if previous_index is not None and previous_index.filenames == filenames and previous_index.files_stats == files_stats:
+        return previous_index
+
+    # Only parse new or modified files
+    previous_annotations, previous_stats = {}, {}
+    if previous_index is not None:
+        previous_annotations, previous_stats = previous_index.annotations_dict(), previous_index.files_stats
+    to_parse = [filename for filename in filenames if previous_stats.get(filename) != files_stats[filename]]
+    if previous_index is not None:
+        print(f"Updating corpus index: {len(to_parse)} new or modified files out of {len(filenames)}.")
+    parsed_annotations = dict(zip(to_parse, get_annotations_from_files([os.path.join(folder_path, filename) for filename in to_parse], workers, executor)))
+
+    dico_anns = {filename: parsed_annotations[filename] if filename in parsed_annotations else previous_annotations[filename] for filename in filenames}
+    index = CorpusIndex.from_annotations_dict(dico_anns, files_stats, filter_hash)
+
+    if index_path is not None:
+        os.makedirs(index_dir, exist_ok=True)
+        index.save(index_path)
+    return index
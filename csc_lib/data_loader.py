@@ -1,31 +1,138 @@
 import os
-import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM
-from peft import PeftModel
+import gc
+import ctypes
+import multiprocessing
+from csc_lib.config import SHARE_BASE_WEIGHTS, MODEL_PRECISION
 
+PRECISIONS = ['fp32', 'bf16', 'int8-dynamic']
 
-def load_models(model_path, base_model_name='bigscience/bloom-1b1'):
+
+class AdapterDisabledModel:
+    """
+    Base model of a PeftModel, sharing its weights: the model runs with the adapters disabled.
+    Other attributes (device, config, dtype...) are the ones of the base model of the PeftModel.
+    """
+
+    def __init__(self, peft_model):
+        self.peft_model = peft_model
+
+    def __call__(self, *args, **kwargs):
+        with self.peft_model.disable_adapter():
+            return self.peft_model(*args, **kwargs)
+
+    def generate(self, *args, **kwargs):
+        with self.peft_model.disable_adapter():
+            return self.peft_model.generate(*args, **kwargs)
+
+    def to(self, device):
+        self.peft_model.to(device)
+        return self
+
+    def state_dict(self):
+        """Returns the weights of the base model only, named as in the base model loaded on its own"""
+        adapter_names = set(self.peft_model.peft_config)
+        state_dict = {}
+        for name, tensor in self.peft_model.get_base_model().state_dict().items():
+            parts = name.split('.')
+            if adapter_names.isdisjoint(parts):
+                state_dict['.'.join(part for part in parts if part not in ('base_layer', 'original_module'))] = tensor
+        return state_dict
+
+    def __getattr__(self, name):
+        return getattr(self.peft_model.get_base_model(), name)
+
+
+def quantize_linear_layers(model):
+    """
+    Replaces, in place, the linear layers of a model by int8 dynamically quantized ones (weights stored in int8, activations quantized on the fly, on CPU).
+    Adapters and the output layer (usually tied to the input embeddings) are kept as they are.
+    """
+
+    import torch
+
+    base_model = model.get_base_model() if hasattr(model, 'get_base_model') else model
+    adapter_names = set(getattr(model, 'peft_config', {}))
+    output_layer = base_model.get_output_embeddings()
+    qconfig_spec = {name: torch.ao.quantization.default_dynamic_qconfig for name, module in model.named_modules()
+                    if isinstance(module, torch.nn.Linear) and module is not output_layer and adapter_names.isdisjoint(name.split('.'))}
+    torch.ao.quantization.quantize_dynamic(model, qconfig_spec, dtype=torch.qint8, inplace=True)
+
+    # Perplexities change with quantization, which is part of the fingerprint of the model (see ppl_cache.get_model_fingerprint)
+    base_model.quantization = 'int8-dynamic'
+    return model
+
+
+def release_freed_memory():
+    """Gives the memory freed by the process back to the system (glibc keeps it otherwise, eg after weights were converted or quantized)"""
+    gc.collect()
+    try:
+        ctypes.CDLL('libc.so.6').malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+def init_model_worker(threads, initializer, initargs):
+    """Sets the number of threads of a model worker process, then runs its own initializer"""
+    import torch
+    torch.set_num_threads(threads)
+    initializer(*initargs)
+
+
+def model_worker_pool(workers, threads_per_worker, initializer, initargs):
+    """
+    Returns a pool of worker processes forked after the models are loaded (models on CPU only): the models given in initargs are inherited
+    from the parent process, their weights being shared copy-on-write. Each worker uses threads_per_worker threads
+    (by default, the CPU cores are split between the workers), then runs initializer(*initargs).
+    """
+    # Fast tokenizers used before forking would warn, or deadlock, in the workers
+    os.environ['TOKENIZERS_PARALLELISM'] = 'false'
+    threads = threads_per_worker or max(1, multiprocessing.cpu_count() // workers)
+    return multiprocessing.get_context('fork').Pool(workers, initializer=init_model_worker, initargs=(threads, initializer, initargs))
+
+
+def load_models(model_path, base_model_name='bigscience/bloom-1b1', share_base_weights=SHARE_BASE_WEIGHTS, precision=MODEL_PRECISION):
     """Load models with or without PEFT depending on the presence of adapter_config.json.
+    With share_base_weights, a PEFT model is loaded once and also serves as the base model, with its adapters disabled (see AdapterDisabledModel).
+    precision is one of PRECISIONS: 'fp32', 'bf16' (weights loaded in bfloat16) or 'int8-dynamic' (see quantize_linear_layers, the models stay on CPU).
     Move models to GPU if available"""
 
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision '{precision}', expected one of {PRECISIONS}.")
+
+    # torch, transformers and peft are only imported when models are loaded
+    import torch
+    from transformers import AutoTokenizer, AutoModelForCausalLM
+    from peft import PeftModel
+
+    torch_dtype = torch.bfloat16 if precision == 'bf16' else torch.float32
+
     # Load tokenizer
     tokenizer = AutoTokenizer.from_pretrained(base_model_name)
 
-    # Load base model
-    base_model = AutoModelForCausalLM.from_pretrained(base_model_name)
-
     # Load fine-tuned model
     if os.path.isfile(os.path.join(model_path, 'adapter_config.json')):
         # Using PEFT if specified path contains adapter_config.json file
-        ft_model = AutoModelForCausalLM.from_pretrained(base_model_name)
+        ft_model = AutoModelForCausalLM.from_pretrained(base_model_name, torch_dtype=torch_dtype)
         ft_model = PeftModel.from_pretrained(ft_model, model_path)
     else:
         # Load fully fine-tuned model directly else
-        ft_model = AutoModelForCausalLM.from_pretrained(model_path)
+        ft_model = AutoModelForCausalLM.from_pretrained(model_path, torch_dtype=torch_dtype)
 
-    # Use GPU if available
-    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    # Load base model (a single copy of the base weights when they can be shared)
+    if share_base_weights and isinstance(ft_model, PeftModel):
+        base_model = AdapterDisabledModel(ft_model)
+    else:
+        base_model = AutoModelForCausalLM.from_pretrained(base_model_name, torch_dtype=torch_dtype)
+
+    # Use GPU if available (dynamically quantized models only run on CPU)
+    device = 'cuda' if torch.cuda.is_available() and precision != 'int8-dynamic' else 'cpu'
     base_model.to(device)
     ft_model.to(device)
 
-    return tokenizer, base_model, ft_model
\ No newline at end of file
+    if precision == 'int8-dynamic':
+        quantize_linear_layers(ft_model)
+        if not isinstance(base_model, AdapterDisabledModel):
+            quantize_linear_layers(base_model)
+    release_freed_memory()
+
+    return tokenizer, base_model, ft_model
@@ -0,0 +1,114 @@
+"""
+Contains a bitset-backed engine used to store and intersect sets of documents
+"""
+
+import numpy as np
+
+
+class DocumentSets:
+    """
+    Interns filenames to integer IDs and stores, for each annotation, the documents containing it as a bitset.
+    Bitsets are numpy arrays of packed uint64 words, so that intersections and counts run word-at-a-time.
+
+    A set of documents is represented by a tuple (word_ids, words) holding the non-zero words of its bitset (and possibly a few zero ones),
+    so that the size of a small set (eg, a rare combination) does not depend on the size of the corpus.
+    """
+
+    def __init__(self, dico_anns_filtered:dict):
+        """
+        Input: A dictionary where each key is an annotation and each value is a list of filenames where that annotation was found.
+        """
+
+        # Intern filenames to integer IDs (in order of first appearance)
+        self.doc_ids = {}
+        for filenames in dico_anns_filtered.values():
+            for filename in filenames:
+                if filename not in self.doc_ids:
+                    self.doc_ids[filename] = len(self.doc_ids)
+        self.filenames = list(self.doc_ids)
+        self.nb_words = (len(self.filenames) + 63) // 64
+
+        # Store the postings of every annotation as a row of packed uint64 words
+        self.annotations = list(dico_anns_filtered.keys())
+        self.annotation_ids = {annotation: i for i, annotation in enumerate(self.annotations)}
+        self.postings = np.zeros((len(self.annotations), self.nb_words), dtype=np.uint64)
+        for i, filenames in enumerate(dico_anns_filtered.values()):
+            ids = np.fromiter((self.doc_ids[filename] for filename in filenames), dtype=np.uint64)
+            np.bitwise_or.at(self.postings[i], ids >> np.uint64(6), np.uint64(1) << (ids & np.uint64(63)))
+
+    def save(self, path):
+        """Saves the postings to a .npy file, which can then be memory-mapped by other processes"""
+        np.save(path, self.postings)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Memory-maps (read-only) postings saved with save().
+        The returned object can intersect and count sets of documents, but does not know the filenames and annotations.
+        """
+        doc_sets = cls({})
+        doc_sets.postings = np.asarray(np.load(path, mmap_mode='r'))
+        doc_sets.nb_words = doc_sets.postings.shape[1]
+        return doc_sets
+
+    def get(self, annotation):
+        """Returns the set of documents containing the annotation"""
+        bits = self.postings[self.annotation_ids[annotation]]
+        word_ids = np.flatnonzero(bits)
+        return word_ids, bits[word_ids]
+
+    def rows(self, annotations):
+        """Returns the postings row IDs of the given annotations"""
+        return np.fromiter((self.annotation_ids[annotation] for annotation in annotations), dtype=np.intp)
+
+    @staticmethod
+    def count(docs):
+        """Returns the number of documents in a set"""
+        return int(np.bitwise_count(docs[1]).sum())
+
+    def intersection(self, docs, annotation):
+        """Returns the intersection of a set of documents with the documents containing the annotation"""
+        word_ids, words = docs
+        intersection = np.bitwise_and(self.postings[self.annotation_ids[annotation], word_ids], words)
+        non_zero = np.flatnonzero(intersection)
+        return word_ids[non_zero], intersection[non_zero]
+
+    def intersect(self, docs, rows, min_count=1, compact=True):
+        """
+        Intersects a set of documents with the postings of several annotations (given as row IDs) at once.
+        Only the words that are non-zero in docs are read from the postings.
+        Yields (index in rows, resulting set of documents, number of documents) for each intersection of at least min_count documents.
+
+        With compact, each resulting set only holds its own non-zero words, which is best when many of them are kept in memory.
+        Otherwise, resulting sets hold the same words as docs, which is faster when they are short-lived.
+        """
+        word_ids, words = docs
+        non_zero = words.nonzero()[0]
+        word_ids, words = word_ids[non_zero], words[non_zero]
+
+        intersections = np.bitwise_and(self.postings[rows[:, np.newaxis], word_ids], words)
+        counts = np.bitwise_count(intersections).sum(axis=1, dtype=np.int64)
+
+        # Only keep the large enough intersections (copied, so that the others can be released)
+        kept = (counts >= max(min_count, 1)).nonzero()[0]
+        intersections = intersections[kept]
+
+        if compact:
+            # Only keep the non-zero words of each intersection, compacted all at once
+            nz_rows, nz_cols = np.nonzero(intersections)
+            bounds = np.cumsum(np.count_nonzero(intersections, axis=1))[:-1]
+            children_word_ids = np.split(word_ids[nz_cols], bounds)
+            children_words = np.split(intersections[nz_rows, nz_cols], bounds)
+        else:
+            children_word_ids = [word_ids] * len(kept)
+            children_words = intersections
+
+        for i, child_word_ids, child_words, count in zip(kept, children_word_ids, children_words, counts[kept]):
+            yield i, (child_word_ids, child_words), int(count)
+
+    def decode(self, docs):
+        """Returns the list of filenames in a set of documents, sorted by document ID"""
+        word_ids, words = docs
+        flags = np.unpackbits(words.astype('<u8').view(np.uint8), bitorder='little').reshape(len(words), 64)
+        rows, bit_ids = np.nonzero(flags)
+        return [self.filenames[i] for i in word_ids[rows] * 64 + bit_ids]
@@ -1,10 +1,134 @@
+import os
+import hashlib
+import numpy as np
 from tqdm import tqdm
-from csc_lib.config import GEN_ARGS
+from contextlib import nullcontext
+from statistics import NormalDist
+from csc_lib.config import GEN_ARGS, GENERATION_BATCH_SIZE, GENERATION_SEED, GENERATION_WORKERS, GENERATION_THREADS_PER_WORKER, EARLY_STOP_INTERVAL, ADAPTIVE_MIN_TRIES, ADAPTIVE_ROUND_TRIES, ADAPTIVE_PRECISION, ADAPTIVE_CONFIDENCE
+from csc_lib.target_matcher import TargetMatcher
+from csc_lib.result_writers import JSONLinesWriter, read_json_lines
+from csc_lib.model_server import RemoteGenerator
+from csc_lib.data_loader import model_worker_pool
 
-def measure_chances_generating_target(generator, df, target_column, prompt_template, nb_tries, max_new_tokens, step=1, block_size=1):
+def derive_seed(seed, *keys):
+    """Returns a seed derived from a base seed and keys (eg, the round of tries and the position of a call), the same in every process"""
+    return int.from_bytes(hashlib.sha256(repr((seed,) + keys).encode('utf-8')).digest()[:8], 'little')
+
+def sample_call(generator, prompts, matchers, nb_tries, max_new_tokens, early_stop_interval, prefix, seed=None):
+    """
+    Samples nb_tries completions of each prompt with a single call to generate and returns, for each prompt, the targets found in each try.
+    Unless seed is None, the random state is seeded first, so that the call gives the same tries in any process.
+    """
+    completions = generator.complete_prompts(prompts, GEN_ARGS, max_new_tokens, num_return_sequences=nb_tries,
+                                             matchers=matchers if early_stop_interval else None, check_interval=early_stop_interval, prefix=prefix, seed=seed)
+
+    # generated parts exclude the prompt
+    return [[matcher.find(generated_part) for generated_part in generated_parts] for matcher, generated_parts in zip(matchers, completions)]
+
+# State of each generation worker process, set once by init_generation_worker
+worker_state = {}
+
+def init_generation_worker(generator):
+    """Stores the generator of the worker (see data_loader.model_worker_pool)"""
+    worker_state['generator'] = generator
+
+def sample_call_worker(call):
+    """Samples the tries of a call (see sample_call) with the generator of the worker"""
+    return sample_call(worker_state['generator'], *call)
+
+def generation_pool(generator, workers=GENERATION_WORKERS, threads_per_worker=GENERATION_THREADS_PER_WORKER):
+    """
+    Returns a pool of worker processes forked with the generator (model on CPU only, see data_loader.model_worker_pool),
+    each using threads_per_worker threads, or a null context with a single worker.
+    """
+    if workers <= 1:
+        return nullcontext()
+    if isinstance(generator, RemoteGenerator):
+        raise ValueError("Tries sampled by a model server are sampled by the server, with a single worker.")
+    if generator.model.device.type != 'cpu':
+        raise ValueError("Tries can only be sampled by several workers with a model on CPU.")
+    return model_worker_pool(workers, threads_per_worker, init_generation_worker, (generator,))
+
+def sample_found_targets(generator, prompts, matchers, nb_tries, max_new_tokens, batch_size=GENERATION_BATCH_SIZE, early_stop_interval=EARLY_STOP_INTERVAL, desc='Iterating through blocks...', prefix=None, writer=None, rules=None, seed=None, seed_key=None, pool=None, skip=None, blocks=None):
+    """
+    Samples nb_tries completions of each prompt and returns, for each prompt, the list of the targets found in each try (with the TargetMatcher of the prompt).
+    All the tries of a prompt, and of several prompts, are sampled with a single call to generate, in batches of up to batch_size sequences (at least one prompt per batch).
+    prefix is the text at the beginning of every prompt (see Generator.complete_prompts).
+    With a writer (see JSONLinesWriter), the tries of each call are written at once, as one record per prompt: {'rule': rule of the prompt (in rules), 'found': targets found in each try}.
+    With blocks (block of each prompt, when a rule is studied in several blocks), records also hold the block of their prompt: {'rule', 'block', 'found'}.
+    Unless seed is None, each call is seeded with a seed derived from seed, seed_key and its position (see derive_seed).
+    With a pool (see generation_pool), calls are shared across its workers and their results streamed back in order,
+    so that the tries are the same whatever the number of workers.
+    With skip (indices of the prompts whose tries are already saved, eg when resuming), calls are built and seeded as without it, so that the other prompts get the same tries,
+    but the calls whose prompts are all in skip are not sampled, and the tries of the prompts in skip are neither written nor returned.
+    """
+
+    if pool is not None and seed is None:
+        # Forked workers share the same random state, each call needs its own seed
+        seed = int.from_bytes(os.urandom(8), 'little')
+
+    prompts_per_call = max(1, batch_size // nb_tries)
+    starts = range(0, len(prompts), prompts_per_call)
+    if skip:
+        starts = [start for start in starts if any(i not in skip for i in range(start, min(start + prompts_per_call, len(prompts))))]
+    calls = ((prompts[start:start + prompts_per_call], matchers[start:start + prompts_per_call], nb_tries, max_new_tokens, early_stop_interval, prefix,
+              None if seed is None else derive_seed(seed, seed_key, start)) for start in starts)
+    results = pool.imap(sample_call_worker, calls) if pool is not None else (sample_call(generator, *call) for call in calls)
+
+    found_targets = []
+    for start, batch_found_targets in tqdm(zip(starts, results), total=len(starts), desc=desc):
+        batch_indices = range(start, start + len(batch_found_targets))
+        if skip:
+            # Prompts of a call that were already saved (eg, before a crash in the middle of the call) are sampled again, but dropped
+            batch_indices, batch_found_targets = zip(*[(i, found_targets_each_try) for i, found_targets_each_try in zip(batch_indices, batch_found_targets) if i not in skip])
+        found_targets.extend(batch_found_targets)
+        if writer is not None:
+            records = ({'rule': rules[i] if rules is not None else None, 'found': [sorted(found) for found in found_targets_each_try]} for i, found_targets_each_try in zip(batch_indices, batch_found_targets))
+            if blocks is not None:
+                records = (dict(record, block=blocks[i]) for i, record in zip(batch_indices, records))
+            writer.write(records)
+
+    return found_targets
+
+def read_found_targets(path, accumulate=False, by_block=False):
+    """
+    Returns the targets found in each try of each rule, from a file written by sample_found_targets: {rule: [targets found in each try]}.
+    With accumulate, the tries of all the records of a rule are gathered, else only the last record of each rule is kept.
+    With by_block, records are keyed by (block, rule) instead (see the blocks of sample_found_targets).
+    """
+    found_targets = {}
+    for record in read_json_lines(path):
+        key = (record['block'], record['rule']) if by_block else record['rule']
+        found_targets_each_try = [set(found) for found in record['found']]
+        if accumulate:
+            found_targets.setdefault(key, []).extend(found_targets_each_try)
+        else:
+            found_targets[key] = found_targets_each_try
+    return found_targets
+
+def add_found_targets(df, target_column, found_targets):
+    """Adds the number of targets found in each try and the targets found during the most successful try of each rule ({position of the rule in df: [targets found in each try]})"""
+    df[f'# {target_column} found each try'] = None
+    df[f'# {target_column} found each try'] = df[f'# {target_column} found each try'].astype(object)
+    df[f'Max {target_column} found'] = None
+    df[f'Max {target_column} found'] = df[f'Max {target_column} found'].astype(object)
+
+    for position, found_targets_each_try in found_targets.items():
+        df.at[df.index[position], f'# {target_column} found each try'] = [len(found) for found in found_targets_each_try]
+        df.at[df.index[position], f'Max {target_column} found'] = get_max_targets_found(found_targets_each_try)
+    return df
+
+def measure_chances_generating_target(generator, df, target_column, prompt_template, nb_tries, max_new_tokens, step=1, block_size=1, batch_size=GENERATION_BATCH_SIZE, ignore_case=False, ignore_accents=False, early_stop_interval=EARLY_STOP_INTERVAL, output_path=None, resume=False, seed=GENERATION_SEED, workers=GENERATION_WORKERS, threads_per_worker=GENERATION_THREADS_PER_WORKER):
     """
     Iterates through rows of a dataframe and keeps track of how many information from a target column we can obtain when using prompt_template in the limit of nb_tries tries.
-    
+    The tries of several rows are sampled at once, in batches of up to batch_size sequences (at least one row per batch).
+    Targets are searched in generated texts with a TargetMatcher, optionally regardless of case and/or accents.
+    Unless early_stop_interval is None (or 0), each try is checked every early_stop_interval new tokens and stops once all the targets are found.
+    With output_path, the tries are streamed to a JSON Lines file (see sample_found_targets) from which the results are read at the end,
+    and with resume, the rows already studied in this file (in the same block) are not studied again (the other ones get the same tries as in an uninterrupted run).
+    Each call to generate is seeded with a seed derived from seed (see sample_found_targets), and with several workers,
+    calls are shared across a pool of processes (see generation_pool): the tries are the same whatever the number of workers.
+
     Example usage :
     measure_chances_generating_target(
         generator = generator,
@@ -19,34 +143,116 @@ def measure_chances_generating_target(generator, df, target_column, prompt_templ
     if target_column not in df.columns:
         raise ValueError(f"The column '{target_column}' is not present in the dataframe.")
 
-    df[f'# {target_column} found each try'] = None
-    df[f'# {target_column} found each try'] = df[f'# {target_column} found each try'].astype(object)
-    df[f'Max {target_column} found'] = None
-    df[f'Max {target_column} found'] = df[f'Max {target_column} found'].astype(object)
+    # Positions of the rows of each block, in order (a row is studied again each time it belongs to a block, blocks overlap when step < block_size)
+    blocks = [bloc_idx for bloc_idx in range(0, len(df)-block_size, step) for _ in range(bloc_idx, min(bloc_idx + block_size, len(df)))]
+    positions = [position for bloc_idx in range(0, len(df)-block_size, step) for position in range(bloc_idx, min(bloc_idx + block_size, len(df)))]
+    # Rows already studied in the same block are skipped, the calls (and their seeds) of the other ones are the same as in an uninterrupted run
+    skip = set()
+    if resume and output_path is not None and os.path.isfile(output_path):
+        studied = set(read_found_targets(output_path, by_block=True))
+        skip = {i for i, (bloc_idx, position) in enumerate(zip(blocks, positions)) if (bloc_idx, position) in studied}
+
+    # prompt = prompt_template.format(**row)
+    prompts = [prompt_template.format(antecedents=', '.join(df.iloc[position]['antecedents'])) for position in positions]
+    # Targets are compiled once for all the tries
+    matchers = [TargetMatcher(df.iloc[position][target_column], ignore_case, ignore_accents) for position in positions]
+    with JSONLinesWriter(output_path, append=resume) if output_path else nullcontext() as writer, generation_pool(generator, workers, threads_per_worker) as pool:
+        found_targets = sample_found_targets(generator, prompts, matchers, nb_tries, max_new_tokens, batch_size, early_stop_interval,
+                                             prefix=prompt_template.split('{')[0], writer=writer, rules=positions, seed=seed, pool=pool, skip=skip, blocks=blocks)
+
+    # The tries of the last block of each row are kept
+    if output_path:
+        found_targets = {position: found_targets_each_try for (_, position), found_targets_each_try in sorted(read_found_targets(output_path, by_block=True).items())}
+    else:
+        found_targets = dict(zip(positions, found_targets))
+    return add_found_targets(df, target_column, found_targets)
+
+def get_max_targets_found(found_targets_each_try):
+    """Returns the targets found during the most successful try (the last one, in case of a tie)"""
+    max_targets_found = []
+    for found_targets in found_targets_each_try:
+        if len(found_targets) >= len(max_targets_found):
+            max_targets_found = found_targets
+    return max_targets_found
+
+def wilson_interval(nb_successes, nb_tries, confidence=ADAPTIVE_CONFIDENCE):
+    """Returns the Wilson score interval (low, high) of a success rate, given as numpy arrays (or floats)"""
+    z = NormalDist().inv_cdf(1 - (1 - confidence) / 2)
+    nb_tries = np.maximum(nb_tries, 1)
+    rate = nb_successes / nb_tries
+    center = (rate + z**2 / (2 * nb_tries)) / (1 + z**2 / nb_tries)
+    half_width = z * np.sqrt(rate * (1 - rate) / nb_tries + z**2 / (4 * nb_tries**2)) / (1 + z**2 / nb_tries)
+    return center - half_width, center + half_width
+
+def measure_chances_adaptive(generator, df, target_column, prompt_template, budget, max_new_tokens, max_tries=30, min_tries=ADAPTIVE_MIN_TRIES, round_tries=ADAPTIVE_ROUND_TRIES, precision=ADAPTIVE_PRECISION, confidence=ADAPTIVE_CONFIDENCE, batch_size=GENERATION_BATCH_SIZE, ignore_case=False, ignore_accents=False, early_stop_interval=EARLY_STOP_INTERVAL, output_path=None, resume=False, seed=GENERATION_SEED, workers=GENERATION_WORKERS, threads_per_worker=GENERATION_THREADS_PER_WORKER):
+    """
+    Same measures as measure_chances_generating_target, for every row of a dataframe, with a total budget of tries spent adaptively across rows.
+    A try is a success when all the targets of the row are found. The success rate of each row is estimated with a Wilson score interval:
+    - every row first gets min_tries tries (rows are covered in order while the budget allows it)
+    - then, by rounds, the rows whose interval is wider than 2 * precision (and which got less than max_tries tries) get round_tries more tries,
+      most uncertain rows first, until the budget is spent or every interval is tight enough
+    Adds the number of tries used, the success rate and its interval (at the given confidence level) for each row. Rows without any try are left empty.
+    With output_path, the tries are streamed to a JSON Lines file (see sample_found_targets), and with resume, the tries already in this file
+    are counted (in the budget too) and the allocation goes on from them.
+    Tries are seeded, and shared across workers, as in measure_chances_generating_target.
+    """
+
+    # Check if the target column is in the dataframe
+    if target_column not in df.columns:
+        raise ValueError(f"The column '{target_column}' is not present in the dataframe.")
 
-    for bloc_idx in tqdm(range(0, len(df)-block_size, step), desc='Iterating through blocks...'):
+    prompts = [prompt_template.format(antecedents=', '.join(antecedents)) for antecedents in df['antecedents']]
+    matchers = [TargetMatcher(targets, ignore_case, ignore_accents) for targets in df[target_column]]
+    found_targets = [[] for _ in range(len(df))]
+    if resume and output_path is not None and os.path.isfile(output_path):
+        for row, found_targets_each_try in read_found_targets(output_path, accumulate=True).items():
+            found_targets[row] = found_targets_each_try
+    nb_tries = np.array([len(found_targets_each_try) for found_targets_each_try in found_targets], dtype=int)
+    nb_successes = np.array([sum(len(found) == matcher.nb_targets for found in found_targets_each_try) for matcher, found_targets_each_try in zip(matchers, found_targets)], dtype=int)
 
-        for i, row in df[bloc_idx:bloc_idx + block_size].iterrows():
+    def sample(rows, nb_new_tries, desc):
+        # The number of tries sampled so far identifies each sampling, including after a resume
+        found = sample_found_targets(generator, [prompts[row] for row in rows], [matchers[row] for row in rows], nb_new_tries, max_new_tokens, batch_size, early_stop_interval, desc,
+                                     prompt_template.split('{')[0], writer, rows, seed, int(nb_tries.sum()), pool)
+        for row, found_targets_each_try in zip(rows, found):
+            found_targets[row].extend(found_targets_each_try)
+            nb_tries[row] += nb_new_tries
+            nb_successes[row] += sum(len(targets) == matchers[row].nb_targets for targets in found_targets_each_try)
 
-            # prompt = prompt_template.format(**row)
-            antecedents = ', '.join(row['antecedents'])
-            prompt = prompt_template.format(antecedents=antecedents)
-            targets = row[target_column]
-            nb_targets_found_over_each_try = []
-            max_targets_found = []
+    # The file is closed (and its records flushed) even if a call fails
+    with JSONLinesWriter(output_path, append=resume) if output_path else nullcontext() as writer, generation_pool(generator, workers, threads_per_worker) as pool:
+        # Every row first gets the same number of tries
+        min_tries = min(min_tries, max_tries)
+        sample([row for row in range(min(len(df), budget // min_tries)) if nb_tries[row] == 0], min_tries, 'First tries')
+        budget -= nb_tries.sum()
 
-            for _ in range(nb_tries):
+        round_idx = 1
+        while budget > 0:
+            low, high = wilson_interval(nb_successes, nb_tries, confidence)
+            uncertain = np.flatnonzero((nb_tries > 0) & (nb_tries < max_tries) & ((high - low) / 2 > precision))
+            if len(uncertain) == 0:
+                break
 
-                completed_prompt = generator.complete_prompt(prompt, GEN_ARGS, max_new_tokens)
-                generated_part = completed_prompt[len(completed_prompt):] # we exclude the prompt
-                found_targets = {target for target in targets if generated_part.find(target)!=-1}
-                nb_targets_found = len(found_targets)
-                nb_targets_found_over_each_try.append(nb_targets_found)
+            # Most uncertain rows first, round_tries more tries each (fewer if the budget or max_tries do not allow it)
+            uncertain = uncertain[np.argsort(-(high - low)[uncertain], kind='stable')]
+            nb_new_tries = np.minimum(round_tries, max_tries - nb_tries[uncertain])
+            nb_new_tries[0] = min(nb_new_tries[0], budget)
+            selected = np.cumsum(nb_new_tries) <= budget
+            uncertain, nb_new_tries = uncertain[selected], nb_new_tries[selected]
 
-                if nb_targets_found >= len(max_targets_found):
-                    max_targets_found = found_targets
+            # Rows getting the same number of tries are sampled together
+            for nb in np.unique(nb_new_tries):
+                rows = sorted(uncertain[nb_new_tries == nb].tolist())
+                sample(rows, int(nb), f'Round {round_idx}, {len(rows)} uncertain rules')
+            budget -= nb_new_tries.sum()
+            round_idx += 1
 
-            df.at[i, f'# {target_column} found each try'] = nb_targets_found_over_each_try
-            df.at[i, f'Max {target_column} found'] = max_targets_found
+    low, high = wilson_interval(nb_successes, nb_tries, confidence)
+    studied = nb_tries > 0
+    df = add_found_targets(df, target_column, {row: found_targets_each_try for row, found_targets_each_try in enumerate(found_targets) if found_targets_each_try})
+    df['Tries used'] = nb_tries
+    df['Success rate'] = np.where(studied, nb_successes / np.maximum(nb_tries, 1), np.nan)
+    df['Success rate CI low'] = np.where(studied, low, np.nan)
+    df['Success rate CI high'] = np.where(studied, high, np.nan)
 
     return df
\ No newline at end of file
@@ -1,11 +1,47 @@
-import torch
+import inspect
+# torch and transformers are only imported when prompts are completed
+
+
+class TargetsFoundCriteria:
+    """
+    Stops each sequence once all its targets appear in its new tokens (matchers: one TargetMatcher per sequence, see csc_lib.target_matcher).
+    New tokens are decoded and searched every check_interval tokens, other sequences of the batch keep being generated.
+    Used as a transformers StoppingCriteria (a callable returning whether each sequence is finished), without importing transformers.
+    """
+
+    def __init__(self, tokenizer, matchers, prompt_length, check_interval=16):
+        self.tokenizer = tokenizer
+        self.matchers = matchers
+        self.prompt_length = prompt_length
+        self.check_interval = check_interval
+        self.finished = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        import torch
+        if self.finished is None:
+            self.finished = torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+
+        if (input_ids.shape[1] - self.prompt_length) % self.check_interval == 0:
+            to_check = (~self.finished).nonzero().flatten().tolist()
+            texts = self.tokenizer.batch_decode(input_ids[to_check, self.prompt_length:], skip_special_tokens=True)
+            for i, text in zip(to_check, texts):
+                if self.matchers[i].all_found(text):
+                    self.finished[i] = True
+
+        # generate pads finished sequences, and stops once all of them are finished
+        return self.finished.clone()
+
 
 class Generator:
 
-    def __init__(self, tokenizer, model, device='cuda'):
+    def __init__(self, tokenizer, model, device='cuda', reuse_prefill=True):
         self.tokenizer = tokenizer
         self.model = model
         self.device = device
+        # With reuse_prefill, complete_prompts computes the past key values of each prompt once for all its completions,
+        # on top of the past key values of the prefix shared by all the prompts (kept for the next calls)
+        self.reuse_prefill = reuse_prefill
+        self.prefix_past = {}
 
     def complete_prompt(self, prompt, gen_args, max_new_tokens):
         input = self.tokenizer(prompt, return_tensors='pt')
@@ -21,3 +57,116 @@ class Generator:
         output = self.model.generate(**gen_args)
 
         return self.tokenizer.decode(output.sequences[0])
+
+    def base_model(self):
+        """Returns the transformers model (the base model of a PEFT model)"""
+        return self.model.get_base_model() if hasattr(self.model, 'get_base_model') else self.model
+
+    def uses_position_ids(self):
+        """Returns whether the model takes the positions of the tokens (position embeddings, eg, GPT-2 or Llama), unlike ALiBi models (BLOOM)"""
+        return 'position_ids' in inspect.signature(self.base_model().forward).parameters
+
+    def expand_past(self, past_key_values, batch_size, repeats):
+        """Repeats the past key values of each sequence of a batch repeats times (consecutively)"""
+        from transformers import Cache
+
+        model = self.base_model()
+        if isinstance(past_key_values, Cache):
+            past_key_values = past_key_values.to_legacy_cache()
+
+        # BLOOM merges the batch and attention heads dimensions
+        if hasattr(model, '_convert_to_bloom_cache'):
+            past_key_values = model._convert_to_standard_cache(past_key_values, batch_size)
+        past_key_values = tuple(tuple(tensor.repeat_interleave(repeats, dim=0) for tensor in layer_past) for layer_past in past_key_values)
+        if hasattr(model, '_convert_to_bloom_cache'):
+            past_key_values = model._convert_to_bloom_cache(past_key_values)
+        return past_key_values
+
+    def get_prefix_past(self, prefix_ids):
+        """Returns the past key values of a prefix (a list of token ids), computed once (only the last prefix is kept)"""
+        import torch
+
+        key = tuple(prefix_ids)
+        if key not in self.prefix_past:
+            device = next(self.model.parameters()).device
+            self.prefix_past = {key: self.model(input_ids=torch.tensor([prefix_ids], device=device), use_cache=True).past_key_values}
+        return self.prefix_past[key]
+
+    def complete_prompts(self, prompts, gen_args, max_new_tokens, num_return_sequences=1, matchers=None, check_interval=16, prefix=None, seed=None):
+        """
+        Samples num_return_sequences completions of each prompt with a single call to generate,
+        and returns, for each prompt, the list of its completions (generated tokens only, without the prompt).
+        Prompts are left-padded, so that the new tokens of every sequence start at the same position.
+        With matchers (one TargetMatcher per prompt), each completion stops as soon as all the targets of its prompt are found
+        (see TargetsFoundCriteria), which does not change the targets found in it.
+
+        With reuse_prefill, the prompts are run once through the model (instead of once per completion) before sampling,
+        and the tokens of prefix (text at the beginning of every prompt, eg, the beginning of the template) are run once for all the calls.
+        Prompts are then padded after the prefix, padding tokens being masked either way.
+        Unless seed is None, the random state is seeded first.
+        """
+
+        import torch
+        from transformers import StoppingCriteriaList
+
+        if seed is not None:
+            torch.manual_seed(seed)
+
+        prompts_ids = self.tokenizer(prompts).input_ids
+
+        # Number of tokens of the prefix (the prefix and the prompts may be tokenized differently where the prefix ends),
+        # the last token of each prompt is left for generate
+        prefix_length = 0
+        if self.reuse_prefill and prefix:
+            prefix_ids = self.tokenizer(prefix).input_ids
+            prefix_length = min(len(prefix_ids), min(len(prompt_ids) for prompt_ids in prompts_ids) - 1)
+            for prompt_ids in prompts_ids:
+                while prefix_length > 0 and prompt_ids[:prefix_length] != prefix_ids[:prefix_length]:
+                    prefix_length -= 1
+
+        pad_token_id = self.tokenizer.pad_token_id if self.tokenizer.pad_token_id is not None else self.tokenizer.eos_token_id
+        width = max(len(prompt_ids) for prompt_ids in prompts_ids) - prefix_length
+        input_ids = [prompt_ids[:prefix_length] + [pad_token_id] * (width + prefix_length - len(prompt_ids)) + prompt_ids[prefix_length:] for prompt_ids in prompts_ids]
+        attention_mask = [[1] * prefix_length + [0] * (width + prefix_length - len(prompt_ids)) + [1] * (len(prompt_ids) - prefix_length) for prompt_ids in prompts_ids]
+        device = next(self.model.parameters()).device
+        input_ids, attention_mask = torch.tensor(input_ids, device=device), torch.tensor(attention_mask, device=device)
+
+        gen_args = dict(
+            gen_args,
+            max_new_tokens=max_new_tokens,
+            num_return_sequences=num_return_sequences,
+            pad_token_id=pad_token_id,
+            # Scores are not used, and would hold (# sequences x vocabulary size) floats for each new token
+            output_scores=False
+        )
+        if matchers is not None:
+            sequence_matchers = [matcher for matcher in matchers for _ in range(num_return_sequences)]
+            gen_args['stopping_criteria'] = StoppingCriteriaList([TargetsFoundCriteria(self.tokenizer, sequence_matchers, input_ids.shape[1], check_interval)])
+
+        with torch.inference_mode():
+            if self.reuse_prefill:
+                past_key_values = None
+                if prefix_length > 0:
+                    past_key_values = self.expand_past(self.get_prefix_past(prefix_ids[:prefix_length]), 1, len(prompts))
+                # All the tokens but the last one of each prompt, after the prefix
+                if width > 1:
+                    # Positions skip the padding tokens, as in generate (the prefix is at positions 0 to prefix_length - 1),
+                    # so that a prompt gets the same positions whatever the length of the others
+                    position_ids = {}
+                    if self.uses_position_ids():
+                        position_ids['position_ids'] = (attention_mask.cumsum(-1) - 1).clamp(min=0)[:, prefix_length:-1]
+                    past_key_values = self.model(input_ids=input_ids[:, prefix_length:-1], attention_mask=attention_mask[:, :-1],
+                                                 past_key_values=past_key_values, use_cache=True, **position_ids).past_key_values
+                if past_key_values is not None:
+                    gen_args['past_key_values'] = self.expand_past(past_key_values, len(prompts), num_return_sequences)
+
+                # Sequences are expanded here, as the past key values
+                input_ids, attention_mask = input_ids.repeat_interleave(num_return_sequences, dim=0), attention_mask.repeat_interleave(num_return_sequences, dim=0)
+                gen_args['num_return_sequences'] = 1
+
+            output = self.model.generate(input_ids=input_ids, attention_mask=attention_mask, **gen_args)
+
+        # Sequences finished early are padded, padding tokens are skipped when decoding
+        sequences = output.sequences if gen_args.get('return_dict_in_generate') else output
+        completions = self.tokenizer.batch_decode(sequences[:, input_ids.shape[1]:], skip_special_tokens=True)
+        return [completions[i:i + num_return_sequences] for i in range(0, len(completions), num_return_sequences)]
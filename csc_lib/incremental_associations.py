@@ -0,0 +1,316 @@
+"""
+Contains the incremental maintenance of frequent itemsets when .ann files are added to, modified in or removed from a corpus
+"""
+
+import os
+import json
+import pickle
+import sqlite3
+import numpy as np
+import pandas as pd
+from collections import defaultdict
+from mlxtend.frequent_patterns import association_rules
+from csc_lib.association_rules import get_min_counts, get_itemset_counts_eclat
+
+
+class ItemsetBorder:
+    """
+    Number of files containing each frequent itemset and each itemset of the negative border
+    (the infrequent itemsets whose subsets are all frequent), maintained as in the FUP / border algorithms:
+    - the counts of these itemsets are updated with the added and removed files only
+    - as long as no itemset of the negative border becomes frequent, every frequent itemset is one of them,
+      so the new frequent itemsets and negative border are derived from the updated counts without reading the other files
+    - otherwise, the only other itemsets that can become frequent are extensions of the promoted ones: they are generated level by level
+      (as in Apriori, from the promoted itemsets only) and counted over all the files, without mining the whole corpus again
+
+    The itemsets of the negative border that are present in no file are not stored.
+    """
+
+    def __init__(self, min_counts, nb_files, frequent, negative_border):
+        self.min_counts = min_counts
+        self.nb_files = nb_files
+        self.frequent = frequent
+        self.negative_border = negative_border
+
+    @classmethod
+    def mine(cls, transactions, min_counts):
+        """Mines the frequent itemsets and the negative border of a list of transactions (sets of annotations, one per file)"""
+        files_by_ann = {}
+        for i, transaction in enumerate(transactions):
+            for ann in transaction:
+                files_by_ann.setdefault(ann, []).append(i)
+        frequent, negative_border = get_itemset_counts_eclat(files_by_ann, min_counts, negative_border=True)
+        return cls(min_counts, len(transactions), frequent, negative_border)
+
+    @staticmethod
+    def is_frequent_count(itemset, count, min_counts):
+        return count >= min_counts[0 if len(itemset) == 1 else 1]
+
+    def is_border(self, itemset):
+        """Returns True if all the subsets of an infrequent itemset are frequent"""
+        return len(itemset) == 1 or all(itemset - {ann} in self.frequent for ann in itemset)
+
+    def count_changes(self, added, removed):
+        """
+        Returns the change of count of each frequent or negative border itemset included in the added or removed transactions.
+        Transactions are mined vertically, as in Eclat: each annotation is represented by the set of changed transactions containing it
+        (a Python integer used as a bitset, added transactions first), so that each itemset is visited once for all of them.
+        """
+        transactions = list(added) + list(removed)
+        masks = defaultdict(int)
+        for i, transaction in enumerate(transactions):
+            for ann in transaction:
+                masks[ann] |= 1 << i
+        nb_added = len(added)
+        def change(mask):
+            return bin(mask & ((1 << nb_added) - 1)).count('1') - bin(mask >> nb_added).count('1')
+
+        # Every annotation is a frequent or negative border itemset, and so is every pair of frequent annotations
+        changes = {frozenset([ann]): change(mask) for ann, mask in masks.items()}
+        frequent_items = sorted(ann for ann in masks if frozenset([ann]) in self.frequent)
+        neighbors = defaultdict(set)
+        for itemset in self.frequent:
+            if len(itemset) == 2:
+                first, second = itemset
+                neighbors[first].add(second)
+                neighbors[second].add(first)
+
+        # Depth-first search of the larger included itemsets, only frequent itemsets are extended,
+        # with the annotations coming after their last one and forming a frequent pair with each of their annotations
+        stack = []
+        for i, first in enumerate(frequent_items):
+            for j in range(i + 1, len(frequent_items)):
+                second = frequent_items[j]
+                mask = masks[first] & masks[second]
+                if mask:
+                    pair = frozenset([first, second])
+                    changes[pair] = change(mask)
+                    if pair in self.frequent:
+                        stack.append((pair, mask, [ann for ann in frequent_items[j+1:] if ann in neighbors[first] and ann in neighbors[second]]))
+        while stack:
+            itemset, mask, extensions = stack.pop()
+            for i, ann in enumerate(extensions):
+                child_mask = mask & masks[ann]
+                if not child_mask:
+                    continue
+                child = itemset | {ann}
+                if child in self.frequent:
+                    changes[child] = change(child_mask)
+                    stack.append((child, child_mask, [other for other in extensions[i+1:] if other in neighbors[ann]]))
+                elif child in self.negative_border or self.is_border(child):
+                    changes[child] = change(child_mask)
+        return changes
+
+    def update(self, added, removed, min_counts, count_itemsets):
+        """
+        Updates the counts with the transactions of the added and removed files (modified files being removed, then added again).
+        When itemsets of the negative border become frequent, their extensions are counted over all the files with count_itemsets
+        (a function returning the number of files of the updated corpus containing each itemset of a list).
+        Returns the number of itemsets counted over all the files.
+        """
+
+        changes = self.count_changes(added, removed)
+        for itemset, change in changes.items():
+            if itemset in self.frequent:
+                self.frequent[itemset] += change
+            else:
+                self.negative_border[itemset] = self.negative_border.get(itemset, 0) + change
+                if self.negative_border[itemset] <= 0:
+                    del self.negative_border[itemset]
+
+        # Itemsets can only change side if their count changed (or if the threshold changed)
+        changed = changes if min_counts == self.min_counts else set(self.frequent) | set(self.negative_border)
+        demoted = [itemset for itemset in changed if itemset in self.frequent and not self.is_frequent_count(itemset, self.frequent[itemset], min_counts)]
+        promoted = [itemset for itemset in changed if itemset in self.negative_border and self.is_frequent_count(itemset, self.negative_border[itemset], min_counts)]
+        self.min_counts = min_counts
+        self.nb_files += len(added) - len(removed)
+
+        # Demoted itemsets join the negative border, which loses the itemsets having a demoted subset
+        # (a subset of a promoted itemset has at least its count, and is still frequent)
+        for itemset in demoted:
+            count = self.frequent.pop(itemset)
+            if count > 0:
+                self.negative_border[itemset] = count
+        for itemset in promoted:
+            self.frequent[itemset] = self.negative_border.pop(itemset)
+        if demoted:
+            demoted_anns = frozenset().union(*demoted)
+            self.negative_border = {itemset: count for itemset, count in self.negative_border.items() if itemset.isdisjoint(demoted_anns) or self.is_border(itemset)}
+
+        # New frequent itemsets other than the promoted ones extend them: each level is generated from the new frequent itemsets of the level below,
+        # whose other subsets are already known, and counted over all the files
+        # (an itemset of several annotations is only extended with the annotations forming a frequent pair with each of its annotations)
+        items = frozenset(ann for itemset in self.frequent if len(itemset) == 1 for ann in itemset)
+        pairs = defaultdict(set)
+        def add_pair(itemset):
+            first, second = itemset
+            pairs[first].add(second)
+            pairs[second].add(first)
+        for itemset in self.frequent:
+            if len(itemset) == 2:
+                add_pair(itemset)
+
+        levels = defaultdict(list)
+        for itemset in promoted:
+            levels[len(itemset)].append(itemset)
+        nb_counted = 0
+        while levels:
+            candidates = set()
+            for itemset in levels.pop(min(levels)):
+                extensions = items if len(itemset) == 1 else set.intersection(*[pairs[ann] for ann in itemset])
+                candidates.update(itemset | {ann} for ann in extensions - itemset)
+            candidates = [candidate for candidate in candidates if candidate not in self.frequent and candidate not in self.negative_border and self.is_border(candidate)]
+            nb_counted += len(candidates)
+            for candidate, count in zip(candidates, count_itemsets(candidates)):
+                if self.is_frequent_count(candidate, count, min_counts):
+                    self.frequent[candidate] = count
+                    levels[len(candidate)].append(candidate)
+                    if len(candidate) == 2:
+                        add_pair(candidate)
+                elif count > 0:
+                    self.negative_border[candidate] = count
+        return nb_counted
+
+    def frequent_itemsets(self):
+        """Returns the frequent itemsets as a DataFrame with 'support' and 'itemsets' columns (as get_frequent_itemsets_fpgrowth)"""
+        return pd.DataFrame({'support': [count / self.nb_files for count in self.frequent.values()], 'itemsets': list(self.frequent)})
+
+
+class TransactionStore:
+    """
+    Annotations of each file (transactions), stored in a SQLite database keyed by filename and files_stats entry (modification time and size),
+    so that a file is only written when it is added or modified, and the transactions of the modified and removed files can be read back.
+    Rows of files that changed since are kept until they are deleted (eg, once the state referring to them is replaced).
+    """
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS transactions (filename TEXT, stats TEXT, annotations TEXT, PRIMARY KEY (filename, stats)) WITHOUT ROWID')
+        self.connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def get_many(self, files_stats):
+        """Returns the transaction of each file of files_stats (filename -> stats) found in the store"""
+        transactions = {}
+        for filename, stats in files_stats.items():
+            row = self.connection.execute('SELECT annotations FROM transactions WHERE filename = ? AND stats = ?', (filename, json.dumps(stats))).fetchone()
+            if row is not None:
+                transactions[filename] = frozenset(json.loads(row[0]))
+        return transactions
+
+    def put_many(self, transactions, files_stats):
+        """Stores the transaction of each file of a dictionary (filename -> transaction), keyed by its stats in files_stats"""
+        self.connection.executemany('INSERT OR REPLACE INTO transactions VALUES (?, ?, ?)',
+                                    [(filename, json.dumps(files_stats[filename]), json.dumps(sorted(transaction))) for filename, transaction in transactions.items()])
+        self.connection.commit()
+
+    def delete_many(self, files_stats):
+        """Removes the transaction of each file of files_stats (filename -> stats)"""
+        self.connection.executemany('DELETE FROM transactions WHERE filename = ? AND stats = ?', [(filename, json.dumps(stats)) for filename, stats in files_stats.items()])
+        self.connection.commit()
+
+    def prune(self, files_stats):
+        """Removes the transactions of the files that are not in files_stats, or whose stats changed"""
+        stale = [(filename, stats) for filename, stats in self.connection.execute('SELECT filename, stats FROM transactions')
+                 if filename not in files_stats or json.dumps(files_stats[filename]) != stats]
+        self.connection.executemany('DELETE FROM transactions WHERE filename = ? AND stats = ?', stale)
+        self.connection.commit()
+
+
+def count_itemsets_in_corpus(corpus_index, itemsets):
+    """Returns the number of files of a CorpusIndex containing each itemset of a list, intersecting the (memory-mapped) inverted postings of its annotations"""
+    vocabulary_ids = {ann: i for i, ann in enumerate(corpus_index.vocabulary)}
+    docs_by_ann = {}
+    def docs(ann):
+        if ann not in docs_by_ann:
+            i = vocabulary_ids.get(ann)
+            docs_by_ann[ann] = np.empty(0, dtype=np.int32) if i is None else np.unique(corpus_index.inverted_indices[corpus_index.inverted_indptr[i]:corpus_index.inverted_indptr[i + 1]])
+        return docs_by_ann[ann]
+
+    counts = []
+    for itemset in itemsets:
+        anns = sorted(itemset, key=lambda ann: len(docs(ann)))
+        common = docs(anns[0])
+        for ann in anns[1:]:
+            common = np.intersect1d(common, docs(ann), assume_unique=True)
+        counts.append(len(common))
+    return counts
+
+
+def get_associations_incremental(corpus_index, state_path:str, min_docs:int, min_confidence:float):
+    """
+    Same as get_associations, but the frequent itemsets of the previous run (saved in state_path) are updated
+    with the added, modified and removed files only (see ItemsetBorder). The corpus is only mined again when the filter configuration changed,
+    or on the first run. The annotations of each file are stored once, next to state_path (see TransactionStore),
+    so that the counts of the files modified or removed later can be removed.
+
+    Input:
+    corpus_index (CorpusIndex): The index of the folder of .ann files.
+    state_path (str): The file where the frequent itemsets and their negative border are saved between runs.
+    min_docs (int): The minimum number of documents an annotation must appear in to be considered.
+    min_confidence (float): The minimum confidence required for an association rule.
+
+    Output:
+    rules (pd.DataFrame): A DataFrame of association rules.
+    """
+
+    nb_files = len(corpus_index.filenames)
+    min_counts = get_min_counts(min_docs / nb_files, nb_files)
+    files_stats = corpus_index.files_stats
+    doc_ids = {filename: i for i, filename in enumerate(corpus_index.filenames)}
+
+    state = None
+    if os.path.isfile(state_path):
+        with open(state_path, 'rb') as f:
+            state = pickle.load(f)
+        if state['filter_hash'] != corpus_index.filter_hash:
+            state = None
+
+    with TransactionStore(f'{os.path.splitext(state_path)[0]}_transactions.sqlite') as store:
+        border = None
+        if state is not None:
+            previous_stats = state['files_stats']
+            if 'transactions' in state:
+                # State saved with all the transactions (previous format)
+                store.put_many(state['transactions'], previous_stats)
+            removed = {filename: stats for filename, stats in previous_stats.items() if files_stats.get(filename) != stats}
+            added = [filename for filename in files_stats if previous_stats.get(filename) != files_stats[filename]]
+            removed_transactions = store.get_many(removed)
+            if len(removed_transactions) == len(removed):
+                print(f"Updating frequent itemsets: {len(added)} new or modified files, {len(removed)} modified or removed files.")
+                added_transactions = {filename: frozenset(corpus_index.annotations(doc_ids[filename])) for filename in added}
+                store.put_many(added_transactions, files_stats)
+                border = state['border']
+                nb_counted = border.update(list(added_transactions.values()), list(removed_transactions.values()), min_counts,
+                                           lambda itemsets: count_itemsets_in_corpus(corpus_index, itemsets))
+                if nb_counted:
+                    print(f"The negative border moved up, {nb_counted} extensions of the new frequent itemsets counted over all files.")
+            else:
+                print("The annotations of modified or removed files are missing, mining all files again...")
+
+        mined = border is None
+        if mined:
+            transactions = {filename: frozenset(corpus_index.annotations(doc)) for filename, doc in doc_ids.items()}
+            store.put_many(transactions, files_stats)
+            border = ItemsetBorder.mine(list(transactions.values()), min_counts)
+
+        tmp_path = f'{state_path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump({'filter_hash': corpus_index.filter_hash, 'files_stats': files_stats, 'border': border}, f)
+        os.replace(tmp_path, state_path)
+        # Transactions of the previous state are only removed once it is replaced
+        if mined:
+            store.prune(files_stats)
+        else:
+            store.delete_many(removed)
+
+    return association_rules(border.frequent_itemsets(), min_threshold=min_confidence)
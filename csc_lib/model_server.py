@@ -0,0 +1,283 @@
+import os
+import time
+import queue
+import socket
+import ipaddress
+import threading
+from collections import defaultdict
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+import numpy as np
+from tqdm import tqdm
+from csc_lib.config import MODEL_SERVER_ADDRESS, MODEL_SERVER_AUTHKEY, MODEL_SERVER_BATCH_WAIT, GENERATION_BATCH_SIZE, PPL_BATCH_SIZE
+
+# Requests and replies are Python objects (dictionaries) pickled over the connection: only clients trusted by the server can be allowed to connect,
+# a Unix socket being only accessible to the user running the server and a TCP address requiring an authkey (see check_server_address)
+
+
+def parse_address(address):
+    """Returns the address of a model server: (host, port) for 'host:port', else the path of a Unix socket"""
+    host, _, port = address.rpartition(':')
+    if host and port.isdigit():
+        return host, int(port)
+    return address
+
+
+def is_loopback(host):
+    """Returns whether all the addresses of a host are loopback addresses (eg, localhost or 127.0.0.1)"""
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(host, None)}
+    except socket.gaierror:
+        return False
+    return all(ipaddress.ip_address(address.split('%')[0]).is_loopback for address in addresses)
+
+
+def check_server_address(address, authkey, allow_remote=False):
+    """
+    Raises a ValueError unless a model server can safely listen on address (see parse_address): anyone able to connect can run code in the server,
+    so a TCP address needs an authkey, and a host other than a loopback address (eg, 0.0.0.0) also needs allow_remote.
+    """
+    if isinstance(address, str):
+        return
+    host, port = address
+    if authkey is None:
+        raise ValueError(f"A model server listening on {host}:{port} needs an authkey (MODEL_SERVER_AUTHKEY in config.py), or use a Unix socket.")
+    if not allow_remote and not is_loopback(host):
+        raise ValueError(f"{host} is not a loopback address: other machines could connect to the model server, pass allow_remote to allow it.")
+
+
+class ModelServer:
+    """
+    Keeps models loaded and serves them to clients (see ModelClient), one thread per connection.
+    Requests are queued and run by a single thread, which batches the requests received meanwhile from all the clients:
+    - 'score_perplexity': texts of all the requests for the same models are scored at once (see classification.get_batch_ppls)
+    - 'generate': unseeded calls with the same generation arguments are sampled at once, up to generation_batch_size sequences.
+      Seeded calls are sampled on their own, so that their completions do not depend on the other clients.
+    """
+
+    def __init__(self, tokenizer, models, batch_wait=MODEL_SERVER_BATCH_WAIT, generation_batch_size=GENERATION_BATCH_SIZE, info=None):
+        from csc_lib.generation import Generator
+
+        self.tokenizer = tokenizer
+        self.models = models
+        self.generators = {name: Generator(tokenizer, model) for name, model in models.items()}
+        self.fingerprints = {}
+        self.batch_wait = batch_wait
+        self.generation_batch_size = generation_batch_size
+        self.info = dict(info or {}, models=list(models))
+        self.requests = queue.Queue()
+
+    def serve(self, address=MODEL_SERVER_ADDRESS, authkey=MODEL_SERVER_AUTHKEY, allow_remote=False):
+        """Accepts connections at address (see parse_address and check_server_address) and runs the requests until interrupted"""
+        address = parse_address(address)
+        check_server_address(address, authkey, allow_remote)
+        if isinstance(address, str):
+            os.makedirs(os.path.dirname(os.path.abspath(address)), exist_ok=True)
+            if os.path.exists(address):
+                # Socket left by a server that was not stopped properly
+                os.remove(address)
+            # The socket is created only accessible to the user running the server
+            umask = os.umask(0o077)
+            try:
+                listener = Listener(address, authkey=authkey)
+            finally:
+                os.umask(umask)
+        else:
+            listener = Listener(address, authkey=authkey)
+        with listener:
+            threading.Thread(target=self.accept, args=(listener,), daemon=True).start()
+            print(f"Serving {', '.join(self.models)} on {address}.")
+            while True:
+                self.run(self.next_requests())
+
+    def accept(self, listener):
+        while True:
+            try:
+                connection = listener.accept()
+            except AuthenticationError:
+                continue
+            except OSError:
+                # Closed listener
+                return
+            threading.Thread(target=self.handle, args=(connection,), daemon=True).start()
+
+    def handle(self, connection):
+        """Queues the requests of a client one at a time and sends back their replies"""
+        with connection:
+            while True:
+                try:
+                    request = connection.recv()
+                except (EOFError, OSError):
+                    return
+                reply = queue.Queue(maxsize=1)
+                self.requests.put((request, reply))
+                try:
+                    connection.send(reply.get())
+                except OSError:
+                    # Client interrupted before the reply
+                    return
+
+    def next_requests(self):
+        """Waits for a request, then returns it along with the requests received up to batch_wait seconds later"""
+        pending = [self.requests.get()]
+        deadline = time.monotonic() + self.batch_wait
+        while True:
+            try:
+                pending.append(self.requests.get(timeout=max(0, deadline - time.monotonic())))
+            except queue.Empty:
+                return pending
+
+    def run(self, pending):
+        """Runs pending requests (request, reply queue), batched by endpoint and arguments"""
+        groups = defaultdict(list)
+        for request, reply in pending:
+            endpoint = request.get('endpoint')
+            if endpoint == 'score_perplexity':
+                key = (endpoint, tuple(request['models']), request['batch_size'])
+            elif endpoint == 'generate' and request['seed'] is None:
+                key = (endpoint, request['model'], repr(sorted(request['gen_args'].items())), request['max_new_tokens'], request['num_return_sequences'],
+                       request['matchers'] is None, request['check_interval'], request['prefix'])
+            else:
+                key = (endpoint, id(request))
+            groups[key].append((request, reply))
+
+        for (endpoint, *_), group in groups.items():
+            try:
+                if endpoint == 'score_perplexity':
+                    results = self.score_perplexity(group)
+                elif endpoint == 'generate':
+                    results = self.generate(group)
+                elif endpoint == 'fingerprint':
+                    results = [self.fingerprint(group[0][0]['model'])]
+                elif endpoint == 'info':
+                    results = [self.info]
+                else:
+                    raise ValueError(f"Unknown endpoint '{endpoint}'.")
+                replies = [{'result': result} for result in results]
+            except Exception as e:
+                replies = [{'error': f"{type(e).__name__}: {e}"}] * len(group)
+            for (_, reply), result in zip(group, replies):
+                reply.put(result)
+
+    def score_perplexity(self, group):
+        """Scores the texts of all the requests of the group at once (each text once), and returns the perplexities of each request"""
+        from csc_lib.classification import get_batch_ppls
+
+        first = group[0][0]
+        texts = list(dict.fromkeys(text for request, _ in group for text in request['texts']))
+        ppls = get_batch_ppls(texts, [self.models[name] for name in first['models']], self.tokenizer, first['batch_size'], workers=1)
+        columns = {text: column for column, text in enumerate(texts)}
+        return [ppls[:, [columns[text] for text in request['texts']]] for request, _ in group]
+
+    def generate(self, group):
+        """Completes the prompts of the requests of the group with as few calls to the model as possible, and returns the completions of each request"""
+        completions = []
+        start = 0
+        while start < len(group):
+            # Requests sampled in the same call (at least one)
+            end = start + 1
+            nb_sequences = len(group[start][0]['prompts']) * group[start][0]['num_return_sequences']
+            while end < len(group) and nb_sequences + len(group[end][0]['prompts']) * group[end][0]['num_return_sequences'] <= self.generation_batch_size:
+                nb_sequences += len(group[end][0]['prompts']) * group[end][0]['num_return_sequences']
+                end += 1
+
+            requests = [request for request, _ in group[start:end]]
+            first = requests[0]
+            call_completions = self.generators[first['model']].complete_prompts(
+                [prompt for request in requests for prompt in request['prompts']], first['gen_args'], first['max_new_tokens'],
+                num_return_sequences=first['num_return_sequences'],
+                matchers=None if first['matchers'] is None else [matcher for request in requests for matcher in request['matchers']],
+                check_interval=first['check_interval'], prefix=first['prefix'], seed=first['seed'])
+            for request in requests:
+                completions.append(call_completions[:len(request['prompts'])])
+                call_completions = call_completions[len(request['prompts']):]
+            start = end
+        return completions
+
+    def fingerprint(self, name):
+        """Returns the fingerprint of a model (see ppl_cache.get_model_fingerprint), computed once per model"""
+        from csc_lib.ppl_cache import get_model_fingerprint
+
+        if name not in self.fingerprints:
+            self.fingerprints[name] = get_model_fingerprint(self.models[name], self.tokenizer)
+        return self.fingerprints[name]
+
+
+class ModelClient:
+    """Connection to a ModelServer, whose requests are sent one at a time (a lock allows threads to share the client)"""
+
+    def __init__(self, address=MODEL_SERVER_ADDRESS, authkey=MODEL_SERVER_AUTHKEY):
+        try:
+            self.connection = Client(parse_address(address), authkey=authkey)
+        except (FileNotFoundError, ConnectionRefusedError) as e:
+            raise ConnectionError(f"No model server at {address}, start one with serve_models.py.") from e
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def request(self, endpoint, **kwargs):
+        with self.lock:
+            self.connection.send(dict(kwargs, endpoint=endpoint))
+            reply = self.connection.recv()
+        if 'error' in reply:
+            raise RuntimeError(f"Model server: {reply['error']}")
+        return reply['result']
+
+    def info(self):
+        """Returns the description of the server (models served, paths, precision...)"""
+        return self.request('info')
+
+    def fingerprint(self, model):
+        return self.request('fingerprint', model=model)
+
+    def score_perplexity(self, texts, models, batch_size=PPL_BATCH_SIZE, texts_per_request=1024):
+        """
+        Returns an array with the perplexity of each text (columns) for each of the models (rows, names of models of the server), as classification.get_batch_ppls.
+        Texts are sent by requests of texts_per_request texts, so that the server also runs the requests of other clients in the meantime.
+        """
+        texts = list(texts)
+        starts = range(0, len(texts), texts_per_request)
+        ppls = [self.request('score_perplexity', texts=texts[start:start + texts_per_request], models=list(models), batch_size=batch_size)
+                for start in tqdm(starts, desc='Calculating perplexities (model server)...')]
+        return np.concatenate(ppls, axis=1) if ppls else np.empty((len(models), 0))
+
+    def generate(self, model, prompts, gen_args, max_new_tokens, num_return_sequences=1, matchers=None, check_interval=16, prefix=None, seed=None):
+        """Returns the completions of each prompt sampled from a model of the server, as Generator.complete_prompts"""
+        return self.request('generate', model=model, prompts=list(prompts), gen_args=gen_args, max_new_tokens=max_new_tokens, num_return_sequences=num_return_sequences,
+                            matchers=matchers, check_interval=check_interval, prefix=prefix, seed=seed)
+
+
+class RemoteModel:
+    """Model of a ModelServer, scored by classification.get_batch_ppls and cached by ppl_cache.PerplexityCache as a loaded model"""
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def fingerprint(self):
+        return self.client.fingerprint(self.name)
+
+
+class RemoteGenerator:
+    """Generator (see generation.Generator) sampling from a model of a ModelServer"""
+
+    def __init__(self, client, name='ft'):
+        self.client = client
+        self.name = name
+
+    def complete_prompts(self, prompts, gen_args, max_new_tokens, num_return_sequences=1, matchers=None, check_interval=16, prefix=None, seed=None):
+        return self.client.generate(self.name, prompts, gen_args, max_new_tokens, num_return_sequences, matchers, check_interval, prefix, seed)
+
+
+def connect_models(address=MODEL_SERVER_ADDRESS, authkey=MODEL_SERVER_AUTHKEY):
+    """Connects to a model server, and returns the client, the base model and the fine-tuned model (see RemoteModel)"""
+    client = ModelClient(address, authkey)
+    print(f"Using the models of the server at {address}: {client.info()}")
+    return client, RemoteModel(client, 'base'), RemoteModel(client, 'ft')
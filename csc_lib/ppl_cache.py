@@ -0,0 +1,151 @@
+"""
+Contains a persistent cache of perplexities, keyed by a fingerprint of the model and the exact text scored
+"""
+
+import os
+import json
+import sqlite3
+import hashlib
+import warnings
+from collections import OrderedDict
+from csc_lib.model_server import RemoteModel
+
+# torch and peft are only imported when a model is fingerprinted
+
+
+def hash_value(value, h):
+    """Updates the hash h with the raw bytes of a tensor (integer values and scale of a quantized tensor), of a tuple of tensors or with a data type"""
+    import torch
+    if isinstance(value, (tuple, list)):
+        for item in value:
+            hash_value(item, h)
+    elif isinstance(value, torch.Tensor):
+        if value.is_quantized:
+            h.update(str(value.q_scale()).encode('utf-8'))
+            value = value.int_repr()
+        h.update(value.detach().cpu().contiguous().flatten().view(torch.uint8).numpy().tobytes())
+    elif value is not None:
+        h.update(str(value).encode('utf-8'))
+
+
+def hash_tensors(state_dict, h):
+    """Updates the hash h with the names and the raw bytes of the tensors of a state dict (including the packed weights of quantized layers)"""
+    for name, value in sorted(state_dict.items()):
+        h.update(name.encode('utf-8'))
+        hash_value(value, h)
+
+
+def get_model_fingerprint(model, tokenizer):
+    """
+    Returns a fingerprint of a model (and of the tokenizer used with it), which changes whenever its perplexities could change:
+    - name or path of the model, revision (commit hash) when it was loaded from the Hub, data type, tokenizer
+    - for PEFT models, the configuration and the weights of the adapters
+    - for models that were not loaded from the Hub (eg, local fine-tuned models), all the weights
+    """
+
+    from peft import PeftModel, get_peft_model_state_dict
+
+    base_model = model.get_base_model() if isinstance(model, PeftModel) else model
+    revision = getattr(base_model.config, '_commit_hash', None)
+    description = {
+        'model': base_model.config._name_or_path,
+        'revision': revision,
+        'dtype': str(base_model.dtype),
+        'tokenizer': tokenizer.name_or_path,
+        'vocabulary_size': len(tokenizer)
+    }
+
+    if getattr(base_model, 'quantization', None) is not None:
+        description['quantization'] = base_model.quantization
+    if isinstance(model, PeftModel):
+        description['adapters'] = {name: config.to_dict() for name, config in model.peft_config.items()}
+
+    h = hashlib.sha256()
+    h.update(json.dumps(description, sort_keys=True, default=lambda o: sorted(o) if isinstance(o, set) else str(o)).encode('utf-8'))
+    if isinstance(model, PeftModel):
+        with warnings.catch_warnings():
+            # peft warns when it cannot check the vocabulary of the base model, which is not needed here
+            warnings.simplefilter('ignore', UserWarning)
+            for name in sorted(model.peft_config):
+                hash_tensors(get_peft_model_state_dict(model, adapter_name=name), h)
+
+    if revision is None:
+        hash_tensors(base_model.state_dict(), h)
+    return h.hexdigest()
+
+
+class PerplexityCache:
+    """
+    Perplexities stored in a SQLite database, keyed by model fingerprint (see get_model_fingerprint) and text,
+    with an in-memory LRU front holding the memory_size most recently used entries.
+    Hits (in memory or on disk) and misses are counted.
+    """
+
+    def __init__(self, path, memory_size=100_000):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS ppls (model TEXT, text TEXT, ppl REAL, PRIMARY KEY (model, text)) WITHOUT ROWID')
+        self.connection.commit()
+        self.memory = OrderedDict()
+        self.memory_size = memory_size
+        self.fingerprints = {}
+        self.memory_hits, self.disk_hits, self.misses = 0, 0, 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def fingerprint(self, model, tokenizer):
+        """Returns the fingerprint of a model, computed once per model"""
+        if id(model) not in self.fingerprints:
+            # Models of a model server are fingerprinted by the server
+            self.fingerprints[id(model)] = model.fingerprint() if isinstance(model, RemoteModel) else get_model_fingerprint(model, tokenizer)
+        return self.fingerprints[id(model)]
+
+    def remember(self, key, ppl):
+        self.memory[key] = ppl
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.memory_size:
+            self.memory.popitem(last=False)
+
+    def get_many(self, fingerprint, texts, chunk_size=500):
+        """Returns a dictionary with the cached perplexity of each text found in the cache (texts are looked up by chunks)"""
+        found, to_read = {}, []
+        for text in dict.fromkeys(texts):
+            if (fingerprint, text) in self.memory:
+                self.memory.move_to_end((fingerprint, text))
+                found[text] = self.memory[(fingerprint, text)]
+            else:
+                to_read.append(text)
+        self.memory_hits += len(found)
+
+        disk_hits = 0
+        for start in range(0, len(to_read), chunk_size):
+            chunk = to_read[start:start + chunk_size]
+            rows = self.connection.execute(f"SELECT text, ppl FROM ppls WHERE model = ? AND text IN ({', '.join('?' * len(chunk))})", [fingerprint] + chunk)
+            for text, ppl in rows:
+                # SQLite stores NaN as NULL
+                ppl = float('nan') if ppl is None else ppl
+                found[text] = ppl
+                self.remember((fingerprint, text), ppl)
+                disk_hits += 1
+        self.disk_hits += disk_hits
+        self.misses += len(to_read) - disk_hits
+
+        return found
+
+    def put_many(self, fingerprint, ppls:dict):
+        """Stores the perplexity of each text of a dictionary"""
+        self.connection.executemany('INSERT OR REPLACE INTO ppls VALUES (?, ?, ?)', [(fingerprint, text, float(ppl)) for text, ppl in ppls.items()])
+        self.connection.commit()
+        for text, ppl in ppls.items():
+            self.remember((fingerprint, text), float(ppl))
+
+    def stats(self):
+        return {'memory_hits': self.memory_hits, 'disk_hits': self.disk_hits, 'misses': self.misses}
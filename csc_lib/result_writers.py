@@ -0,0 +1,236 @@
+"""
+Contains writers used to stream results to disk instead of keeping them in memory
+"""
+
+import os
+import io
+import csv
+import json
+import shutil
+import tempfile
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+class SortedWriter:
+    """
+    Streams rows to a file sorted by a key taking few distinct values (eg, the number of documents and annotations of a rare combination),
+    without keeping all the rows in memory. Rows are buffered by key, in order of arrival, and spilled to one temporary file per key
+    (in a directory next to the output file) when the buffer exceeds max_buffer_bytes.
+    Subclasses define the format: how rows are buffered (encode_row), spilled (spill_rows) and written to the output (open_output, write_rows, copy_spilled).
+    """
+
+    spill_extension = ''
+
+    def __init__(self, path, max_buffer_bytes=512 * 2**20, descending=True):
+        self.path = path
+        self.max_buffer_bytes = max_buffer_bytes
+        self.descending = descending
+        self.buffers = {}
+        self.buffer_bytes = 0
+        self.spill_dir = None
+        self.spilled_keys = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.remove_spilled()
+
+    def encode_row(self, row):
+        """Returns the buffered form of a row and its size (in bytes)"""
+        raise NotImplementedError
+
+    def spill_rows(self, key, rows):
+        """Appends buffered rows to the temporary file of their key"""
+        raise NotImplementedError
+
+    def open_output(self):
+        """Returns the output (a context manager), to which write_rows and copy_spilled write"""
+        raise NotImplementedError
+
+    def write_rows(self, output, rows):
+        raise NotImplementedError
+
+    def copy_spilled(self, output, key):
+        """Copies the rows spilled for a key to the output"""
+        raise NotImplementedError
+
+    def close_spilled(self):
+        """Releases what spill_rows keeps open (nothing by default)"""
+
+    def write(self, key, row):
+        row, size = self.encode_row(row)
+        self.buffers.setdefault(key, []).append(row)
+        self.buffer_bytes += size
+        if self.buffer_bytes > self.max_buffer_bytes:
+            self.spill()
+
+    def spill(self):
+        """Appends the buffered rows to one temporary file per key"""
+        if self.spill_dir is None:
+            self.spill_dir = tempfile.mkdtemp(prefix='csc_spill_', dir=os.path.dirname(os.path.abspath(self.path)))
+        for key, rows in self.buffers.items():
+            self.spill_rows(key, rows)
+            self.spilled_keys.add(key)
+        self.buffers = {}
+        self.buffer_bytes = 0
+
+    def spill_file(self, key):
+        return os.path.join(self.spill_dir, '_'.join(map(str, key)) + self.spill_extension)
+
+    def remove_spilled(self):
+        self.close_spilled()
+        if self.spill_dir is not None:
+            shutil.rmtree(self.spill_dir)
+
+    def close(self):
+        """Writes the rows sorted by key (rows sharing the same key stay in order of arrival)"""
+        with self.open_output() as output:
+            for key in sorted(self.spilled_keys | set(self.buffers), reverse=self.descending):
+                if key in self.spilled_keys:
+                    self.copy_spilled(output, key)
+                if key in self.buffers:
+                    self.write_rows(output, self.buffers[key])
+        self.remove_spilled()
+
+
+class SortedCSVWriter(SortedWriter):
+    """
+    Streams rows to a CSV file (formatted as with DataFrame.to_csv) sorted by a key, as SortedWriter.
+    The index of each row is its order of arrival.
+    """
+
+    spill_extension = '.csv'
+
+    def __init__(self, path, columns, max_buffer_bytes=512 * 2**20, descending=True):
+        super().__init__(path, max_buffer_bytes, descending)
+        self.columns = columns
+        self.nb_rows = 0
+
+    @staticmethod
+    def format_row(row):
+        line = io.StringIO()
+        csv.writer(line, lineterminator=os.linesep).writerow(row)
+        return line.getvalue()
+
+    def encode_row(self, row):
+        line = self.format_row([self.nb_rows] + list(row))
+        self.nb_rows += 1
+        return line, len(line)
+
+    def spill_rows(self, key, lines):
+        with open(self.spill_file(key), 'a', newline='', encoding='utf-8') as f:
+            f.writelines(lines)
+
+    def open_output(self):
+        f = open(self.path, 'w', newline='', encoding='utf-8')
+        f.write(self.format_row([''] + list(self.columns)))
+        return f
+
+    def write_rows(self, f, lines):
+        f.writelines(lines)
+
+    def copy_spilled(self, f, key):
+        with open(self.spill_file(key), 'r', newline='', encoding='utf-8') as spilled:
+            shutil.copyfileobj(spilled, f)
+
+
+class JSONLinesWriter:
+    """
+    Appends records (JSON-serializable dictionaries) to a JSON Lines file, one per line.
+    Records are flushed to disk by each call to write, so that a crash loses no record written before it.
+    With append, records are added to the existing file (a last line cut short by a crash is dropped), else the file is emptied.
+    """
+
+    def __init__(self, path, append=False):
+        if append and os.path.isfile(path):
+            with open(path, 'rb+') as f:
+                # Looks for the end of the last complete line, from the end of the file
+                end = f.seek(0, os.SEEK_END)
+                while end > 0:
+                    start = max(0, end - 65536)
+                    f.seek(start)
+                    newline = f.read(end - start).rfind(b'\n')
+                    if newline != -1:
+                        end = start + newline + 1
+                        break
+                    end = start
+                f.truncate(end)
+        self.file = open(path, 'a' if append else 'w', encoding='utf-8')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, records):
+        self.file.write(''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+
+def read_json_lines(path):
+    """Yields the records of a JSON Lines file, except a last line cut short by a crash"""
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if not line.endswith('\n'):
+                break
+            yield json.loads(line)
+
+
+def estimate_size(value):
+    """Returns a rough estimate of the size (in bytes) of a value of a row: strings and numbers, or lists of them"""
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return 8 + sum(estimate_size(item) for item in value)
+    return len(value) if isinstance(value, str) else 8
+
+
+class SortedParquetWriter(SortedWriter):
+    """
+    Streams rows to a Parquet file sorted by a key, as SortedWriter (rows are spilled to one temporary Parquet file per key).
+    Each row group of the output file only holds rows of the same key, so that readers can skip the row groups of other keys.
+    """
+
+    spill_extension = '.parquet'
+
+    def __init__(self, path, schema, max_buffer_bytes=512 * 2**20, descending=True, metadata=None, row_group_size=100_000):
+        super().__init__(path, max_buffer_bytes, descending)
+        self.schema = schema.with_metadata(metadata) if metadata else schema
+        self.row_group_size = row_group_size
+        self.spill_writers = {}
+
+    def encode_row(self, row):
+        return row, estimate_size(row)
+
+    def table(self, rows):
+        return pa.Table.from_pydict({field.name: [row[i] for row in rows] for i, field in enumerate(self.schema)}, schema=self.schema)
+
+    def spill_rows(self, key, rows):
+        # Spill files stay open, each spill adding row groups to them
+        if key not in self.spill_writers:
+            self.spill_writers[key] = pq.ParquetWriter(self.spill_file(key), self.schema)
+        self.spill_writers[key].write_table(self.table(rows), row_group_size=self.row_group_size)
+
+    def close_spilled(self):
+        for writer in self.spill_writers.values():
+            writer.close()
+        self.spill_writers = {}
+
+    def open_output(self):
+        return pq.ParquetWriter(self.path, self.schema)
+
+    def write_rows(self, writer, rows):
+        writer.write_table(self.table(rows), row_group_size=self.row_group_size)
+
+    def copy_spilled(self, writer, key):
+        self.spill_writers.pop(key).close()
+        for batch in pq.ParquetFile(self.spill_file(key)).iter_batches(batch_size=self.row_group_size):
+            writer.write_table(pa.Table.from_batches([batch]), row_group_size=self.row_group_size)
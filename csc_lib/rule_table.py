@@ -0,0 +1,38 @@
+"""
+Contains vectorised operations on tables of association rules (with antecedents and consequents columns) and other tables of itemsets:
+the lengths of the itemsets are computed once, for whole columns, and rules are selected with boolean masks instead of iterating over rows
+"""
+
+import numpy as np
+import pandas as pd
+
+
+def get_lengths(column:pd.Series):
+    """Returns the length of each itemset (or list) of a column"""
+    return pd.Series(np.fromiter(map(len, column), dtype=np.int64, count=len(column)), index=column.index)
+
+
+def get_rule_lengths(df:pd.DataFrame):
+    """Returns the number of annotations of each rule (antecedents + consequents), read from the 'length' column if the table has one"""
+    if 'length' in df.columns:
+        return df['length']
+    return get_lengths(df['antecedents']) + get_lengths(df['consequents'])
+
+
+def add_rule_lengths(df:pd.DataFrame):
+    """Adds the number of antecedents, of consequents and of annotations ('length') of each rule"""
+    df['# antecedents'] = get_lengths(df['antecedents'])
+    df['# consequents'] = get_lengths(df['consequents'])
+    df['length'] = df['# antecedents'] + df['# consequents']
+    return df
+
+
+def get_length_mask(df:pd.DataFrame, lengths):
+    """Returns the boolean mask of the rules of the given number(s) of annotations"""
+    lengths = [lengths] if isinstance(lengths, (int, np.integer)) else list(lengths)
+    return get_rule_lengths(df).isin(lengths).to_numpy()
+
+
+def select_rules(df:pd.DataFrame, lengths):
+    """Returns the rules of the given number(s) of annotations"""
+    return df[get_length_mask(df, lengths)]
@@ -0,0 +1,76 @@
+"""
+Contains a matcher used to find which targets (eg, consequents of association rules) appear in generated texts
+"""
+
+import re
+import unicodedata
+import ahocorasick
+
+# Unicode blocks of combining marks (accents once characters are decomposed)
+COMBINING_MARKS = re.compile('[\u0300-\u036f\u1ab0-\u1aff\u1dc0-\u1dff\u20d0-\u20ff\ufe20-\ufe2f]')
+
+# Below this number of distinct targets, searching each target with str.find is faster than running the automaton
+MIN_PATTERNS_AUTOMATON = 8
+
+
+def normalize_text(text, ignore_case=False, ignore_accents=False):
+    """Returns the text in lower case and/or without accents (eg, 'Écho' -> 'echo'), so that targets can be found regardless of them"""
+    if ignore_accents:
+        text = unicodedata.normalize('NFC', COMBINING_MARKS.sub('', unicodedata.normalize('NFD', text)))
+    if ignore_case:
+        text = text.casefold()
+    return text
+
+
+class TargetMatcher:
+    """
+    Finds which targets appear in a text, with all the targets compiled once (eg, the targets of a rule, or all the targets of a file of association rules).
+    Texts are scanned in a single pass with an Aho-Corasick automaton, or with str.find for each target when there are only a few of them.
+    Without normalization, a target is found if and only if text.find(target) != -1.
+    With ignore_case and/or ignore_accents, targets and texts are normalized before matching (see normalize_text).
+    """
+
+    def __init__(self, targets, ignore_case=False, ignore_accents=False):
+        self.ignore_case = ignore_case
+        self.ignore_accents = ignore_accents
+
+        # Several targets can share the same normalized form
+        self.targets_by_pattern = {}
+        for target in targets:
+            self.targets_by_pattern.setdefault(self.normalize(target), set()).add(target)
+        self.nb_targets = sum(len(pattern_targets) for pattern_targets in self.targets_by_pattern.values())
+
+        # An empty target is found in any text
+        self.always_found = self.targets_by_pattern.pop('', set())
+
+        self.automaton = None
+        if len(self.targets_by_pattern) >= MIN_PATTERNS_AUTOMATON:
+            self.automaton = ahocorasick.Automaton()
+            for pattern, pattern_targets in self.targets_by_pattern.items():
+                self.automaton.add_word(pattern, pattern_targets)
+            self.automaton.make_automaton()
+
+    def normalize(self, text):
+        return normalize_text(text, self.ignore_case, self.ignore_accents)
+
+    def find(self, text, targets=None):
+        """Returns the set of targets found in the text (only among the given targets, if any)"""
+        text = self.normalize(text)
+        found = set(self.always_found)
+
+        if self.automaton is None:
+            for pattern, pattern_targets in self.targets_by_pattern.items():
+                if text.find(pattern) != -1:
+                    found.update(pattern_targets)
+        else:
+            for _, pattern_targets in self.automaton.iter(text):
+                found.update(pattern_targets)
+                # No need to read the rest of the text once all the targets are found
+                if len(found) == self.nb_targets:
+                    break
+
+        return found if targets is None else found.intersection(targets)
+
+    def all_found(self, text):
+        """Returns True if every target appears in the text"""
+        return len(self.find(text)) == self.nb_targets
@@ -1,10 +1,17 @@
+import os
+import pickle
+import tempfile
+import multiprocessing
+import numpy as np
 from itertools import combinations
+from csc_lib.document_sets import DocumentSets
 
 class TreeNode:
-    def __init__(self, annotation, dico_anns_filtered, parent=None):
+    def __init__(self, annotation, doc_sets, parent=None, docs=None, nb_docs=None):
         self.annotation = annotation
-        self.dico_anns_filtered = dico_anns_filtered
-        self.docs = self.get_docs_containing_combination(parent)
+        self.doc_sets = doc_sets
+        self.docs = self.get_docs_containing_combination(parent) if docs is None else docs
+        self.nb_docs = doc_sets.count(self.docs) if nb_docs is None else nb_docs
         self.children = []
         self.parent = parent
 
@@ -13,39 +20,48 @@ class TreeNode:
 
     def get_docs_containing_combination(self, parent):
         if parent is None:
-            return set(self.dico_anns_filtered[self.annotation])
+            return self.doc_sets.get(self.annotation)
         else:
-            return parent.docs.intersection(set(self.dico_anns_filtered[self.annotation]))
+            return self.doc_sets.intersection(parent.docs, self.annotation)
 
     def to_dict(self):
         return {
             'annotation': self.annotation,
-            'docs': list(self.docs),
+            'docs': self.doc_sets.decode(self.docs),
             'children': [child.to_dict() for child in self.children]
         }
 
 
-def build_tree_recursive(annotations, parent, current_depth, max_depth, threshold_number_docs, dico_anns_filtered):
-    """Recursively builds a tree representing combinations of annotations where each node represents an annotation"""
+def build_tree_recursive(annotations, parent, current_depth, max_depth, threshold_number_docs, doc_sets, canonical_order=True):
+    """
+    Recursively builds a tree representing combinations of annotations where each node represents an annotation
+    Annotations are given as row IDs of the postings stored in doc_sets
+
+    With canonical_order, each child is only expanded with the annotations that come after it in the list of annotations,
+    so that each combination is built exactly once (instead of once per permutation).
+    The combinations built in the canonical order are the first permutations visited otherwise, so that the rare combinations retrieved are the same.
+    """
     
     if current_depth >= max_depth:
         return
 
-    for annotation in annotations:
-        node = TreeNode(annotation, dico_anns_filtered, parent)
-        if len(node.docs)>0:
-            parent.add_child(node)
-            if len(node.docs) >= threshold_number_docs:
-                build_tree_recursive([a for a in annotations if a!=annotation], node, current_depth+1, max_depth, threshold_number_docs, dico_anns_filtered)
+    # Intersect the documents of the parent with those of every remaining annotation at once
+    for i, docs, nb_docs in doc_sets.intersect(parent.docs, annotations):
+        node = TreeNode(doc_sets.annotations[annotations[i]], doc_sets, parent, docs, nb_docs)
+        parent.add_child(node)
+        if node.nb_docs >= threshold_number_docs:
+            remaining_annotations = annotations[i+1:] if canonical_order else np.delete(annotations, i)
+            build_tree_recursive(remaining_annotations, node, current_depth+1, max_depth, threshold_number_docs, doc_sets, canonical_order)
             
                  
 
-def build_tree(annotations, max_depth, threshold_number_docs, dico_anns_filtered):
+def build_tree(annotations, max_depth, threshold_number_docs, dico_anns_filtered, canonical_order=True):
     """Builds the root of the tree and starts calls the function to recursively complete it"""
 
     annotations = list(annotations)
-    root = TreeNode(annotations[0], dico_anns_filtered)
-    build_tree_recursive(annotations[1:], root, 0, max_depth, threshold_number_docs, dico_anns_filtered)
+    doc_sets = DocumentSets(dico_anns_filtered)
+    root = TreeNode(annotations[0], doc_sets)
+    build_tree_recursive(doc_sets.rows(annotations[1:]), root, 0, max_depth, threshold_number_docs, doc_sets, canonical_order)
     return root
 
 
@@ -88,4 +104,116 @@ def get_rare_combinations(tree_dict, threshold_nb_docs, max_combination_size, cu
     for child in tree_dict.get('children', []):
         get_rare_combinations(child, threshold_nb_docs, max_combination_size, current_combination.copy(), current_docs, results, flagged_combinations)
 
-    return results
\ No newline at end of file
+    return results
+
+
+def iter_rare_combinations_recursive(annotations, docs, combination, current_depth, max_depth, threshold_nb_docs, doc_sets):
+    """
+    Recursively yields the rare combinations extending the current combination, following the canonical order
+    Combinations are yielded as lists of postings row IDs, along with their set of documents
+    """
+
+    if current_depth >= max_depth:
+        return
+
+    for i, child_docs, nb_docs in doc_sets.intersect(docs, annotations):
+        child_combination = combination + [int(annotations[i])]
+        if nb_docs <= threshold_nb_docs:
+            yield child_combination, child_docs
+        else:
+            yield from iter_rare_combinations_recursive(annotations[i+1:], child_docs, child_combination, current_depth+1, max_depth, threshold_nb_docs, doc_sets)
+
+
+# State of each worker process, set once by init_rare_combinations_worker
+worker_state = {}
+
+def init_rare_combinations_worker(postings_path, annotations, root_docs, max_depth, threshold_nb_docs, chunk_size):
+    """Memory-maps the postings (read-only, shared with the other processes) and stores the parameters of the search"""
+    worker_state.update({
+        'doc_sets': DocumentSets.load(postings_path),
+        'shards_dir': os.path.dirname(postings_path),
+        'annotations': annotations,
+        'root_docs': root_docs,
+        'max_depth': max_depth,
+        'threshold_nb_docs': threshold_nb_docs,
+        'chunk_size': chunk_size
+    })
+
+
+def get_rare_combinations_shard(i):
+    """
+    Writes the rare combinations starting with the i-th annotation, as (row IDs, word IDs, words) tuples, to a file next to the postings
+    and returns its path. Combinations are pickled by chunks of chunk_size, so that the memory of the worker does not depend on the size of the shard.
+    """
+
+    doc_sets, annotations, root_docs = worker_state['doc_sets'], worker_state['annotations'], worker_state['root_docs']
+    max_depth, threshold_nb_docs, chunk_size = worker_state['max_depth'], worker_state['threshold_nb_docs'], worker_state['chunk_size']
+
+    path = os.path.join(worker_state['shards_dir'], f'shard_{i}.pkl')
+    with open(path, 'wb') as f:
+        chunk = []
+        for _, docs, nb_docs in doc_sets.intersect(root_docs, annotations[i:i+1]):
+            if nb_docs <= threshold_nb_docs:
+                results = [([int(annotations[i])], docs)]
+            else:
+                results = iter_rare_combinations_recursive(annotations[i+1:], docs, [int(annotations[i])], 1, max_depth, threshold_nb_docs, doc_sets)
+            for combination, (word_ids, words) in results:
+                chunk.append((combination, word_ids, words))
+                if len(chunk) >= chunk_size:
+                    pickle.dump(chunk, f, protocol=pickle.HIGHEST_PROTOCOL)
+                    chunk = []
+        if chunk:
+            pickle.dump(chunk, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return path
+
+
+def read_rare_combinations_shard(path):
+    """Yields the rare combinations of a shard written by get_rare_combinations_shard, one chunk in memory at a time, then removes its file"""
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                chunk = pickle.load(f)
+            except EOFError:
+                break
+            yield from chunk
+    os.remove(path)
+
+
+def iter_rare_combinations(annotations, max_depth, threshold_nb_docs, dico_anns_filtered, workers=1, chunk_size=10_000):
+    """
+    Depth-first search yielding rare combinations of annotations as soon as they are found, without building the tree.
+    Yields the same combinations, in the same order, as get_rare_combinations on the tree built in canonical order:
+    in that order, the only subsets of a combination that can be flagged before it are its prefixes,
+    so that a combination is rare and not flagged if, and only if, it is rare and all its prefixes are not.
+    Memory only depends on the depth of the search.
+
+    With several workers, the search is sharded by first-level annotation across a pool of processes sharing a memory-mapped copy of the postings.
+    Each shard is streamed to a temporary file by chunks of chunk_size combinations (see get_rare_combinations_shard),
+    so that memory stays bounded; shards waiting to be merged are kept on disk. Shards are merged in order,
+    so that the results are the same as with a single process.
+    """
+
+    annotations = list(annotations)
+    doc_sets = DocumentSets(dico_anns_filtered)
+    root_docs = doc_sets.get(annotations[0])
+    rows = doc_sets.rows(annotations[1:])
+
+    # The root (eg, the empty annotation contained in every document) is itself rare
+    if doc_sets.count(root_docs) <= threshold_nb_docs:
+        yield {'combination': [], 'docs': doc_sets.decode(root_docs)}
+        return
+
+    if workers <= 1 or max_depth < 1:
+        rare_combinations = iter_rare_combinations_recursive(rows, root_docs, [], 0, max_depth, threshold_nb_docs, doc_sets)
+        for combination, docs in rare_combinations:
+            yield {'combination': [doc_sets.annotations[row] for row in combination], 'docs': doc_sets.decode(docs)}
+        return
+
+    with tempfile.TemporaryDirectory(prefix='csc_postings_') as tmp_dir:
+        postings_path = os.path.join(tmp_dir, 'postings.npy')
+        doc_sets.save(postings_path)
+        initargs = (postings_path, rows, root_docs, max_depth, threshold_nb_docs, chunk_size)
+        with multiprocessing.Pool(workers, initializer=init_rare_combinations_worker, initargs=initargs) as pool:
+            for shard_path in pool.imap(get_rare_combinations_shard, range(len(rows))):
+                for combination, word_ids, words in read_rare_combinations_shard(shard_path):
+                    yield {'combination': [doc_sets.annotations[row] for row in combination], 'docs': doc_sets.decode((word_ids, words))}
@@ -1,30 +1,33 @@
-import matplotlib.pyplot as plt
-import seaborn as sns
+import numpy as np
 import pandas as pd
+from csc_lib.rule_table import get_lengths
 
 def violin_plot(df, target_column, title, filter_func=None):
 
+    # Plotting libraries are only imported when a plot is drawn
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
     fig, ax = plt.subplots(figsize=(19, 6))
 
+    df = df.dropna()
+    found_each_try = df[f'# {target_column} found each try']
+
     # Store number of targets found in generated text
     if filter_func is None:
-        targets_length = [len(row[target_column]) for _, row in df.dropna().iterrows()]
+        targets_length = get_lengths(df[target_column]).to_numpy()
     # If specified, a filtered is applied (eg: lambda x: len([a for a in x if a[1] in {'PROC', 'DISO', 'CHEM'}])
     else:
-        targets_length = [filter_func(row[target_column]) for _, row in df.dropna().iterrows()]
-    
+        targets_length = np.array([filter_func(targets) for targets in df[target_column]])
+
     # Define a color for each violin depending on the proportion of targets found during the most successful try
     cmap = plt.cm.Reds
-    colors = []
-    data = []
-    for i, (_, row) in enumerate(df.dropna().iterrows()):
-        max_val = max(row[f'# {target_column} found each try'])
-        colors.append(cmap(max_val / targets_length[i]))
-
-        # Format the data before plotting
-        for val in row[f'# {target_column} found each try']:
-            data.append({'Row': i, 'Value': val})
-    data_df = pd.DataFrame(data)
+    max_vals = np.array([max(found) for found in found_each_try])
+    colors = [cmap(ratio) for ratio in max_vals / targets_length]
+
+    # Format the data before plotting (one row per try)
+    nb_tries = get_lengths(found_each_try).to_numpy()
+    data_df = pd.DataFrame({'Row': np.repeat(np.arange(len(df)), nb_tries), 'Value': np.concatenate([np.asarray(found) for found in found_each_try]) if len(df) else []})
 
     sns.violinplot(data=data_df, x='Row', y='Value', hue='Row', ax=ax, inner=None, cut=0, palette=colors, legend=False)
 
@@ -1,36 +1,44 @@
 import os
-import pandas as pd
 import argparse
-from csc_lib.data_loader import load_models
-from csc_lib.data_processing import correct_literal_eval
-from csc_lib.classification import calculate_all_ppls, prepare_data_downsample, train_and_evaluate_model
-from csc_lib.config import FT_MODEL_PATH, OUTPUT_PATH, models_and_params
+from csc_lib.data_loader import load_models, PRECISIONS
+from csc_lib.artifacts import load_association_rules
+from csc_lib.classification import calculate_all_ppls, prepare_data_downsample, train_and_evaluate_model, build_model
+from csc_lib.ppl_cache import PerplexityCache
+from csc_lib.model_server import connect_models
+from csc_lib.config import FT_MODEL_PATH, OUTPUT_PATH, PPL_CACHE_PATH, MODEL_PRECISION, PPL_WORKERS, MODEL_SERVER_ADDRESS, models_and_params
 
-def main(train_rules_path, unseen_rules_path, experiment_name, base_model_path, ft_model_path=FT_MODEL_PATH):
+def main(train_rules_path, unseen_rules_path, experiment_name, base_model_path, ft_model_path=FT_MODEL_PATH, model_precision=MODEL_PRECISION, workers=PPL_WORKERS, server=None):
 
     # Check if association rules paths exist
     if not os.path.isfile(train_rules_path):
-        raise FileNotFoundError(f"The specified path for CSV file containing association rules is not correct: {train_rules_path}")
+        raise FileNotFoundError(f"The specified path for the file containing association rules is not correct: {train_rules_path}")
     if not os.path.isfile(unseen_rules_path):
-        raise FileNotFoundError(f"The specified path for CSV file containing association rules is not correct: {unseen_rules_path}")
+        raise FileNotFoundError(f"The specified path for the file containing association rules is not correct: {unseen_rules_path}")
     
     # Creates save path
     save_path = os.path.join(OUTPUT_PATH, experiment_name)
     os.makedirs(save_path, exist_ok=True)
     
-    # Load association rules
-    train_rules = pd.read_csv(train_rules_path, index_col=0)
-    train_rules = correct_literal_eval(train_rules, ['antecedents', 'consequents'])
-    unseen_rules = pd.read_csv(unseen_rules_path, index_col=0)
-    unseen_rules = correct_literal_eval(unseen_rules, ['antecedents', 'consequents'])
+    # Load association rules (only the itemsets of the rules of 3 annotations are needed)
+    train_rules = load_association_rules(train_rules_path, columns=['antecedents', 'consequents'], lengths=[3])
+    unseen_rules = load_association_rules(unseen_rules_path, columns=['antecedents', 'consequents'], lengths=[3])
 
-    # Prepare base model and fine-tuned model to measure their perplexity
-    tokenizer, base_model, ft_model = load_models(ft_model_path, base_model_path)
+    # Prepare base model and fine-tuned model to measure their perplexity (or use the ones of a model server, already loaded, which tokenizes the associations)
+    if server is not None:
+        tokenizer = None
+        _, base_model, ft_model = connect_models(server)
+    else:
+        tokenizer, base_model, ft_model = load_models(ft_model_path, base_model_path, precision=model_precision)
 
-    # Calculate perplexities for each model
+    # Calculate perplexities for each model (only the ones missing from the cache)
     # Currently we only consider associations of 3 annotations
-    ppls_train_data = calculate_all_ppls(train_rules, base_model, ft_model, tokenizer, len_associations=3)
-    ppls_unseen_data = calculate_all_ppls(unseen_rules, base_model, ft_model, tokenizer, len_associations=3)
+    cache = PerplexityCache(PPL_CACHE_PATH) if PPL_CACHE_PATH is not None else None
+    ppls_train_data = calculate_all_ppls(train_rules, base_model, ft_model, tokenizer, len_associations=3, cache=cache, workers=workers)
+    ppls_unseen_data = calculate_all_ppls(unseen_rules, base_model, ft_model, tokenizer, len_associations=3, cache=cache, workers=workers)
+    if cache is not None:
+        stats = cache.stats()
+        print(f"Perplexity cache: {stats['memory_hits'] + stats['disk_hits']} hits ({stats['memory_hits']} in memory), {stats['misses']} misses.")
+        cache.close()
 
     # Split into training and testing set after balancing classes by downsampling
     X_train, X_test, y_train, y_test = prepare_data_downsample(ppls_unseen_data, ppls_train_data)
@@ -41,7 +49,7 @@ def main(train_rules_path, unseen_rules_path, experiment_name, base_model_path,
         print(f"Training {model_name}...", end=' ')
         result = train_and_evaluate_model(
             X_train, X_test, y_train, y_test,
-            model_info['model'], model_info['param_grid'],
+            build_model(model_info), model_info['param_grid'],
             os.path.join(OUTPUT_PATH, experiment_name, f'ROC_curve_{model_name}.png')
         )
         print("✔")
@@ -66,13 +74,16 @@ def main(train_rules_path, unseen_rules_path, experiment_name, base_model_path,
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description='Measure to which extent a model can generate consequents when prompting antecedents')
-    parser.add_argument('-t', '--train_rules_path', type=str, required=True, help='Path to the association rules csv file of training data')
-    parser.add_argument('-u', '--unseen_rules_path', type=str, required=True, help='Path to the association rules csv file of unseen data')
+    parser.add_argument('-t', '--train_rules_path', type=str, required=True, help='Path to the association rules file (.parquet or .csv) of training data')
+    parser.add_argument('-u', '--unseen_rules_path', type=str, required=True, help='Path to the association rules file (.parquet or .csv) of unseen data')
     parser.add_argument('-b', '--base_model', type=str, default='bigscience/bloom-1b1', help='Base model path')
     parser.add_argument('-ft', '--ft_model_path', type=str, default=FT_MODEL_PATH, help='Path to the fine-tuned model')
     parser.add_argument('-e', '--experiment_name', type=str, required=True)
+    parser.add_argument('--model_precision', type=str, default=MODEL_PRECISION, choices=PRECISIONS, help='Precision of the weights of the models (bf16 and int8-dynamic use less memory, int8-dynamic runs on CPU only)')
+    parser.add_argument('--workers', type=int, default=PPL_WORKERS, help='Number of processes sharing the calculation of perplexities (models on CPU only)')
+    parser.add_argument('--server', type=str, nargs='?', const=MODEL_SERVER_ADDRESS, default=None, help='Use the models of a model server (see serve_models.py) at this address (default: MODEL_SERVER_ADDRESS) instead of loading them')
     args = parser.parse_args()
 
     train_rules_path, unseen_rules_path, experiment_name, base_model_path, ft_model_path = args.train_rules_path, args.unseen_rules_path, args.experiment_name, args.base_model, args.ft_model_path
 
-    main(train_rules_path, unseen_rules_path, experiment_name, base_model_path, ft_model_path=FT_MODEL_PATH)
\ No newline at end of file
+    main(train_rules_path, unseen_rules_path, experiment_name, base_model_path, ft_model_path=FT_MODEL_PATH, model_precision=args.model_precision, workers=args.workers, server=args.server)
\ No newline at end of file
@@ -1,24 +1,38 @@
 import os
 import argparse
-from csc_lib.config import OUTPUT_PATH
-from csc_lib.annotation_processor import load_annotations_from_folder, flatten_annotations_dict
-from csc_lib.association_rules import get_associations
+from csc_lib.config import OUTPUT_PATH, ARTIFACT_FORMAT
+from csc_lib.annotation_processor import flatten_annotations_dict
+from csc_lib.corpus_index import load_corpus_index
+from csc_lib.association_rules import get_associations, MINING_BACKENDS
+from csc_lib.incremental_associations import get_associations_incremental
+from csc_lib.artifacts import ARTIFACT_FORMATS, save_association_rules
 
-def main(ann_path, experiment_name, min_docs, min_confidence):
+def main(ann_path, experiment_name, min_docs, min_confidence, backend='fpgrowth', incremental=False, artifact_format=ARTIFACT_FORMAT):
 
-    # Process annotations
-    dict_annotations = load_annotations_from_folder(ann_path)
-    all_annotations_flatten = flatten_annotations_dict(dict_annotations)
+    save_path = os.path.join(OUTPUT_PATH, experiment_name)
+    os.makedirs(save_path, exist_ok=True)
+
+    # Process annotations (cached in an on-disk index, only new or modified files are parsed)
+    corpus_index = load_corpus_index(ann_path)
 
     # Get associations rules
     print("Getting associations rules...")
-    association_rules = get_associations(all_annotations_flatten, dict_annotations, min_docs, min_confidence)
-
-    # Save associations to csv
+    if incremental:
+        # Update the frequent itemsets of the previous run with the added, modified and removed files
+        state_path = os.path.join(save_path, f'frequent_itemsets_{min_docs}_docs.pkl')
+        association_rules = get_associations_incremental(corpus_index, state_path, min_docs, min_confidence)
+    else:
+        dict_annotations = corpus_index.annotations_dict()
+        all_annotations_flatten = flatten_annotations_dict(dict_annotations)
+        association_rules = get_associations(all_annotations_flatten, dict_annotations, min_docs, min_confidence, backend)
+
+    # Save associations (to Parquet, with native lists of annotations, or to CSV)
     print("Saving results...")
-    save_path = os.path.join(OUTPUT_PATH, experiment_name)
-    os.makedirs(save_path, exist_ok=True)
-    association_rules.to_csv(os.path.join(save_path, f'FP_growth_{min_docs}_docs_{min_confidence}_confidence.csv'))
+    output_file = os.path.join(save_path, f'FP_growth_{min_docs}_docs_{min_confidence}_confidence.{artifact_format}')
+    if artifact_format == 'parquet':
+        save_association_rules(association_rules, output_file)
+    else:
+        association_rules.to_csv(output_file)
 
     print(f"Task completed successfully. Results are stored in {save_path}/ .")
 
@@ -30,10 +44,14 @@ if __name__ == "__main__":
     parser.add_argument('-e', '--experiment_name', type=str, required=True)
     parser.add_argument('--min_docs', type=int, default=3, help='Minimum number of docs')
     parser.add_argument('--min_confidence', type=float, default=0.5, help='Minimum confidence threshold')
+    parser.add_argument('--backend', type=str, default='fpgrowth', choices=list(MINING_BACKENDS), help='Algorithm used to find frequent itemsets')
+    parser.add_argument('--incremental', action='store_true', help='Update the frequent itemsets of the previous run of the experiment with the added, modified and removed files only (mined with Eclat)')
+    parser.add_argument('--format', type=str, default=ARTIFACT_FORMAT, choices=ARTIFACT_FORMATS, help='Format of the saved association rules')
     args = parser.parse_args()
 
-    path, experiment_name, min_docs, min_confidence = args.path, args.experiment_name, args.min_docs, args.min_confidence
+    path, experiment_name, min_docs, min_confidence, backend, incremental = args.path, args.experiment_name, args.min_docs, args.min_confidence, args.backend, args.incremental
+    artifact_format = args.format
 
     print(f"Looking for the most common associations in at least {min_docs} documents with a confidence >= {min_confidence} :")
 
-    main(path, experiment_name, min_docs, min_confidence)
\ No newline at end of file
+    main(path, experiment_name, min_docs, min_confidence, backend, incremental, artifact_format)
\ No newline at end of file
@@ -1,39 +1,68 @@
 import os
 import argparse
 import pandas as pd
-from csc_lib.config import OUTPUT_PATH
-from csc_lib.annotation_processor import load_annotations_from_folder, reverse_annotations_dict
-from csc_lib.tree_builder import  build_tree_recursive, build_tree, get_rare_combinations
+from tqdm import tqdm
+from csc_lib.config import OUTPUT_PATH, ARTIFACT_FORMAT
+from csc_lib.corpus_index import load_corpus_index
+from csc_lib.tree_builder import  build_tree_recursive, build_tree, get_rare_combinations, iter_rare_combinations
+from csc_lib.result_writers import SortedCSVWriter
+from csc_lib.artifacts import ARTIFACT_FORMATS, rare_combinations_writer
+from csc_lib.rule_table import get_lengths
 
-def main(ann_path, experiment_name, max_depth, threshold_nb_docs):
+def main(ann_path, experiment_name, max_depth, threshold_nb_docs, canonical_order=True, max_buffer_mb=512, workers=1, artifact_format=ARTIFACT_FORMAT):
 
-    # Process annotations
-    dict_annotations = load_annotations_from_folder(ann_path)
+    # Process annotations (cached in an on-disk index, only new or modified files are parsed)
+    corpus_index = load_corpus_index(ann_path)
 
     # Format training annotations
-    dict_annotations_reversed = reverse_annotations_dict(dict_annotations)
-
-    # Build a tree representing combinations of annotations
-    print("Building combinations tree... (This step can be long)")
-    root = build_tree(list(dict_annotations_reversed.keys()), max_depth=max_depth, threshold_number_docs=threshold_nb_docs, dico_anns_filtered=dict_annotations_reversed)
-
-    # Format and save the output
-    print("Identifying combinations...")
-    rare_combinations = get_rare_combinations(
-        tree_dict = root.to_dict(),
-        threshold_nb_docs = threshold_nb_docs,
-        max_combination_size = max_depth
-    )
-
-    df_rare_combis = pd.DataFrame(rare_combinations)
-    df_rare_combis['# docs'] = df_rare_combis.apply(lambda x: len(x['docs']), axis=1)
-    df_rare_combis['# annotations'] = df_rare_combis.apply(lambda x: len(x['combination']), axis=1)
-    df_rare_combis.sort_values(by=['# docs', '# annotations'], ascending=False, inplace=True)
-
-    print("Saving results...")
+    dict_annotations_reversed = corpus_index.reversed_annotations_dict()
+
     save_path = os.path.join(OUTPUT_PATH, experiment_name)
     os.makedirs(save_path, exist_ok=True)
-    df_rare_combis.to_csv(os.path.join(save_path, f'rare_combinations_{max_depth}_anns_{threshold_nb_docs}_docs.csv'))
+    output_file = os.path.join(save_path, f'rare_combinations_{max_depth}_anns_{threshold_nb_docs}_docs.{artifact_format}')
+    # In Parquet files, documents are stored as IDs (position in the list of filenames stored in the file)
+    doc_ids = {filename: doc_id for doc_id, filename in enumerate(corpus_index.filenames)}
+
+    if canonical_order:
+        # Stream rare combinations to the output file as soon as they are found, without building the tree
+        print("Identifying combinations... (This step can be long)")
+        rare_combinations = iter_rare_combinations(list(dict_annotations_reversed.keys()), max_depth=max_depth, threshold_nb_docs=threshold_nb_docs, dico_anns_filtered=dict_annotations_reversed, workers=workers)
+        if artifact_format == 'parquet':
+            writer = rare_combinations_writer(output_file, corpus_index.filenames, max_buffer_bytes=max_buffer_mb * 2**20)
+        else:
+            writer = SortedCSVWriter(output_file, ['combination', 'docs', '# docs', '# annotations'], max_buffer_bytes=max_buffer_mb * 2**20)
+        with writer:
+            for rare_combination in tqdm(rare_combinations, desc='Saving rare combinations...'):
+                combination, docs = rare_combination['combination'], rare_combination['docs']
+                if artifact_format == 'parquet':
+                    docs = [doc_ids[doc] for doc in docs]
+                writer.write((len(docs), len(combination)), [combination, docs, len(docs), len(combination)])
+
+    else:
+        # Build a tree representing combinations of annotations
+        print("Building combinations tree... (This step can be long)")
+        root = build_tree(list(dict_annotations_reversed.keys()), max_depth=max_depth, threshold_number_docs=threshold_nb_docs, dico_anns_filtered=dict_annotations_reversed, canonical_order=canonical_order)
+
+        # Format and save the output
+        print("Identifying combinations...")
+        rare_combinations = get_rare_combinations(
+            tree_dict = root.to_dict(),
+            threshold_nb_docs = threshold_nb_docs,
+            max_combination_size = max_depth
+        )
+
+        df_rare_combis = pd.DataFrame(rare_combinations)
+        df_rare_combis['# docs'] = get_lengths(df_rare_combis['docs'])
+        df_rare_combis['# annotations'] = get_lengths(df_rare_combis['combination'])
+        df_rare_combis.sort_values(by=['# docs', '# annotations'], ascending=False, inplace=True)
+
+        print("Saving results...")
+        if artifact_format == 'parquet':
+            with rare_combinations_writer(output_file, corpus_index.filenames) as writer:
+                for combination, docs, nb_docs, nb_annotations in zip(df_rare_combis['combination'], df_rare_combis['docs'], df_rare_combis['# docs'], df_rare_combis['# annotations']):
+                    writer.write((nb_docs, nb_annotations), [combination, [doc_ids[doc] for doc in docs], nb_docs, nb_annotations])
+        else:
+            df_rare_combis.to_csv(output_file)
 
     print(f"Task completed successfully. Results are stored in {save_path}/.")
 
@@ -46,13 +75,21 @@ if __name__ == "__main__":
     parser.add_argument('-e', '--experiment_name', type=str, required=True)
     parser.add_argument('-d', '--max_depth', type=int, default=3, help='Maximum depth of constructed tree (ie, max size of combination)')
     parser.add_argument('-t', '--threshold_nb_docs', type=int, default=5, help='Find the combinations present in at most the number of documents specified')
+    parser.add_argument('--enumeration', type=str, default='canonical', choices=['canonical', 'permutations'], help='Build each combination once (canonical) or once per permutation (permutations, slower but same results)')
+    parser.add_argument('--max_buffer_mb', type=int, default=512, help='Memory (in MB) used to buffer rare combinations before spilling them to disk (canonical enumeration only)')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes sharing the search, sharded by first annotation (canonical enumeration only)')
+    parser.add_argument('--format', type=str, default=ARTIFACT_FORMAT, choices=ARTIFACT_FORMATS, help='Format of the saved rare combinations')
     args = parser.parse_args()
 
-    path, experiment_name, max_depth, threshold_nb_docs = args.path, args.experiment_name, args.max_depth, args.threshold_nb_docs
+    if args.workers > 1 and args.enumeration != 'canonical':
+        parser.error('--workers is only supported with --enumeration canonical')
+
+    path, experiment_name, max_depth, threshold_nb_docs, canonical_order = args.path, args.experiment_name, args.max_depth, args.threshold_nb_docs, args.enumeration == 'canonical'
+    max_buffer_mb, workers, artifact_format = args.max_buffer_mb, args.workers, args.format
 
     print(f"Looking for rare combinations of size <= {max_depth} present in at most {threshold_nb_docs} training documents :")
 
-    main(path, experiment_name, max_depth, threshold_nb_docs)
+    main(path, experiment_name, max_depth, threshold_nb_docs, canonical_order, max_buffer_mb, workers, artifact_format)
 
 
     
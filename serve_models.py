@@ -0,0 +1,31 @@
+import argparse
+from csc_lib.data_loader import load_models, PRECISIONS
+from csc_lib.model_server import ModelServer, parse_address, check_server_address
+from csc_lib.config import FT_MODEL_PATH, MODEL_PRECISION, MODEL_SERVER_ADDRESS, MODEL_SERVER_AUTHKEY
+
+def main(base_model_path, ft_model_path=FT_MODEL_PATH, model_precision=MODEL_PRECISION, address=MODEL_SERVER_ADDRESS, allow_remote=False):
+
+    # Check the address before loading the models
+    check_server_address(parse_address(address), MODEL_SERVER_AUTHKEY, allow_remote)
+
+    # Models are loaded once, then served until the server is interrupted (Ctrl+C)
+    tokenizer, base_model, ft_model = load_models(ft_model_path, base_model_path, precision=model_precision)
+    server = ModelServer(tokenizer, {'base': base_model, 'ft': ft_model},
+                         info={'base_model': base_model_path, 'ft_model': ft_model_path, 'precision': model_precision})
+    try:
+        server.serve(address, MODEL_SERVER_AUTHKEY, allow_remote)
+    except KeyboardInterrupt:
+        print("Server stopped.")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Keep the base and fine-tuned models loaded, and serve them to consequents_generation.py and determine_source_corpus.py (run with --server)')
+    parser.add_argument('-b', '--base_model', type=str, default='bigscience/bloom-1b1', help='Base model path')
+    parser.add_argument('-ft', '--ft_model_path', type=str, default=FT_MODEL_PATH, help='Path to the fine-tuned model')
+    parser.add_argument('--model_precision', type=str, default=MODEL_PRECISION, choices=PRECISIONS, help='Precision of the weights of the models (bf16 and int8-dynamic use less memory, int8-dynamic runs on CPU only)')
+    parser.add_argument('--address', type=str, default=MODEL_SERVER_ADDRESS, help='Path of the Unix socket, or localhost:port (needs MODEL_SERVER_AUTHKEY), the server listens on')
+    parser.add_argument('--allow_remote', action='store_true', help='Allow listening on a host other than a loopback address (eg, 0.0.0.0), reachable from other machines')
+    args = parser.parse_args()
+
+    main(args.base_model, args.ft_model_path, args.model_precision, args.address, args.allow_remote)